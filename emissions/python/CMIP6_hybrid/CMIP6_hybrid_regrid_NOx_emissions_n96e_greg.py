@@ -32,17 +32,25 @@
 ##############################################################################################
 
 # preamble
+import os
+import sys
 import time
 import iris
 import cf_units
 import numpy
+# shared regridding helpers in emissions/python/ukca_emiss
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ukca_emiss
 
 # --- CHANGE THINGS BELOW THIS LINE TO WORK WITH YOUR FILES ETC. ---
 
-# name of file containing an ENDGame grid, e.g. your model output
+# name of file containing an ENDGame grid, e.g. your model output, or the
+# name of a standard ENDGame grid (N48e, N96e, N216e or N512e), which
+# needs no file at all
 # NOTE: all the fields in the file should be on the same horizontal
 #       grid, as the field used MAY NOT be the first in order of STASH
-grid_file='/group_workspaces/jasmin2/ukca/vol1/mkoehler/um/archer/ag542/apm.pp/ag542a.pm1988dec'
+#grid_file='/group_workspaces/jasmin2/ukca/vol1/mkoehler/um/archer/ag542/apm.pp/ag542a.pm1988dec'
+grid_file='N96e'
 #
 # name of emissions file 
 emissions_file='/group_workspaces/jasmin2/ukca/vol1/mkoehler/emissions/CMIP6/0.5x0.5_combined_hybrid/v2/CMIP6_hybrid_combined_NOx_1960-2020_greg_v2.nc'
@@ -60,16 +68,14 @@ stash='m01s00i301'
 species_name='NO'
 
 # this is the grid we want to regrid to, e.g. N96 ENDGame
-grd=iris.load(grid_file)[0]
-grd.coord(axis='x').guess_bounds()
-grd.coord(axis='y').guess_bounds()
+grd=ukca_emiss.load_grid(grid_file)
 
 # This is the original data
 ems=iris.load_cube(emissions_file)
 
-# make intersection between 0 and 360 longitude to ensure that 
-# the data is regridded correctly
-nems = ems.intersection(longitude=(0, 360))
+# no need to make an intersection between 0 and 360 longitude, which
+# copies all the data: the regrid weights wrap the longitudes themselves
+nems = ems
 
 # make sure that we use the same coordinate system, otherwise regrid won't work
 nems.coord(axis='x').coord_system=grd.coord_system()
@@ -79,8 +85,10 @@ nems.coord(axis='y').coord_system=grd.coord_system()
 nems.coord(axis='x').guess_bounds()
 nems.coord(axis='y').guess_bounds()
 
-# now regrid
-ocube=nems.regrid(grd,iris.analysis.AreaWeighted())
+# now regrid, reusing cached area-weighted regrid weights, straight into
+# 32-bit. The regridded data are lazy: they are read, regridded and written
+# a year at a time
+ocube=ukca_emiss.regrid(nems,grd,dtype='float32')
 
 # now add correct attributes and names to netCDF file
 ocube.var_name='emissions_'+str.strip(species_name)
@@ -191,21 +199,12 @@ ocube.coord(axis='t').points=numpy.array([15.5, 45.5, 75.5, 106, 136.5, 167, 197
     21899.5, 21930.5, 21960.5, 21990.5, 22021, 22051.5, 22082, 22112.5,
     22143.5, 22174, 22204.5, 22235, 22265.5])
 
-# make z-direction.
+# make z-direction, putting Z 2nd. The data are already float32 and this
+# only adds a length-1 axis to them; it also makes the x, y and t
+# coordinates (and the latitude bounds, which are float) 64-bit
 zdims=iris.coords.DimCoord(numpy.array([0]),standard_name = 'model_level_number',
                            units='1',attributes={'positive':'up'})
-ocube.add_aux_coord(zdims)
-ocube=iris.util.new_axis(ocube, zdims)
-# now transpose cube to put Z 2nd
-ocube.transpose([1,0,2,3])
-
-# make coordinates 64-bit
-ocube.coord(axis='x').points=ocube.coord(axis='x').points.astype(dtype='float64')
-ocube.coord(axis='y').points=ocube.coord(axis='y').points.astype(dtype='float64')
-#ocube.coord(axis='z').points=ocube.coord(axis='z').points.astype(dtype='float64') # integer
-ocube.coord(axis='t').points=ocube.coord(axis='t').points.astype(dtype='float64')
-# for some reason, longitude_bounds are double, but latitude_bounds are float
-ocube.coord('latitude').bounds=ocube.coord('latitude').bounds.astype(dtype='float64')
+ocube=ukca_emiss.add_level_axis(ocube, zdims)
 
 
 # add forecast_period & forecast_reference_time
@@ -299,17 +298,13 @@ ocube.add_aux_coord(fp_dims,data_dims=None)
 ocube.cell_methods = [iris.coords.CellMethod('mean', 'time')]
 # set _FillValue
 fillval=1e+20
-ocube.data = numpy.ma.array(data=ocube.data, fill_value=fillval, dtype='float32')
 
 # output file name, based on species
 outpath='ukca_emiss_'+species_name+'.nc'
 # don't want time to be cattable, as is a periodic emissions file
-iris.FUTURE.netcdf_no_unlimited=True
-# annoying hack to set a missing_value attribute as well as a _FillValue attribute
-dict.__setitem__(ocube.attributes, 'missing_value', fillval)
+# (save also sets a missing_value attribute as well as a _FillValue attribute)
 # now write-out to netCDF
-saver = iris.fileformats.netcdf.Saver(filename=outpath, netcdf_format='NETCDF3_CLASSIC')
-saver.update_global_attributes(Conventions=iris.fileformats.netcdf.CF_CONVENTIONS_VERSION)
-saver.write(ocube, local_keys=['vertical_scaling', 'missing_value','um_stash_source','tracer_name'])
+ukca_emiss.save(ocube, outpath, netcdf_format='NETCDF3_CLASSIC', fill_value=fillval, unlimited=False,
+                local_keys=['vertical_scaling', 'missing_value','um_stash_source','tracer_name'])
 
 # end of script
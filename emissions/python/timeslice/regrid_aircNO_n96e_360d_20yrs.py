@@ -31,9 +31,14 @@
 ##############################################################################################
 
 # preamble
+import os
+import sys
 import iris
 import cf_units
 import numpy
+# shared helpers in emissions/python/ukca_emiss
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ukca_emiss
 
 # --- CHANGE THINGS BELOW THIS LINE TO WORK WITH YOUR FILES ETC. ---
 
@@ -267,18 +272,17 @@ ocube.add_aux_coord(fp_dims,data_dims=None)
 ocube.cell_methods = [iris.coords.CellMethod('mean', 'time')]
 # set _FillValue
 fillval=1e+20
-ocube.data = numpy.ma.array(data=ocube.data, fill_value=fillval, dtype='float32')
 
 # output file name, based on species
 outpath='ukca_emiss_'+species_name+'.nc'
 # don't want time to be cattable, as is a periodic emissions file
-iris.FUTURE.netcdf_no_unlimited=False
-# annoying hack to set a missing_value attribute as well as a _FillValue attribute
-dict.__setitem__(ocube.attributes, 'missing_value', fillval)
-# now write-out to netCDF
-saver = iris.fileformats.netcdf.Saver(filename=outpath, netcdf_format='NETCDF4_CLASSIC')
-saver.update_global_attributes(Conventions=iris.fileformats.netcdf.CF_CONVENTIONS_VERSION)
-mycube=ocube[0:240,:,:,:].copy()
-saver.write(mycube, local_keys=['vertical_scaling', 'missing_value','um_stash_source','tracer_name'])
+# (save also sets a missing_value attribute as well as a _FillValue attribute)
+# now write-out to netCDF, only the first 240 months (slicing the lazy data
+# doesn't read anything), converted to 32-bit as the data are read, and read
+# and written in blocks of time steps and levels that fit the memory budget
+# (UKCA_EMISS_MEMORY)
+mycube = ukca_emiss.stream_levels(ocube[0:240,:,:,:], dtype='float32')
+ukca_emiss.save(mycube, outpath, netcdf_format='NETCDF4_CLASSIC', fill_value=fillval, unlimited=True,
+                local_keys=['vertical_scaling', 'missing_value','um_stash_source','tracer_name'])
 
 # end of script
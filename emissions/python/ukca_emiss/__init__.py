@@ -0,0 +1,15 @@
+##############################################################################################
+#
+#  ukca_emiss
+#
+#  Helpers shared by the regrid_*_n96e_* scripts in this directory. The
+#  scripts add emissions/python to sys.path and import this package.
+#
+##############################################################################################
+
+from .assemble import add_level_axis
+from .grids import endgame_grid, load_grid
+from .output import save
+from .pipeline import stream_levels
+from .regrid import regrid
+from .weights import load_weights
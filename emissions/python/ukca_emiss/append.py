@@ -0,0 +1,346 @@
+##############################################################################################
+#
+#  append.py
+#
+#  Add new months to the end of an existing ukca_emiss_*.nc time series,
+#  e.g. to extend the 1950-2020 files to 2021, without regridding the
+#  months that are already there.
+#
+#  Only the months of the source file after the last month of the existing
+#  file are read and regridded. The time and forecast_reference_time
+#  coordinates are extended to match: the new points are mid-month, like
+#  the existing ones, and the new bounds follow the existing bounds, either
+#  month boundaries or halfway between points (as guess_bounds gives, in
+#  which case the upper bound of the last existing step moves to halfway to
+#  the first new one, as if the whole file had been made at once). The
+#  existing time axis must be monthly and contiguous, and the source must
+#  carry on from its last month without a gap.
+#
+#  A file with an unlimited time dimension is appended to in place. The
+#  time dimension of the NETCDF3 files made by the scripts is fixed, so
+#  these are copied into a longer file (the existing data are copied, not
+#  regridded) which then replaces them.
+#
+#  Usage (from emissions/python):
+#      python -m ukca_emiss.append ukca_emiss_NO.nc \
+#          --script timeseries_1950-2020/regrid_NOx_emissions_n96e_360d.py
+#  where the script's emissions_file now runs to 2021 (or give --source
+#  and --grid instead of --script).
+#
+##############################################################################################
+
+import argparse
+import os
+import sys
+import time
+
+import cftime
+import iris
+import netCDF4
+import numpy
+
+from .batch import script_settings
+from .grids import load_grid
+from .periodic import _copy_attributes, _time_units
+from .pipeline import store
+from .regrid import CHUNK_SIZE, prepare_source, regrid
+from .writer import _VariableWriter
+
+
+def _months(dates):
+    # months since year 0 of each date
+    return numpy.array([date.year * 12 + date.month - 1 for date in dates])
+
+
+def month_bounds(months, units, calendar):
+    """Return the start and end of each of *months* (months since year 0)
+    in *units*, as an (n, 2) array."""
+    starts = [cftime.datetime(month // 12, month % 12 + 1, 1,
+                              calendar=calendar)
+              for month in list(months) + [months[-1] + 1]]
+    edges = numpy.asarray(cftime.date2num(starts, units, calendar),
+                          dtype='float64')
+    return numpy.stack([edges[:-1], edges[1:]], axis=-1)
+
+
+def _check_consecutive(months, what):
+    if len(months) > 1 and numpy.any(numpy.diff(months) != 1):
+        gap = numpy.nonzero(numpy.diff(months) != 1)[0][0]
+        raise ValueError('{} is not monthly and contiguous after '
+                         '{:04d}-{:02d}.'.format(what, months[gap] // 12,
+                                                 months[gap] % 12 + 1))
+
+
+def _guess_bounds(points):
+    # as iris.coords.Coord.guess_bounds: halfway between points, with the
+    # ends half a step out
+    points = numpy.asarray(points, dtype='float64')
+    diffs = numpy.diff(points)
+    edges = numpy.concatenate([[points[0] - diffs[0] / 2.0],
+                               points[:-1] + diffs / 2.0,
+                               [points[-1] + diffs[-1] / 2.0]])
+    return numpy.stack([edges[:-1], edges[1:]], axis=-1)
+
+
+def extend_time(points, bounds, months, new_months, units, calendar):
+    """Return (points, bounds) for *new_months* following on from the
+    existing *points* and *bounds* (or None) of *months*.
+
+    The returned bounds, if any, start at the last existing step, whose
+    upper bound may change. Raises a ValueError if the existing points are
+    not mid-month or the bounds follow no rule that can be extended.
+    """
+    existing = month_bounds(months, units, calendar)
+    if not numpy.allclose(points, existing.mean(axis=-1)):
+        raise ValueError('The existing time points are not mid-month.')
+    new = month_bounds(new_months, units, calendar)
+    new_points = new.mean(axis=-1)
+    if bounds is None:
+        return new_points, None
+    if numpy.allclose(bounds, existing):
+        return new_points, numpy.concatenate([bounds[-1:], new])
+    if len(points) > 1 and numpy.allclose(bounds, _guess_bounds(points)):
+        guessed = _guess_bounds(numpy.concatenate([points, new_points]))
+        return new_points, guessed[len(points) - 1:]
+    raise ValueError('The existing time bounds are neither month boundaries '
+                     'nor halfway between the points.')
+
+
+def _data_variable(dataset, time_names):
+    # the one variable along time that isn't a time or bounds
+    bounds = set(getattr(variable, 'bounds', None)
+                 for variable in dataset.variables.values())
+    found = [name for name, variable in dataset.variables.items()
+             if 'time' in variable.dimensions and name not in time_names
+             and name not in bounds]
+    if len(found) != 1:
+        raise ValueError('Expected one data variable along time, found {}.'
+                         .format(', '.join(found) or 'none'))
+    return found[0]
+
+
+def _check_grid(dataset, cube):
+    # the regridded data must be on the grid of the file
+    for axis in ('x', 'y'):
+        coord = cube.coord(axis=axis, dim_coords=True)
+        name = coord.var_name or coord.name()
+        if name not in dataset.variables or not numpy.allclose(
+                dataset.variables[name][:], coord.points):
+            raise ValueError('The {} coordinate of the regridded data does '
+                             'not match the file.'.format(name))
+
+
+def new_data(dataset, source, grid, chunk_size=CHUNK_SIZE):
+    """Return (new months, lazy regridded data) to add to *dataset*.
+
+    *source* is the emissions cube and *grid* the target grid. Only the
+    months of *source* after those of *dataset* are regridded. The data
+    have the shape of the data variable of *dataset* along time.
+    """
+    time_variable = dataset.variables['time']
+    units, calendar = _time_units(time_variable)
+    months = _months(cftime.num2date(time_variable[:], units, calendar))
+    _check_consecutive(months, 'The existing time axis')
+
+    time_coord = source.coord(axis='t', dim_coords=True)
+    source_months = _months(time_coord.units.num2date(time_coord.points))
+    index = numpy.nonzero(source_months > months[-1])[0]
+    if len(index) == 0:
+        return numpy.array([], dtype=int), None
+    new_months = source_months[index[0]:]
+    _check_consecutive(new_months, 'The source')
+    if new_months[0] != months[-1] + 1:
+        raise ValueError('The source starts {:04d}-{:02d}, leaving a gap '
+                         'after the existing {:04d}-{:02d}.'.format(
+                             new_months[0] // 12, new_months[0] % 12 + 1,
+                             months[-1] // 12, months[-1] % 12 + 1))
+
+    dim, = source.coord_dims(time_coord)
+    keys = [slice(None)] * source.ndim
+    keys[dim] = slice(index[0], None)
+    result = regrid(prepare_source(source[tuple(keys)], grid), grid,
+                    chunk_size=chunk_size)
+    _check_grid(dataset, result)
+
+    variable = dataset.variables[_data_variable(dataset, _time_names(dataset))]
+    shape = (len(new_months),) + variable.shape[1:]
+    if variable.dimensions[0] != 'time' or result.shape[-2:] != shape[-2:] \
+            or result.core_data().size != numpy.prod(shape):
+        raise ValueError('Regridded data of shape {} do not fit {} {}.'.format(
+            result.shape, variable.name, variable.dimensions))
+    data = result.lazy_data().astype(variable.dtype).reshape(shape)
+    return new_months, data
+
+
+def _time_names(dataset):
+    # the variables along time holding times, with their bounds
+    names = {}
+    for name, variable in dataset.variables.items():
+        if 'time' in variable.dimensions and _time_units(variable):
+            names[name] = getattr(variable, 'bounds', None)
+    return names
+
+
+def _extend_times(target, source, months, new_months):
+    # write the new time points and bounds of source into target
+    start = len(months)
+    for name, bounds_name in _time_names(source).items():
+        variable = source.variables[name]
+        units, calendar = _time_units(variable)
+        # (in place, the data already made the time dimension longer)
+        bounds = source.variables[bounds_name][:start] if bounds_name \
+            else None
+        points, new_bounds = extend_time(variable[:start], bounds, months,
+                                         new_months, units, calendar)
+        target.variables[name][start:] = points
+        if bounds_name:
+            target.variables[bounds_name][start - 1:] = new_bounds
+
+
+def _copy_longer(source, outpath, extra, chunk_size):
+    # copy source into the new file outpath, with a time dimension extra
+    # steps longer
+    target = netCDF4.Dataset(outpath, 'w', format=source.file_format)
+    try:
+        for name, dimension in source.dimensions.items():
+            size = None if dimension.isunlimited() else len(dimension)
+            if name == 'time' and size is not None:
+                size += extra
+            target.createDimension(name, size)
+        for name, variable in source.variables.items():
+            fill_value = variable.getncattr('_FillValue') \
+                if '_FillValue' in variable.ncattrs() else None
+            args = {}
+            if source.data_model.startswith('NETCDF4'):
+                chunking = variable.chunking()
+                if chunking and chunking != 'contiguous':
+                    args['chunksizes'] = chunking
+                filters = variable.filters() or {}
+                if filters.get('zlib'):
+                    args.update(zlib=True, complevel=filters['complevel'],
+                                shuffle=filters['shuffle'])
+            copy = target.createVariable(name, variable.dtype,
+                                         variable.dimensions,
+                                         fill_value=fill_value, **args)
+            copy.set_auto_maskandscale(False)
+            _copy_attributes(variable, copy)
+            if 'time' not in variable.dimensions:
+                copy[...] = variable[...]
+                continue
+            # the existing steps, a chunk at a time
+            length = len(source.dimensions['time'])
+            tdim = variable.dimensions.index('time')
+            for start in range(0, length, chunk_size):
+                keys = [slice(None)] * variable.ndim
+                keys[tdim] = slice(start, min(start + chunk_size, length))
+                copy[tuple(keys)] = variable[tuple(keys)]
+        _copy_attributes(source, target, skip=())
+    finally:
+        target.close()
+
+
+def append_months(path, source, grid, chunk_size=CHUNK_SIZE, title=None):
+    """Append the months of the cube *source* after the end of the
+    ukca_emiss_*.nc file *path* to it, regridded onto *grid*.
+
+    Returns the number of months appended. *title* replaces the title
+    attribute if given.
+    """
+    path = os.path.abspath(path)
+    dataset = netCDF4.Dataset(path)
+    try:
+        dataset.set_auto_maskandscale(False)
+        new_months, data = new_data(dataset, source, grid,
+                                    chunk_size=chunk_size)
+        if len(new_months) == 0:
+            return 0
+        time_variable = dataset.variables['time']
+        months = _months(cftime.num2date(time_variable[:],
+                                         *_time_units(time_variable)))
+        name = _data_variable(dataset, _time_names(dataset))
+        in_place = dataset.dimensions['time'].isunlimited()
+        if in_place:
+            outpath = path
+        else:
+            outpath = path + '.append.tmp'
+            _copy_longer(dataset, outpath, len(new_months), chunk_size)
+    finally:
+        dataset.close()
+
+    try:
+        # the data first: the file only looks longer once the times are in
+        store(data, _VariableWriter(outpath, name), start=len(months))
+
+        existing = netCDF4.Dataset(path, 'a' if in_place else 'r')
+        try:
+            existing.set_auto_maskandscale(False)
+            target = existing if in_place else netCDF4.Dataset(outpath, 'a')
+            try:
+                _extend_times(target, existing, months, new_months)
+                now = time.ctime(time.time())
+                last = new_months[-1]
+                target.setncattr('File_creation_date', now)
+                target.setncattr('history', '{}: appended {:04d}-{:02d} to '
+                                 '{:04d}-{:02d} \n{}'.format(
+                                     now, new_months[0] // 12,
+                                     new_months[0] % 12 + 1, last // 12,
+                                     last % 12 + 1,
+                                     getattr(existing, 'history', '')))
+                if title is not None:
+                    target.setncattr('title', title)
+            finally:
+                if not in_place:
+                    target.close()
+        finally:
+            existing.close()
+    except Exception:
+        if not in_place:
+            os.remove(outpath)
+        raise
+    if not in_place:
+        os.replace(outpath, path)
+    return len(new_months)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Append the new months of a source file to existing '
+                    'ukca_emiss_*.nc time series, regridding only those.')
+    parser.add_argument('files', nargs='+', help='ukca_emiss_*.nc time series')
+    parser.add_argument('--script', default=None,
+                        help='regrid script to take the source file '
+                             '(emissions_file) and grid (grid_file) from')
+    parser.add_argument('--source', default=None, help='source emissions file')
+    parser.add_argument('--grid', default=None,
+                        help='target grid: an ENDGame grid name or grid file')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='time steps read, regridded and copied at a time '
+                             '(default: %(default)s)')
+    parser.add_argument('--title', default=None,
+                        help='new title attribute (default: keep the title)')
+    args = parser.parse_args(argv)
+
+    source_file, grid_file = args.source, args.grid
+    if args.script:
+        settings = script_settings(args.script)
+        source_file = source_file or settings.get('emissions_file')
+        grid_file = grid_file or settings.get('grid_file')
+    if not source_file or not grid_file:
+        parser.error('give --script, or --source and --grid')
+
+    grid = load_grid(grid_file)
+    source = iris.load_cube(source_file)
+    for path in args.files:
+        try:
+            count = append_months(path, source, grid,
+                                  chunk_size=args.chunk_size,
+                                  title=args.title)
+        except ValueError as error:
+            sys.stderr.write('{}: {}\n'.format(path, error))
+            return 1
+        print('{}: appended {} months'.format(path, count))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+##############################################################################################
+#
+#  assemble.py
+#
+#  Putting a regridded (t, y, x) cube into the (t, 1, y, x) form of the
+#  emissions files.
+#
+#  The scripts used to do this with iris.util.new_axis and a transpose,
+#  then cast the coordinates to 64-bit one by one and the data to float32
+#  at the end. add_level_axis() does it all in one go: the data are cast
+#  to float32 only if they aren't already (ukca_emiss.regrid(...,
+#  dtype='float32') regrids straight into float32), the model level axis is
+#  a view of the data with a length-1 axis put in second place, and the
+#  horizontal and time coordinates are cast to float64 once. With lazy data
+#  this is all done a chunk at a time as the file is written.
+#
+##############################################################################################
+
+import iris.coords
+import iris.cube
+import iris.util
+import numpy
+
+from . import timing as _timing
+
+
+def _float64_coord(coord):
+    # as the scripts did: 64-bit points for the x, y and t dimension
+    # coordinates, and 64-bit bounds for x and y
+    axis = iris.util.guess_coord_axis(coord)
+    if axis not in ('X', 'Y', 'T'):
+        return coord.copy()
+    coord = coord.copy()
+    coord.points = coord.points.astype('float64')
+    if axis in ('X', 'Y') and coord.has_bounds():
+        coord.bounds = coord.bounds.astype('float64')
+    return coord
+
+
+@_timing.timed('assemble')
+def add_level_axis(cube, level_coord, dtype='float32'):
+    """Return the (t, y, x) *cube* as a (t, 1, y, x) cube.
+
+    *level_coord* is the one-point coordinate of the new axis (e.g.
+    model_level_number). The data are a view of those of *cube*, cast to
+    *dtype* if they are of another type (and not cast if *dtype* is None),
+    and the x, y and t dimension coordinates are made 64-bit.
+    """
+    if len(level_coord.points) != 1:
+        raise ValueError('Expected a level coordinate with one point, got {}.'
+                         .format(len(level_coord.points)))
+    data = cube.core_data()
+    if dtype is not None and data.dtype != numpy.dtype(dtype):
+        data = data.astype(dtype)
+    # a view with the new axis second, for numpy and dask arrays alike
+    data = data[:, numpy.newaxis]
+
+    result = iris.cube.Cube(data)
+    result.metadata = cube.metadata
+    for coord in cube.dim_coords:
+        dim, = cube.coord_dims(coord)
+        result.add_dim_coord(_float64_coord(coord), dim if dim < 1 else dim + 1)
+    result.add_dim_coord(iris.coords.DimCoord.from_coord(level_coord), 1)
+    for coord in cube.aux_coords:
+        dims = tuple(dim if dim < 1 else dim + 1
+                     for dim in cube.coord_dims(coord))
+        result.add_aux_coord(coord.copy(), dims)
+    return result
@@ -0,0 +1,263 @@
+##############################################################################################
+#
+#  audit.py
+#
+#  A check that the regrid kept the global mass of the emissions: the
+#  area-weighted global totals of a ukca_emiss_*.nc file, compared with
+#  those of its 0.5x0.5 degree source file and with the published totals in
+#  csv/v1 (the *_monthly_combined.csv and *_annual_combined.csv members of
+#  the species' zip file).
+#
+#  Both files are read a time chunk at a time with netCDF4 (so memory use is
+#  set by the chunk size, not the length of the series) and each chunk is
+#  reduced straight away to one emission rate (kg s-1) per time step (see
+#  totals.py). The cell area factors are cached by grid, so a batch of
+#  products on the same grids works them out once. Reading the data is
+#  most of the time taken, which is small next to the regrid itself.
+#
+#  The checks, each flagged if the relative difference of any step goes
+#  over the tolerance:
+#    regrid -- the rate of each month of the output against the source,
+#              which doesn't depend on the calendars of the two files
+#    csv    -- the monthly and annual totals (kg) of the output against
+#              csv/v1, with the month lengths of the output's calendar as
+#              in combine_all_sources_*.pro (30 days for 360_day files)
+#
+#  Usage (from emissions/python):
+#      python -m ukca_emiss.audit timeseries_1960-2020/regrid_CO_emissions_n96e_greg.py \
+#          --output-dir /path/to/output
+#  which audits the script's output file against its emissions_file, or
+#      python -m ukca_emiss.audit ukca_emiss_CO.nc --source combined_sources_CO.nc
+#
+##############################################################################################
+
+import argparse
+import glob
+import os
+import re
+import sys
+import zipfile
+
+import numpy
+
+from .batch import script_settings
+from .regrid import CHUNK_SIZE
+from .totals import annual_totals, global_totals, read_csv_totals
+
+# largest relative difference of a month or year that passes
+TOLERANCE = 1e-3
+
+# the published totals, csv/v1 at the top of the repository
+CSV_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', '..',
+                                        '..', 'csv', 'v1'))
+
+
+# products whose csv/v1 tables are under another name: the NVOC files are
+# the methanol series expressed as carbon (make_combined_NVOC_1950-2020.pro)
+CSV_PRODUCTS = {'NVOC': 'CH3OH_as_C'}
+
+
+def _names(name, species):
+    # whether the file name *name* names *species*, as a whole word
+    return re.search(r'(^|[_.-]){}([_.-]|$)'.format(re.escape(species)),
+                     name) is not None
+
+
+def _csv_name(source):
+    # the file name of *source*, with products known by another name in
+    # csv/v1 given that name
+    name = os.path.basename(source)
+    for product, csv_product in CSV_PRODUCTS.items():
+        if _names(name, product):
+            name = re.sub(r'(^|[_.-]){}([_.-]|$)'.format(re.escape(product)),
+                          r'\g<1>{}\g<2>'.format(csv_product), name)
+    return name
+
+
+def find_csv(source, directory=CSV_DIR):
+    """Return the csv/v1 zip file in *directory* of the species of the
+    source file *source*, named in its file name (e.g. CO in
+    combined_sources_CO_1960-2020_greg.nc), or None."""
+    name = _csv_name(source)
+    best = None
+    for path in glob.glob(os.path.join(directory, '*.zip')):
+        species = re.sub(r'_\d{8}$', '',
+                         os.path.splitext(os.path.basename(path))[0])
+        if _names(name, species) and \
+                (best is None or len(species) > len(best[0])):
+            best = (species, path)
+    return best[1] if best else None
+
+
+def _csv_members(path, source=None):
+    """Return the (monthly, annual) combined tables of the csv/v1 zip file
+    *path* for the product of the source file *source*, either None if the
+    zip file has no such table.
+
+    Some zip files hold the tables of several products of the species (e.g.
+    C2H6 and C2H6_lumped); the product is the longest one the source file
+    name names, otherwise that of the zip file's species.
+    """
+    with zipfile.ZipFile(path) as archive:
+        names = archive.namelist()
+    tables = {}
+    for name in names:
+        match = re.match(r'^(.+)_(monthly|annual)(_combined)?\.csv$', name)
+        if match:
+            tables.setdefault(match.group(1), {})[match.group(2)] = name
+    species = re.sub(r'_\d{8}$', '',
+                     os.path.splitext(os.path.basename(path))[0])
+    named = [product for product in tables
+             if source is not None and _names(_csv_name(source), product)]
+    product = max(named, key=len) if named else species
+    found = tables.get(product, {})
+    return found.get('monthly'), found.get('annual')
+
+
+def relative_drift(values, reference):
+    """Return {key: relative difference} of *values* from *reference* (dicts)
+    for their keys in common."""
+    drift = {}
+    for key in sorted(set(values) & set(reference)):
+        if reference[key]:
+            drift[key] = (values[key] - reference[key]) / reference[key]
+        else:
+            drift[key] = 0.0 if not values[key] else numpy.inf
+    return drift
+
+
+def _check(name, drift, tolerance):
+    worst = max(drift, key=lambda key: abs(drift[key])) if drift else None
+    return {'check': name, 'count': len(drift), 'worst': worst,
+            'drift': abs(drift[worst]) if drift else 0.0,
+            'failed': sorted(key for key in drift
+                             if not abs(drift[key]) <= tolerance)}
+
+
+def audit(output, source=None, csv_file=None, tolerance=TOLERANCE,
+          chunk_size=CHUNK_SIZE, variable=None):
+    """Return the mass checks of the ukca_emiss_*.nc file *output*, against
+    its *source* file and the csv/v1 zip file *csv_file* if given.
+
+    The result is a dict with a list of 'checks', each a dict with the
+    'check' name, the 'count' of months or years compared, the 'worst' of
+    them and its relative 'drift', and the months or years 'failed' (more
+    than *tolerance* out). 'ok' is False if any check failed or no months
+    matched.
+    """
+    out = global_totals(output, variable=variable, chunk_size=chunk_size)
+    result = {'output': output, 'source': source, 'csv': csv_file,
+              'totals': out, 'checks': []}
+    if source is not None:
+        src = global_totals(source, chunk_size=chunk_size)
+        out_keys, src_keys = out['dates'], src['dates']
+        if not set(out_keys) & set(src_keys) and \
+                len(out_keys) == len(src_keys):
+            # the scripts of periodic files give them new dates
+            out_keys = src_keys
+        result['checks'].append(_check(
+            'regrid', relative_drift(dict(zip(out_keys, out['rate'])),
+                                     dict(zip(src_keys, src['rate']))),
+            tolerance))
+    if csv_file is not None:
+        monthly, annual = _csv_members(csv_file, source)
+        if monthly:
+            result['checks'].append(_check(
+                'csv monthly',
+                relative_drift(dict(zip(out['dates'], out['kg'])),
+                               read_csv_totals(csv_file, monthly)),
+                tolerance))
+        if annual:
+            result['checks'].append(_check(
+                'csv annual',
+                relative_drift(annual_totals(out),
+                               read_csv_totals(csv_file, annual)),
+                tolerance))
+    result['ok'] = all(check['count'] and not check['failed']
+                       for check in result['checks'])
+    return result
+
+
+def _key_text(key):
+    if isinstance(key, tuple):
+        return '{:04d}-{:02d}'.format(*key)
+    return str(key)
+
+
+def format_audit(result):
+    """Return the checks of *result* (from audit) as text."""
+    lines = ['{}: {} ({} months, {:.4g} kg)'.format(
+        result['output'], 'ok' if result['ok'] else 'DRIFT',
+        len(result['totals']['dates']), result['totals']['kg'].sum())]
+    for check in result['checks']:
+        if not check['count']:
+            lines.append('  {:<12} no months in common'.format(check['check']))
+            continue
+        line = '  {:<12} {:4d} compared, worst {} {:+.2e}'.format(
+            check['check'], check['count'], _key_text(check['worst']),
+            check['drift'])
+        if check['failed']:
+            line += ', {} over tolerance'.format(len(check['failed']))
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Check that ukca_emiss_*.nc files have the global '
+                    'emission totals of their sources and of csv/v1.')
+    parser.add_argument('products', nargs='+',
+                        help='ukca_emiss_*.nc files, or regrid scripts to '
+                             'audit the output file of')
+    parser.add_argument('--source', default=None,
+                        help='source file of a single ukca_emiss_*.nc file')
+    parser.add_argument('--csv', default=None,
+                        help='csv/v1 zip file of the totals (default: found '
+                             'from the source file name)')
+    parser.add_argument('--no-csv', action='store_true',
+                        help="don't compare with csv/v1, e.g. for products "
+                             'made from other sources')
+    parser.add_argument('--csv-dir', default=CSV_DIR,
+                        help='directory of the csv/v1 zip files '
+                             '(default: %(default)s)')
+    parser.add_argument('--output-dir', default='.',
+                        help='directory of the output files of the scripts '
+                             '(default: the current directory)')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='largest relative difference that passes '
+                             '(default: %(default)s)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='time steps read at a time '
+                             '(default: %(default)s)')
+    args = parser.parse_args(argv)
+    if args.source and len(args.products) > 1:
+        parser.error('--source needs a single ukca_emiss_*.nc file')
+
+    failed = 0
+    for product in args.products:
+        source = args.source
+        output = product
+        if product.endswith('.py'):
+            settings = script_settings(product)
+            source = settings.get('emissions_file')
+            output = os.path.join(args.output_dir, settings['outpath'])
+        csv_file = args.csv
+        if args.no_csv:
+            csv_file = None
+        elif csv_file is None and source is not None:
+            csv_file = find_csv(source, args.csv_dir)
+        try:
+            result = audit(output, source=source, csv_file=csv_file,
+                           tolerance=args.tolerance,
+                           chunk_size=args.chunk_size)
+        except (IOError, OSError, ValueError) as error:
+            sys.stderr.write('{}: {}\n'.format(product, error))
+            failed += 1
+            continue
+        print(format_audit(result))
+        failed += not result['ok']
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,289 @@
+##############################################################################################
+#
+#  batch.py
+#
+#  Run several regrid scripts in one Python process, regridding all their
+#  source files together.
+#
+#  The sources are read time chunk by time chunk, stacked along a species
+#  axis and regridded with a single application of the (shared) weights.
+#  Each script is then run as normal, but its call to ukca_emiss.regrid
+#  returns its part of the (lazy) stacked regrid, so the script only has to
+#  add its metadata and set up its own ukca_emiss_*.nc file. The files of a
+#  group of scripts are then written together a time chunk at a time
+#  (pipeline.store_together), so each chunk is regridded once for all of
+#  them and memory use is set by the chunk and group sizes, not the length
+#  of the series. The grid file is read and the weights are set up once for
+#  the whole batch.
+#
+#  Usage (from emissions/python):
+#      python -m ukca_emiss.batch timeseries_1950-2020/regrid_*_n96e_360d.py
+#
+##############################################################################################
+
+import argparse
+import ast
+import runpy
+import sys
+import traceback
+
+import dask
+import dask.array
+import iris
+import numpy
+
+from . import output as _output
+from . import pipeline as _pipeline
+from . import timing as _timing
+from .grids import load_grid
+from .regrid import (CHUNK_SIZE, ENGINES, _result_dtype, apply_weights,
+                     build_operator, dense, prepare_source, regrid,
+                     regridded_ahead, regridded_cube, select_engine,
+                     target_shape, yx_last)
+from .weights import weights_key
+
+# number of scripts regridded and written together by default; each time
+# chunk of all their sources is held at once
+GROUP_SIZE = 8
+
+
+def _string_value(node, settings):
+    # the value of a string expression made of constants, settings and +,
+    # or None
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.Name) and isinstance(settings.get(node.id), str):
+        return settings[node.id]
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        left = _string_value(node.left, settings)
+        right = _string_value(node.right, settings)
+        if left is not None and right is not None:
+            return left + right
+    return None
+
+
+def script_settings(path):
+    """Return the settings of the regrid script *path*.
+
+    This is a dict of the strings assigned at the top level of the script
+    (grid_file, emissions_file, stash, species_name, outpath, ...), as
+    long as they are constants or sums of constants and earlier settings,
+    plus 'regrids', which is True if the script calls ukca_emiss.regrid.
+    """
+    with open(path) as source:
+        tree = ast.parse(source.read(), filename=path)
+    settings = {'regrids': False}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and \
+                isinstance(node.targets[0], ast.Name):
+            value = _string_value(node.value, settings)
+            if value is not None:
+                settings[node.targets[0].id] = value
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and \
+                isinstance(node.func, ast.Attribute) and \
+                node.func.attr == 'regrid' and \
+                isinstance(node.func.value, ast.Name) and \
+                node.func.value.id == 'ukca_emiss':
+            settings['regrids'] = True
+    return settings
+
+
+def _stacked_data(cube):
+    # the data of cube, still lazy if possible, as (n, y, x)
+    data = cube.core_data() if hasattr(cube, 'core_data') else cube.data
+    data = data.transpose(yx_last(cube))
+    return data.reshape((-1,) + tuple(data.shape[-2:]))
+
+
+def _concatenate(arrays):
+    # only masked if some of the arrays have missing points
+    if any(numpy.ma.isMaskedArray(array) for array in arrays):
+        return numpy.ma.concatenate(arrays)
+    return numpy.concatenate(arrays)
+
+
+def _stack_regrid(blocks, operator, tgt_shape, dtype):
+    # the blocks of several sources regridded with one application of the
+    # weights, one after the other along the first dimension
+    blocks = [dense(numpy.asanyarray(block)) for block in blocks]
+    return apply_weights(_concatenate(blocks), operator, tgt_shape, dtype)
+
+
+def regrid_stack(cubes, grid, engine=None, chunk_size=CHUNK_SIZE):
+    """Regrid several cubes on the same source grid onto *grid* in one pass.
+
+    For each chunk of *chunk_size* time steps, the data of all the cubes
+    are stacked and regridded with a single application of the weights.
+    Returns the list of regridded cubes, in the same order as *cubes*, with
+    lazy data: computed together (see pipeline.store_together), each chunk
+    is read and regridded once for all of them.
+    """
+    if not cubes:
+        return []
+    engine = select_engine(cubes[0], grid, engine)
+    key = weights_key(cubes[0], grid)
+    if engine == 'iris' or \
+            any(weights_key(cube, grid) != key for cube in cubes[1:]):
+        # nothing to share, regrid them one at a time
+        return [regrid(cube, grid, engine=engine) for cube in cubes]
+
+    operator = build_operator(cubes[0], grid, engine)
+    tgt_shape = target_shape(grid)
+    sources = [_stacked_data(cube) for cube in cubes]
+    dtype = _result_dtype(numpy.result_type(*sources))
+    meta = numpy.empty((0, 0, 0), dtype=dtype)
+    pieces = [[] for cube in cubes]
+
+    nsteps = max(source.shape[0] for source in sources)
+    for start in range(0, nsteps, chunk_size):
+        stop = start + chunk_size
+        blocks = [source[start:stop] for source in sources]
+        result = dask.delayed(_stack_regrid)(blocks, operator, tgt_shape,
+                                             dtype)
+        offset = 0
+        for piece, block in zip(pieces, blocks):
+            size = block.shape[0]
+            piece.append(dask.array.from_delayed(
+                result[offset:offset + size], (size,) + tgt_shape,
+                dtype=dtype, meta=meta))
+            offset += size
+
+    results = []
+    for cube, piece in zip(cubes, pieces):
+        order = yx_last(cube)
+        lead = tuple(cube.shape[dim] for dim in order[:-2])
+        data = dask.array.concatenate(piece).reshape(lead + tgt_shape)
+        data = data.transpose(tuple(numpy.argsort(order)))
+        results.append(regridded_cube(cube, grid, data))
+    return results
+
+
+def run_script(path, result=None):
+    """Run the script *path* as if from the command line.
+
+    If *result* is given, the script's call to ukca_emiss.regrid returns it
+    rather than regridding (see regrid.regridded_ahead).
+    """
+    try:
+        with regridded_ahead(result):
+            runpy.run_path(path, run_name='__main__')
+    except BaseException:
+        # no report for a script that failed, unless it is shared with the
+        # scripts whose files are written along with its own
+        if _output.deferred is None:
+            _timing.discard()
+        raise
+
+
+def _write_together(writes):
+    # write the deferred (data, target) writes, those chunked alike together
+    by_chunks = {}
+    for data, target in writes:
+        by_chunks.setdefault(data.chunks[:2], []).append((data, target))
+    for chunked_alike in by_chunks.values():
+        _pipeline.store_together(*zip(*chunked_alike))
+
+
+def run_scripts(paths, group_size=GROUP_SIZE, chunk_size=CHUNK_SIZE,
+                engine=None):
+    """Run the regrid scripts *paths* in this process.
+
+    Scripts that regrid are taken *group_size* at a time (all at once if it
+    is None or 0); the sources in a group that share a grid file are
+    regridded together with regrid_stack, the scripts are run and then
+    their files are written together. Returns a dict of the scripts that
+    failed and their tracebacks.
+    """
+    failures = {}
+    settings = {}
+    for path in paths:
+        try:
+            settings[path] = script_settings(path)
+        except SyntaxError:
+            failures[path] = traceback.format_exc()
+
+    regridding = [path for path in paths if path in settings and
+                  settings[path]['regrids'] and
+                  'grid_file' in settings[path] and
+                  'emissions_file' in settings[path]]
+    others = [path for path in paths if path in settings and
+              path not in regridding]
+
+    if not group_size:
+        group_size = max(len(regridding), 1)
+    for start in range(0, len(regridding), group_size):
+        group = regridding[start:start + group_size]
+        by_grid = {}
+        for path in group:
+            by_grid.setdefault(settings[path]['grid_file'], []).append(path)
+
+        for grid_file, grid_paths in by_grid.items():
+            grid = load_grid(grid_file)
+            cubes = []
+            for path in grid_paths:
+                ems = iris.load_cube(settings[path]['emissions_file'])
+                cubes.append(prepare_source(ems, grid))
+            results = regrid_stack(cubes, grid, engine=engine,
+                                   chunk_size=chunk_size)
+            del cubes
+            writers = []
+            _output.deferred = []
+            try:
+                for path, result in zip(grid_paths, results):
+                    count = len(_output.deferred)
+                    try:
+                        run_script(path, result)
+                    except Exception:
+                        failures[path] = traceback.format_exc()
+                    if len(_output.deferred) > count:
+                        writers.append(path)
+                writes = _output.deferred
+            finally:
+                _output.deferred = None
+            del results
+            # the files of the group are written a chunk at a time together,
+            # so each chunk is regridded once for all of them
+            try:
+                with _timing.stage('save'):
+                    _write_together(writes)
+            except Exception:
+                error = traceback.format_exc()
+                for path in writers:
+                    failures.setdefault(path, error)
+                _timing.discard()
+            else:
+                _timing.finish()
+
+    for path in others:
+        try:
+            run_script(path)
+        except Exception:
+            failures[path] = traceback.format_exc()
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run several regrid scripts in one process, regridding '
+                    'their sources together.')
+    parser.add_argument('scripts', nargs='+', help='regrid scripts to run')
+    parser.add_argument('--group-size', type=int, default=GROUP_SIZE,
+                        help='number of scripts regridded together, 0 for '
+                             'all (default: %(default)s)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='time steps per species in each stacked regrid '
+                             '(default: %(default)s)')
+    parser.add_argument('--engine', choices=ENGINES, default=None,
+                        help='regrid engine (default: chosen from the grids)')
+    args = parser.parse_args(argv)
+
+    failures = run_scripts(args.scripts, group_size=args.group_size,
+                           chunk_size=args.chunk_size, engine=args.engine)
+    for path in sorted(failures):
+        sys.stderr.write('FAILED: {}\n{}\n'.format(path, failures[path]))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
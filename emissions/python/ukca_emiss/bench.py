@@ -0,0 +1,366 @@
+##############################################################################################
+#
+#  bench.py
+#
+#  Benchmarks of the regrid scripts' path from the 0.5x0.5 source file to
+#  the N96e ukca_emiss_*.nc file, on synthetic data, so they run offline on
+#  any Linux machine.
+#
+#  The source files are made up to look like the real ones: a 720 x 360
+#  grid of monthly mean fluxes (kg m-2 s-1), zero over the sea and on
+#  most of the land, with a seasonal cycle and a trend. The N96e grid is
+#  generated (grids.py), as the scripts do.
+#
+#  Each case (regrid engine, number of months and mode) runs in a fresh
+#  process, which reports its peak resident memory. In 'eager' mode each
+#  step is done in full before the next, and timed on its own:
+#    load     -- iris.load_cube and reading the data
+#    prepare  -- the coordinate system and bounds, as in the scripts
+#    regrid   -- ukca_emiss.regrid(..., dtype='float32'), including the
+#                intersection onto 0 to 360 for the 'iris' engine (the
+#                others fold the longitude wrap into the weights)
+#    assemble -- the metadata, add_level_axis and the forecast coordinates
+#    write    -- ukca_emiss.save as NETCDF3_CLASSIC
+#  In 'lazy' mode the steps are as in the scripts, so the reading and
+#  regridding happen a chunk at a time during the write, and the peak
+#  memory is that of a real run.
+#
+#  The regrid weights are made once beforehand, in a cache in the work
+#  directory, and aren't part of the times.
+#
+#  Usage (from emissions/python):
+#      python -m ukca_emiss.bench --months 12 120 852 --engines separable sparse
+#  --json saves the results, and --baseline compares them with saved ones.
+#
+##############################################################################################
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import cf_units
+import iris
+import iris.coords
+import netCDF4
+import numpy
+
+from . import output as _output
+from .assemble import add_level_axis
+from .grids import load_grid
+from .regrid import (ENGINES, build_operator, prepare_source, regrid,
+                     select_engine)
+
+STAGES = ('load', 'prepare', 'regrid', 'assemble', 'write')
+
+MODES = ('eager', 'lazy')
+
+# cases run by default
+MONTHS = (12, 120, 852)
+
+# fraction of the source grid with non-zero emissions
+LAND_FRACTION = 0.25
+
+# a slower case than this (as a fraction of the baseline) is a regression
+TOLERANCE = 0.2
+
+
+def _smooth_noise(rng, shape, passes=8):
+    # random noise smoothed by repeated averaging with the neighbours, so
+    # the emitting areas come in patches like the land
+    field = rng.standard_normal(shape)
+    for dummy in range(passes):
+        field = (field + numpy.roll(field, 1, 0) + numpy.roll(field, -1, 0) +
+                 numpy.roll(field, 1, 1) + numpy.roll(field, -1, 1)) / 5.0
+    return field
+
+
+def synthetic_source(path, months, seed=0, land_fraction=LAND_FRACTION):
+    """Write a synthetic 0.5x0.5 monthly emissions file of *months* months
+    (from January 1950, in the 360_day calendar) to *path*."""
+    rng = numpy.random.default_rng(seed)
+    lons = -179.75 + 0.5 * numpy.arange(720)
+    lats = -89.75 + 0.5 * numpy.arange(360)
+    noise = _smooth_noise(rng, (360, 720))
+    land = noise > numpy.quantile(noise, 1.0 - land_fraction)
+    # mostly small fluxes with a few large sources
+    base = numpy.where(land, rng.lognormal(-25.0, 2.0, (360, 720)), 0.0)
+    # the seasonal cycle peaks at different months in each hemisphere
+    phase = numpy.where(lats[:, numpy.newaxis] >= 0, 0.0, numpy.pi)
+
+    dataset = netCDF4.Dataset(path, 'w', format='NETCDF3_64BIT_OFFSET')
+    try:
+        dataset.createDimension('time', months)
+        dataset.createDimension('lat', len(lats))
+        dataset.createDimension('lon', len(lons))
+        for name, values, standard_name, units in (
+                ('lat', lats, 'latitude', 'degrees_north'),
+                ('lon', lons, 'longitude', 'degrees_east')):
+            variable = dataset.createVariable(name, 'f8', (name,))
+            variable.standard_name = standard_name
+            variable.units = units
+            variable[:] = values
+        time_variable = dataset.createVariable('time', 'f8', ('time',))
+        time_variable.standard_name = 'time'
+        time_variable.units = 'days since 1950-01-01 00:00:00'
+        time_variable.calendar = '360_day'
+        time_variable[:] = 15.0 + 30.0 * numpy.arange(months)
+        flux = dataset.createVariable('emiss_flux', 'f4',
+                                      ('time', 'lat', 'lon'))
+        flux.units = 'kg m-2 s-1'
+        flux.long_name = 'synthetic surface emissions'
+        dataset.history = 'synthetic data from ukca_emiss.bench'
+        for month in range(months):
+            season = 1.0 + 0.3 * numpy.cos(2 * numpy.pi * (month % 12) / 12.0
+                                           + phase)
+            trend = 1.0 + 0.01 * (month // 12)
+            flux[month] = (base * season * trend).astype('float32')
+    finally:
+        dataset.close()
+
+
+def _assemble(cube):
+    # as the regrid scripts do after the regrid
+    cube.var_name = 'emissions_NO'
+    cube.long_name = 'NO surf emissions'
+    cube.units = cf_units.Unit('kg m-2 s-1')
+    cube.attributes['vertical_scaling'] = 'surface'
+    cube.attributes['um_stash_source'] = 'm01s00i301'
+    cube.attributes['tracer_name'] = 'NO'
+    cube.attributes['emission_type'] = '1'
+    cube.attributes['update_type'] = '1'
+    cube.attributes['update_freq_in_hours'] = '120'
+    cube.attributes['File_creation_date'] = time.ctime(time.time())
+    cube.coord(axis='t').var_name = 'time'
+    zdims = iris.coords.DimCoord(numpy.array([0]),
+                                 standard_name='model_level_number',
+                                 units='1', attributes={'positive': 'up'})
+    cube = add_level_axis(cube, zdims)
+    time_coord = cube.coord(axis='t')
+    frt = iris.coords.AuxCoord(time_coord.points.astype('float64'),
+                               standard_name='forecast_reference_time',
+                               units=time_coord.units)
+    cube.add_aux_coord(frt, data_dims=0)
+    cube.coord('forecast_reference_time').guess_bounds()
+    cube.add_aux_coord(iris.coords.AuxCoord(
+        numpy.array([-360], dtype='float64'), standard_name='forecast_period',
+        units=cf_units.Unit('hours'),
+        bounds=numpy.array([-720, 0], dtype='float64')), data_dims=None)
+    cube.cell_methods = [iris.coords.CellMethod('mean', 'time')]
+    return cube
+
+
+def _peak_rss():
+    # in MB; ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_case(source, grid_name, engine, mode, outpath):
+    """Run one case in this process, returning a dict of the time taken by
+    each of STAGES (in seconds) and the peak memory use ('peak_rss', MB)."""
+    times = {}
+    start = time.time()
+
+    def lap(stage):
+        now = time.time()
+        times[stage] = now - lap.last
+        lap.last = now
+    lap.last = start
+
+    grid = load_grid(grid_name)
+    cube = iris.load_cube(source)
+    if mode == 'eager':
+        # read it all now
+        cube.data
+    lap('load')
+    cube = prepare_source(cube, grid)
+    lap('prepare')
+    result = regrid(cube, grid, engine=engine, dtype='float32')
+    if mode == 'eager':
+        result.data
+    lap('regrid')
+    result = _assemble(result)
+    lap('assemble')
+    _output.save(result, outpath, netcdf_format='NETCDF3_CLASSIC',
+                 local_keys=['vertical_scaling', 'um_stash_source',
+                             'tracer_name'])
+    lap('write')
+    times['total'] = time.time() - start
+    times['peak_rss'] = _peak_rss()
+    return times
+
+
+def _run_job(args):
+    # in a fresh process, for its own peak memory
+    cache_dir = args[-1]
+    os.environ['UKCA_EMISS_CACHE_DIR'] = cache_dir
+    return run_case(*args[:-1])
+
+
+def _warm_cache(source, grid_name, engines):
+    # make the regrid weights for each engine, so they aren't timed
+    grid = load_grid(grid_name)
+    cube = prepare_source(iris.load_cube(source), grid)
+    for engine in engines:
+        if engine != 'iris':
+            build_operator(cube, grid, select_engine(cube, grid, engine))
+
+
+def run_benchmarks(months=MONTHS, engines=('separable',), modes=MODES,
+                   grid_name='N96e', work_dir=None, repeat=1):
+    """Run every combination of *months*, *engines* and *modes* *repeat*
+    times, returning a list of result dicts (see run_case) with the case
+    ('months', 'engine', 'mode', 'repeat') and 'months_per_s' added."""
+    cleanup = work_dir is None
+    if cleanup:
+        work_dir = tempfile.mkdtemp(prefix='ukca_emiss_bench')
+    elif not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    cache_dir = os.path.join(work_dir, 'cache')
+    os.environ['UKCA_EMISS_CACHE_DIR'] = cache_dir
+    context = multiprocessing.get_context('spawn')
+    results = []
+    try:
+        for count in months:
+            source = os.path.join(work_dir, 'source_{}.nc'.format(count))
+            if not os.path.exists(source):
+                synthetic_source(source, count)
+            _warm_cache(source, grid_name, engines)
+            for engine in engines:
+                for mode in modes:
+                    for number in range(repeat):
+                        outpath = os.path.join(work_dir, 'ukca_emiss_{}_{}_{}'
+                                               '.nc'.format(engine, mode,
+                                                            count))
+                        pool = context.Pool(processes=1)
+                        try:
+                            result = pool.apply(_run_job, ((
+                                source, grid_name, engine, mode, outpath,
+                                cache_dir),))
+                        finally:
+                            pool.close()
+                            pool.join()
+                        os.remove(outpath)
+                        result.update(months=count, engine=engine, mode=mode,
+                                      repeat=number,
+                                      months_per_s=count / result['total'])
+                        results.append(result)
+                        _progress(result)
+    finally:
+        if cleanup:
+            shutil.rmtree(work_dir)
+    return results
+
+
+def _progress(result):
+    sys.stderr.write('{engine} {mode} {months} months: {total:.1f}s\n'
+                     .format(**result))
+
+
+def _case(result):
+    return (result['engine'], result['mode'], result['months'])
+
+
+def best(results):
+    """Return the fastest of each case of *results*, keyed by (engine,
+    mode, months)."""
+    fastest = {}
+    for result in results:
+        case = _case(result)
+        if case not in fastest or result['total'] < fastest[case]['total']:
+            fastest[case] = result
+    return fastest
+
+
+def regressions(results, baseline, tolerance=TOLERANCE):
+    """Return (case, time, baseline time) for each case of *results* more
+    than *tolerance* slower than in *baseline*."""
+    slower = []
+    old = best(baseline)
+    for case, result in sorted(best(results).items()):
+        if case in old and \
+                result['total'] > old[case]['total'] * (1 + tolerance):
+            slower.append((case, result['total'], old[case]['total']))
+    return slower
+
+
+def format_table(results, baseline=None):
+    """Return the fastest of each case of *results* as a text table,
+    with the change in the total time from *baseline* if given."""
+    old = best(baseline) if baseline else {}
+    header = '{:10} {:6} {:>6}'.format('engine', 'mode', 'months')
+    header += ''.join(' {:>8}'.format(stage) for stage in STAGES)
+    header += ' {:>8} {:>9} {:>8}'.format('total', 'months/s', 'peak MB')
+    if old:
+        header += ' {:>8}'.format('change')
+    lines = [header]
+    for case, result in sorted(best(results).items()):
+        line = '{:10} {:6} {:6d}'.format(*case)
+        line += ''.join(' {:8.2f}'.format(result[stage]) for stage in STAGES)
+        line += ' {:8.2f} {:9.1f} {:8.0f}'.format(
+            result['total'], result['months_per_s'], result['peak_rss'])
+        if case in old:
+            line += ' {:+7.0f}%'.format(
+                100.0 * (result['total'] / old[case]['total'] - 1))
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time the regrid of synthetic 0.5x0.5 emissions onto '
+                    'N96e, stage by stage, with the peak memory use.')
+    parser.add_argument('--months', type=int, nargs='+', default=list(MONTHS),
+                        help='lengths of the time series (default: '
+                             '%(default)s)')
+    parser.add_argument('--engines', nargs='+', choices=ENGINES,
+                        default=['separable'],
+                        help='regrid engines (default: %(default)s)')
+    parser.add_argument('--modes', nargs='+', choices=MODES,
+                        default=list(MODES),
+                        help='eager (each stage timed) and/or lazy (as the '
+                             'scripts run) (default: %(default)s)')
+    parser.add_argument('--grid', default='N96e',
+                        help='target grid (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs of each case, the fastest is shown '
+                             '(default: %(default)s)')
+    parser.add_argument('--work-dir', default=None,
+                        help='directory for the synthetic files, kept for '
+                             'later runs (default: a temporary directory)')
+    parser.add_argument('--json', default=None,
+                        help='file to save the results to')
+    parser.add_argument('--baseline', default=None,
+                        help='results saved with --json to compare with; '
+                             'cases more than {:.0f}%% slower are reported '
+                             'and give a non-zero exit status'
+                             .format(100 * TOLERANCE))
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(months=args.months, engines=args.engines,
+                             modes=args.modes, grid_name=args.grid,
+                             work_dir=args.work_dir, repeat=args.repeat)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)
+    print(format_table(results, baseline))
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(results, outfile, indent=1, sort_keys=True)
+    if baseline:
+        slower = regressions(results, baseline)
+        for case, seconds, old in slower:
+            sys.stderr.write('{} {} {} months: {:.2f}s, was {:.2f}s\n'
+                             .format(case[0], case[1], case[2], seconds, old))
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
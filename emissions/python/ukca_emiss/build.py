@@ -0,0 +1,616 @@
+##############################################################################################
+#
+#  build.py
+#
+#  Rebuild only the emissions files that are out of date, across both the
+#  IDL preprocessing (emissions/idl) and the Python regrid scripts.
+#
+#  Each script is a node of a build graph. Its inputs and outputs are read
+#  from the script itself: the file names assigned to ifn*, *file* and
+#  *ofn* variables in the .pro files (as far as they are built from string
+#  constants) and emissions_file, grid_file and outpath in the regrid
+#  scripts. A node depends on the nodes which write its inputs. Files that
+#  were copied by hand from one place to another (e.g. into 0.5x0.5/) can be
+#  given with --copies, as a JSON file of {"copy": "original"}; each copy is
+#  a node of its own.
+#
+#  A node is rebuilt if the hash of its code (the script, and for the regrid
+#  scripts the ukca_emiss modules they import), its parameters or the contents of any of
+#  its inputs changed since it was last built, or if an output is missing or
+#  has changed. Contents are hashed with File_creation_date and history
+#  left out, so a file that is remade with the same data doesn't make
+#  everything downstream of it out of date. The hashes are kept in the
+#  state file in the build directory. Independent nodes run in parallel.
+#
+#  The regrid scripts are run in <build dir>/<product dir>/<script name>/,
+#  where they write their ukca_emiss_*.nc files.
+#
+#  Usage (from emissions/python):
+#      python -m ukca_emiss.build ../idl timeseries_1960-2020 --build-dir /path/to/output --jobs 4
+#
+##############################################################################################
+
+import argparse
+import ast
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+
+import netCDF4
+import numpy
+
+from .batch import script_settings
+from .grids import ENDGAME_GRIDS
+
+# attributes that change whenever a file is remade, left out of its hash
+VOLATILE_ATTRIBUTES = ('File_creation_date', 'file_creation_date', 'history')
+
+# name of the state file in the build directory
+STATE_FILE = '.ukca_emiss_build.json'
+
+# bytes of a variable hashed at a time
+_BLOCK_BYTES = 64 * 1024 * 1024
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# names of the IDL variables holding input and output file names
+_IDL_INPUT = re.compile(r'^ifn\d*$|file\d*$')
+_IDL_OUTPUT = re.compile(r'(^|_)ofn(ame)?\d*$')
+_IDL_ASSIGNMENT = re.compile(r'^(\s*)([A-Za-z_]\w*)\s*=\s*(.+)$')
+_IDL_NUMBER = re.compile(r'^[-+]?(\d+\.?\d*|\.\d+)([eEdD][-+]?\d+)?[bBsSlLdD]?$')
+
+
+class Node(object):
+    """A step of the build: a script and the files it reads and writes."""
+
+    def __init__(self, name, command, cwd, inputs, outputs, code, params,
+                 stdin=None):
+        self.name = name
+        self.command = command
+        self.cwd = cwd
+        self.inputs = inputs
+        self.outputs = outputs
+        self.code = code
+        self.params = params
+        self.stdin = stdin
+
+
+# hashing
+
+def _hash_attributes(hasher, owner):
+    for key in sorted(owner.ncattrs()):
+        if key not in VOLATILE_ATTRIBUTES:
+            hasher.update(repr((key, owner.getncattr(key))).encode())
+
+
+def netcdf_hash(path):
+    """Return a hash of the contents of the netCDF file *path*.
+
+    This covers the dimensions, variables, data and attributes, apart from
+    the VOLATILE_ATTRIBUTES. The data are read a block at a time.
+    """
+    hasher = hashlib.sha1()
+    dataset = netCDF4.Dataset(path)
+    try:
+        dataset.set_auto_maskandscale(False)
+        for name in sorted(dataset.dimensions):
+            hasher.update(repr((name, len(dataset.dimensions[name]))).encode())
+        _hash_attributes(hasher, dataset)
+        for name in sorted(dataset.variables):
+            variable = dataset.variables[name]
+            hasher.update(repr((name, variable.dtype.str,
+                                variable.dimensions)).encode())
+            _hash_attributes(hasher, variable)
+            if variable.ndim == 0 or variable.shape[0] == 0:
+                hasher.update(numpy.ascontiguousarray(variable[...]).tobytes())
+                continue
+            step = max(1, _BLOCK_BYTES // max(1, variable[0:1].nbytes))
+            for start in range(0, variable.shape[0], step):
+                block = variable[start:start + step]
+                hasher.update(numpy.ascontiguousarray(block).tobytes())
+    finally:
+        dataset.close()
+    return hasher.hexdigest()
+
+
+def file_hash(path):
+    """Return a hash of the contents of the file *path* (see netcdf_hash)."""
+    if path.endswith('.nc'):
+        try:
+            return netcdf_hash(path)
+        except (OSError, RuntimeError):
+            # not a netCDF file after all
+            pass
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as data:
+        for block in iter(lambda: data.read(_BLOCK_BYTES), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _code_hash(paths):
+    hasher = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as source:
+            hasher.update(source.read())
+    return hasher.hexdigest()
+
+
+# the build graph
+
+def _idl_lines(path):
+    # the statements of an IDL file: comments removed, continuations joined
+    lines = []
+    pending = ''
+    with open(path, errors='replace') as source:
+        for line in source:
+            text = []
+            quote = None
+            for char in line.rstrip('\n'):
+                if quote:
+                    if char == quote:
+                        quote = None
+                elif char in '\'"':
+                    quote = char
+                elif char == ';':
+                    break
+                text.append(char)
+            text = ''.join(text).rstrip()
+            if text.endswith('$'):
+                pending += text[:-1] + ' '
+                continue
+            lines.append(pending + text)
+            pending = ''
+    if pending:
+        lines.append(pending)
+    return lines
+
+
+def _idl_string(expression, names):
+    # the value of an IDL expression of quoted strings, names and +, or None
+    tokens = re.findall(r"'[^']*'|\"[^\"]*\"|[A-Za-z_]\w*|\S", expression)
+    if len(tokens) % 2 == 0 or any(token != '+' for token in tokens[1::2]):
+        return None
+    value = ''
+    for term in tokens[::2]:
+        if term[0] in '\'"':
+            value += term[1:-1]
+        elif isinstance(names.get(term), str):
+            value += names[term]
+        else:
+            return None
+    return value
+
+
+def _node_name(path, root):
+    # scripts in the repository are named relative to it
+    if os.path.commonpath([path, root]) == root:
+        return os.path.relpath(path, root)
+    return path
+
+
+def _is_file_name(value):
+    return isinstance(value, str) and os.path.splitext(value)[1] != ''
+
+
+def _resolve(path, cwd):
+    return os.path.normpath(os.path.join(cwd, path))
+
+
+def idl_node(path, root, idl='idl'):
+    """Return the Node for the IDL file *path*, or None if none of its
+    outputs is known. *root* is the directory node names are relative to.
+    """
+    path = os.path.abspath(path)
+    cwd = os.path.dirname(path)
+    names = {}
+    params = {}
+    for line in _idl_lines(path):
+        match = _IDL_ASSIGNMENT.match(line)
+        if not match:
+            continue
+        indent, name, expression = match.groups()
+        expression = expression.strip()
+        value = _idl_string(expression, names)
+        if value is None and _IDL_NUMBER.match(expression):
+            value = expression
+            if not indent:
+                params[name] = value
+        if name in names and names[name] != value:
+            # set more than once (e.g. in a loop), so no single value
+            value = None
+        names[name] = value
+    outputs = sorted(set(_resolve(value, cwd) for name, value in names.items()
+                         if _IDL_OUTPUT.search(name) and _is_file_name(value)))
+    if not outputs:
+        return None
+    inputs = sorted(set(_resolve(value, cwd) for name, value in names.items()
+                        if _IDL_INPUT.search(name) and _is_file_name(value))
+                    - set(outputs))
+    return Node(_node_name(path, root), [idl], cwd, inputs, outputs,
+                _code_hash([path]), params,
+                stdin='.run {}\nexit\n'.format(os.path.basename(path)))
+
+
+def _package_files(module='__init__'):
+    """Return the files of the ukca_emiss modules that *module* imports,
+    directly or through other modules of the package, and its own file.
+
+    For a regrid script, which imports ukca_emiss, these are the modules of
+    the regrid path; tools such as this one or pool.py are left out.
+    """
+    files = set()
+    pending = [module]
+    while pending:
+        path = os.path.join(_PACKAGE_DIR, pending.pop() + '.py')
+        if path in files or not os.path.isfile(path):
+            continue
+        files.add(path)
+        with open(path) as infile:
+            tree = ast.parse(infile.read(), path)
+        for statement in ast.walk(tree):
+            if isinstance(statement, ast.ImportFrom) and statement.level == 1:
+                if statement.module:
+                    pending.append(statement.module.split('.')[0])
+                else:
+                    pending.extend(alias.name for alias in statement.names)
+    return sorted(files)
+
+
+def python_node(path, root, build_dir):
+    """Return the Node for the regrid script *path*, or None if its output
+    file is not known. It runs in a directory of its own under *build_dir*.
+    """
+    path = os.path.abspath(path)
+    settings = script_settings(path)
+    if 'outpath' not in settings:
+        return None
+    product = os.path.basename(os.path.dirname(path))
+    stem = os.path.splitext(os.path.basename(path))[0]
+    cwd = os.path.join(os.path.abspath(build_dir), product, stem)
+    inputs = []
+    if 'emissions_file' in settings:
+        inputs.append(_resolve(settings['emissions_file'], cwd))
+    if settings.get('grid_file') and settings['grid_file'] not in ENDGAME_GRIDS:
+        inputs.append(_resolve(settings['grid_file'], cwd))
+    params = dict((key, value) for key, value in settings.items()
+                  if key != 'regrids')
+    return Node(_node_name(path, root), [sys.executable, path], cwd,
+                sorted(set(inputs)), [_resolve(settings['outpath'], cwd)],
+                _code_hash([path] + _package_files()), params)
+
+
+def copy_node(copy, original):
+    """Return the Node that copies the file *original* to *copy*."""
+    copy = os.path.abspath(copy)
+    original = os.path.abspath(original)
+    return Node('copy:' + copy, None, os.path.dirname(copy), [original],
+                [copy], 'copy', {})
+
+
+def find_nodes(paths, build_dir, copies=None, idl='idl'):
+    """Return (nodes, skipped) for the scripts in *paths*.
+
+    *paths* are .pro and .py files and directories containing them (IDL
+    directories are searched recursively). *copies* is a dict of {copy:
+    original} file names. skipped is a dict of the scripts that are not
+    nodes and why.
+    """
+    root = os.path.dirname(os.path.dirname(_PACKAGE_DIR))
+    scripts = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, subdirs, files in os.walk(path):
+                subdirs[:] = sorted(subdir for subdir in subdirs
+                                    if subdir != 'ukca_emiss' and
+                                    not subdir.startswith('.'))
+                scripts.extend(os.path.join(directory, name)
+                               for name in sorted(files)
+                               if name.endswith(('.pro', '.py')))
+        else:
+            scripts.append(path)
+
+    nodes = []
+    skipped = {}
+    for path in scripts:
+        try:
+            if path.endswith('.pro'):
+                node = idl_node(path, root, idl=idl)
+            else:
+                node = python_node(path, root, build_dir)
+        except SyntaxError as error:
+            skipped[path] = 'cannot be parsed: {}'.format(error)
+            continue
+        if node is None:
+            skipped[path] = 'its output files are not known'
+        else:
+            nodes.append(node)
+    for copy, original in sorted((copies or {}).items()):
+        nodes.append(copy_node(copy, original))
+
+    producers = {}
+    for node in nodes:
+        for output in node.outputs:
+            if output in producers:
+                raise ValueError('{} is written by both {} and {}.'.format(
+                    output, producers[output].name, node.name))
+            producers[output] = node
+    return nodes, skipped
+
+
+def upstream(nodes):
+    """Return a dict of the names of the nodes each node depends on."""
+    producers = dict((output, node.name) for node in nodes
+                     for output in node.outputs)
+    return dict((node.name, sorted(set(producers[path] for path in node.inputs
+                                       if path in producers)))
+                for node in nodes)
+
+
+def select(nodes, targets):
+    """Return the *nodes* named by (or writing) *targets*, and everything
+    they depend on."""
+    if not targets:
+        return nodes
+    by_name = dict((node.name, node) for node in nodes)
+    depends = upstream(nodes)
+    wanted = set()
+    todo = []
+    for target in targets:
+        matches = [node.name for node in nodes if target in node.name or
+                   os.path.abspath(target) in node.outputs]
+        if not matches:
+            raise ValueError('No build step matches {}.'.format(target))
+        todo.extend(matches)
+    while todo:
+        name = todo.pop()
+        if name not in wanted:
+            wanted.add(name)
+            todo.extend(depends[name])
+    return [by_name[name] for name in sorted(wanted)]
+
+
+# state and staleness
+
+def _load_state(build_dir):
+    path = os.path.join(build_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {'nodes': {}, 'files': {}}
+    with open(path) as state:
+        return json.load(state)
+
+
+def _save_state(build_dir, state):
+    # write and rename, so an interrupted build doesn't lose the state
+    path = os.path.join(build_dir, STATE_FILE)
+    with open(path + '.tmp', 'w') as temporary:
+        json.dump(state, temporary, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+class _Hashes(object):
+    # content hashes of files, recalculated only when their size or
+    # modification time changes
+
+    def __init__(self, files):
+        self.files = files
+        self.lock = threading.Lock()
+
+    def __call__(self, path):
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        with self.lock:
+            known = self.files.get(path)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+        value = file_hash(path)
+        with self.lock:
+            self.files[path] = [stat.st_size, stat.st_mtime_ns, value]
+        return value
+
+
+def signature(node, hashes):
+    """Return what a node's outputs are made from: its code, parameters
+    and the hashes of its inputs (None for a missing input)."""
+    return {'code': node.code, 'params': node.params,
+            'inputs': dict((path, hashes(path)) for path in node.inputs)}
+
+
+def why_stale(node, record, current, hashes):
+    """Return why *node* needs rebuilding, or None if it is up to date.
+
+    *record* is what was recorded when it was last built (or None), and
+    *current* its signature now.
+    """
+    if record is None:
+        return 'not built yet'
+    for output in node.outputs:
+        if not os.path.exists(output):
+            return 'missing {}'.format(output)
+    previous = record['signature']
+    if previous['code'] != current['code']:
+        return 'code changed'
+    if previous['params'] != current['params']:
+        return 'parameters changed'
+    for path, value in sorted(current['inputs'].items()):
+        if previous['inputs'].get(path) != value:
+            return 'input changed: {}'.format(path)
+    for output in node.outputs:
+        if record['outputs'].get(output) != hashes(output):
+            return 'output changed: {}'.format(output)
+    return None
+
+
+def _run(node):
+    if node.command is None:
+        shutil.copyfile(node.inputs[0], node.outputs[0])
+        return
+    if not os.path.isdir(node.cwd):
+        os.makedirs(node.cwd)
+    for output in node.outputs:
+        directory = os.path.dirname(output)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    process = subprocess.run(node.command, cwd=node.cwd, input=node.stdin,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             universal_newlines=True)
+    if process.returncode != 0:
+        raise RuntimeError('{} exited with status {}:\n{}'.format(
+            ' '.join(node.command), process.returncode, process.stdout))
+    missing = [output for output in node.outputs if not os.path.exists(output)]
+    if missing:
+        raise RuntimeError('{} did not write {}.'.format(
+            node.name, ', '.join(missing)))
+
+
+def build(nodes, build_dir, jobs=1, dry_run=False, log=print):
+    """Bring the outputs of *nodes* up to date, running up to *jobs* of
+    them at once.
+
+    Returns a dict of the nodes that failed (or could not be run because a
+    node they depend on failed) and why. With *dry_run*, nothing is run
+    and the nodes that would be are logged.
+    """
+    build_dir = os.path.abspath(build_dir)
+    if not os.path.isdir(build_dir):
+        os.makedirs(build_dir)
+    state = _load_state(build_dir)
+    hashes = _Hashes(state['files'])
+    state_lock = threading.Lock()
+    by_name = dict((node.name, node) for node in nodes)
+    depends = upstream(nodes)
+    produced = set(output for node in nodes for output in node.outputs)
+    failures = {}
+    # names of the nodes a dry run would rebuild
+    rebuilt = set()
+
+    def step(node):
+        # runs in a worker thread
+        record = state['nodes'].get(node.name)
+        if dry_run and any(name in rebuilt for name in depends[node.name]):
+            return 'after {}'.format(', '.join(
+                name for name in depends[node.name] if name in rebuilt))
+        for path in node.inputs:
+            if path not in produced and not os.path.exists(path):
+                raise RuntimeError('missing input {}'.format(path))
+        current = signature(node, hashes)
+        reason = why_stale(node, record, current, hashes)
+        if reason is None or dry_run:
+            return reason
+        _run(node)
+        record = {'signature': current,
+                  'outputs': dict((output, hashes(output))
+                                  for output in node.outputs)}
+        with state_lock:
+            state['nodes'][node.name] = record
+            _save_state(build_dir, state)
+        return reason
+
+    remaining = dict((name, set(depends[name])) for name in by_name)
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        while remaining or running:
+            for name in sorted(remaining):
+                if remaining[name]:
+                    continue
+                del remaining[name]
+                running[executor.submit(step, by_name[name])] = name
+            if not running:
+                break
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    reason = future.result()
+                except Exception as error:
+                    failures[name] = str(error)
+                    log('FAILED {}: {}'.format(name, error))
+                    # skip everything downstream of it
+                    todo = [name]
+                    while todo:
+                        failed = todo.pop()
+                        for other in list(remaining):
+                            if failed in depends[other]:
+                                del remaining[other]
+                                failures[other] = 'depends on {}'.format(failed)
+                                log('SKIPPED {}: depends on {}'.format(
+                                    other, failed))
+                                todo.append(other)
+                    continue
+                if reason is None:
+                    log('up to date: {}'.format(name))
+                else:
+                    rebuilt.add(name)
+                    log('{} {} ({})'.format(
+                        'would build' if dry_run else 'built', name, reason))
+                for other in remaining.values():
+                    other.discard(name)
+    with state_lock:
+        _save_state(build_dir, state)
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Rebuild the out of date emissions files made by the IDL '
+                    'and Python scripts.')
+    parser.add_argument('paths', nargs='+',
+                        help='.pro and .py scripts and directories of them')
+    parser.add_argument('--build-dir', default='.',
+                        help='directory for the regridded files and the build '
+                             'state (default: the current directory)')
+    parser.add_argument('--target', action='append', default=[],
+                        help='only build the steps whose names contain this, '
+                             'or which write this file, and what they depend '
+                             'on (can be given more than once)')
+    parser.add_argument('--copies', default=None,
+                        help='JSON file of {"copy": "original"} file names')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='steps run at once (default: %(default)s)')
+    parser.add_argument('--idl', default='idl',
+                        help='IDL command (default: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only list the steps that would be run')
+    parser.add_argument('--list', action='store_true',
+                        help='list the build steps with their inputs and '
+                             'outputs, and the scripts that are not steps')
+    args = parser.parse_args(argv)
+
+    copies = None
+    if args.copies:
+        with open(args.copies) as copies_file:
+            copies = json.load(copies_file)
+    try:
+        nodes, skipped = find_nodes(args.paths, args.build_dir, copies=copies,
+                                    idl=args.idl)
+        nodes = select(nodes, args.target)
+    except ValueError as error:
+        sys.stderr.write('{}\n'.format(error))
+        return 1
+
+    if args.list:
+        for node in nodes:
+            print(node.name)
+            for path in node.inputs:
+                print('    < {}'.format(path))
+            for path in node.outputs:
+                print('    > {}'.format(path))
+        for path in sorted(skipped):
+            print('not built: {} ({})'.format(path, skipped[path]))
+        return 0
+
+    failures = build(nodes, args.build_dir, jobs=args.jobs,
+                     dry_run=args.dry_run)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
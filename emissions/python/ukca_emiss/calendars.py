@@ -0,0 +1,222 @@
+##############################################################################################
+#
+#  calendars.py
+#
+#  Make the Gregorian and 360_day versions of an emissions time series from
+#  a single regrid.
+#
+#  The paired scripts (regrid_*_greg.py and regrid_*_360d.py) differ only in
+#  their time coordinates and, if the 360_day script reads a file made by
+#  combine_all_sources_*.pro with gregorian=0, in the fluxes: there each
+#  month of the Gregorian flux is multiplied by month_length/30. That factor
+#  is the same everywhere in a month, so it can equally be applied after
+#  regridding. Each pair is run with one regrid of the Gregorian source: the
+#  360_day script gets the same regridded fluxes if it reads the same file
+#  (as all the timeseries_1960-2020 and CMIP6_hybrid scripts do), or the
+#  regridded fluxes times month_length/30 otherwise. Both files are written
+#  together, so the Gregorian source is read once and the 360_day source
+#  not at all, and memory use is set by the chunk size (see
+#  pipeline.store_together). Scripts without a partner are run as normal.
+#
+#  The two scripts of a pair write files with the same name, so the files
+#  are written to greg/ and 360d/ directories.
+#
+#  Usage (from emissions/python):
+#      python -m ukca_emiss.calendars timeseries_1960-2020 --output-dir /path/to/output
+#
+##############################################################################################
+
+import argparse
+import os
+import sys
+import traceback
+
+import iris
+import numpy
+
+from . import output as _output
+from . import pipeline as _pipeline
+from . import timing as _timing
+from .batch import run_script, script_settings
+from .grids import load_grid
+from .pool import find_scripts
+from .regrid import CHUNK_SIZE, prepare_source, regrid, regridded_cube
+
+# days in each month of a non-leap year
+MONTH_DAYS = numpy.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+_GREGORIAN = ('gregorian', 'standard', 'proleptic_gregorian')
+
+
+def month_lengths(years, months):
+    """Return the number of days in each Gregorian (*years*, *months*)."""
+    years = numpy.asarray(years)
+    months = numpy.asarray(months)
+    leap = ((years % 4 == 0) & (years % 100 != 0)) | (years % 400 == 0)
+    return MONTH_DAYS[months - 1] + (leap & (months == 2))
+
+
+def calendar_factors(time_coord):
+    """Return the month_length/30 factor for each point of *time_coord*.
+
+    These scale monthly mean Gregorian fluxes to 360_day ones with the same
+    monthly totals, as in combine_all_sources_*.pro.
+    """
+    if time_coord.units.calendar not in _GREGORIAN:
+        raise ValueError('Expected a Gregorian time coordinate, got the {} '
+                         'calendar.'.format(time_coord.units.calendar))
+    dates = time_coord.units.num2date(time_coord.points)
+    years = [date.year for date in dates]
+    months = [date.month for date in dates]
+    return month_lengths(years, months) / 30.0
+
+
+def scale_to_360_day(cube):
+    """Return the (lazy) data of the Gregorian *cube* scaled to 360_day."""
+    time_coord = cube.coord(axis='t', dim_coords=True)
+    dim, = cube.coord_dims(time_coord)
+    shape = [1] * cube.ndim
+    shape[dim] = -1
+    factors = calendar_factors(time_coord).reshape(shape)
+    data = cube.lazy_data()
+    return (data * factors).astype(data.dtype)
+
+
+def find_pairs(paths):
+    """Split *paths* into (pairs, others).
+
+    pairs is a list of (greg script, 360d script) with the same name apart
+    from the _greg/_360d ending, others the rest of *paths*.
+    """
+    by_name = dict((os.path.abspath(path), path) for path in paths)
+    pairs = []
+    paired = set()
+    for path in paths:
+        if not path.endswith('_greg.py'):
+            continue
+        partner = os.path.abspath(path[:-len('_greg.py')] + '_360d.py')
+        if partner in by_name:
+            pairs.append((path, by_name[partner]))
+            paired.update((path, by_name[partner]))
+    others = [path for path in paths if path not in paired]
+    return pairs, others
+
+
+def _run_in(directory, path, result=None):
+    # run the script path in directory
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        run_script(path, result)
+    finally:
+        os.chdir(cwd)
+
+
+def run_pair(greg_path, path_360d, output_dir='.', chunk_size=CHUNK_SIZE):
+    """Run a Gregorian script and its 360_day partner from one regrid.
+
+    Their files are written to the greg and 360d directories in
+    *output_dir*.
+    """
+    greg_path = os.path.abspath(greg_path)
+    path_360d = os.path.abspath(path_360d)
+    greg = script_settings(greg_path)
+    settings = script_settings(path_360d)
+    for path, values in ((greg_path, greg), (path_360d, settings)):
+        if not values['regrids'] or 'grid_file' not in values or \
+                'emissions_file' not in values:
+            raise ValueError('{} does not regrid its emissions.'.format(path))
+    if greg['grid_file'] != settings['grid_file']:
+        raise ValueError('{} and {} regrid onto different grids.'
+                         .format(greg_path, path_360d))
+
+    grid = load_grid(greg['grid_file'])
+    src = prepare_source(iris.load_cube(greg['emissions_file']), grid)
+    result = regrid(src, grid, chunk_size=chunk_size)
+    if settings['emissions_file'] == greg['emissions_file']:
+        # each script changes its cube, so give them a copy each
+        result_360d = result.copy(data=result.core_data())
+    else:
+        # only the metadata of the 360_day file are read
+        src_360d = prepare_source(iris.load_cube(settings['emissions_file']),
+                                  grid)
+        if src_360d.shape != src.shape:
+            raise ValueError('{} and {} have different shapes.'.format(
+                greg['emissions_file'], settings['emissions_file']))
+        result_360d = regridded_cube(src_360d, grid,
+                                     scale_to_360_day(result))
+
+    _output.deferred = []
+    try:
+        _run_in(os.path.join(output_dir, 'greg'), greg_path, result)
+        _run_in(os.path.join(output_dir, '360d'), path_360d, result_360d)
+        writes = _output.deferred
+        _output.deferred = None
+        # both files are written a chunk at a time together, so each chunk
+        # of the source is only read once
+        with _timing.stage('save'):
+            if writes:
+                _pipeline.store_together(*zip(*writes))
+    except BaseException:
+        # no report for a run that failed
+        _timing.discard()
+        raise
+    finally:
+        _output.deferred = None
+    _timing.finish()
+
+
+def run_calendars(paths, output_dir='.', chunk_size=CHUNK_SIZE):
+    """Run the regrid scripts *paths*, sharing a regrid between each pair.
+
+    Each file is written to the greg or 360d directory in *output_dir*,
+    depending on the name of its script; files of other scripts are
+    written to *output_dir* itself. Returns a dict of the scripts that
+    failed and their tracebacks.
+    """
+    failures = {}
+    pairs, others = find_pairs(paths)
+    for greg_path, path_360d in pairs:
+        try:
+            run_pair(greg_path, path_360d, output_dir=output_dir,
+                     chunk_size=chunk_size)
+        except Exception:
+            failures[greg_path] = failures[path_360d] = traceback.format_exc()
+    for path in others:
+        directory = output_dir
+        for calendar in ('greg', '360d'):
+            if path.endswith('_{}.py'.format(calendar)):
+                directory = os.path.join(output_dir, calendar)
+        try:
+            _run_in(directory, os.path.abspath(path))
+        except Exception:
+            failures[path] = traceback.format_exc()
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run pairs of Gregorian and 360_day regrid scripts from '
+                    'one regrid each.')
+    parser.add_argument('paths', nargs='+',
+                        help='product directories and/or regrid scripts')
+    parser.add_argument('--output-dir', default='.',
+                        help='directory in which to make the greg and 360d '
+                             'directories (default: the current directory)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='time steps read and regridded at a time '
+                             '(default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    failures = run_calendars(find_scripts(args.paths),
+                             output_dir=args.output_dir,
+                             chunk_size=args.chunk_size)
+    for path in sorted(failures):
+        sys.stderr.write('FAILED: {}\n{}\n'.format(path, failures[path]))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,307 @@
+##############################################################################################
+#
+#  cyclic.py
+#
+#  Perpetual (cyclic) time series that don't take the memory or disk space
+#  of the repeated data.
+#
+#  Several of the series are padded with repeats of a 12-month cycle: the
+#  1950-1959 months of the 1950-2020 files are the 1960 cycle ten times over
+#  (make_combined_*_1950-2020.pro), the soil NOx cycle is added to every
+#  year (combine_all_sources_NOx_1960-2020.pro) and the CEDS files repeat
+#  2014 up to 2020. A CyclicArray holds only the cycle, and returns any
+#  slice of the repeated series from it. As lazy (dask) data, a repeated
+#  series of any length is then only made a chunk at a time, as it is
+#  regridded, summed or written out (see output.save).
+#
+#  The regrid is linear and works month by month, so a padded series can be
+#  made after regridding just as well as before, and a cyclic cube can be
+#  made from the regridded cycle, which regrids each month of the cycle
+#  only once.
+#
+#  Run as a script, it makes the combined 1950-2020 source files from the
+#  1960-2020 ones in place of make_combined_*_1950-2020.pro, reading and
+#  writing a chunk of months at a time rather than holding both series in
+#  memory. As the IDL did, the times are mid-months of a 360_day calendar
+#  from the first year (give --calendar to keep another).
+#
+#  Usage (from emissions/python):
+#      python -m ukca_emiss.cyclic \
+#          combined_sources_NOx_1960-2020_greg.nc \
+#          combined_sources_NOx_1950-2020.nc --before 10
+#
+##############################################################################################
+
+import argparse
+import sys
+import time
+
+import cf_units
+import cftime
+import dask.array
+import dask.base
+import iris
+import iris.coords
+import iris.cube
+import numpy
+
+from .pipeline import read_ahead
+from .regrid import CHUNK_SIZE, dense
+from .writer import write
+
+# months in a cycle
+PERIOD = 12
+
+
+class CyclicArray(object):
+    """A read-only array of *length* steps along *axis*, going round the
+    steps of *cycle* starting from step *phase*.
+
+    Only *cycle* is stored; indexing returns a new numpy array.
+    """
+
+    def __init__(self, cycle, length, axis=0, phase=0):
+        self.cycle = numpy.asanyarray(cycle)
+        self.axis = axis % self.cycle.ndim
+        self.length = length
+        self.phase = phase % self.cycle.shape[self.axis]
+        shape = list(self.cycle.shape)
+        shape[self.axis] = length
+        self.shape = tuple(shape)
+        self.dtype = self.cycle.dtype
+        self.ndim = self.cycle.ndim
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return '<CyclicArray shape={} cycle={}>'.format(
+            self.shape, self.cycle.shape[self.axis])
+
+    def __dask_tokenize__(self):
+        return (type(self).__name__, dask.base.tokenize(self.cycle),
+                self.length, self.axis, self.phase)
+
+    def __getitem__(self, keys):
+        if not isinstance(keys, tuple):
+            keys = (keys,)
+        if any(key is Ellipsis for key in keys):
+            at = keys.index(Ellipsis)
+            keys = keys[:at] + (slice(None),) * (self.ndim - len(keys) + 1) + \
+                keys[at + 1:]
+        keys = keys + (slice(None),) * (self.ndim - len(keys))
+        steps = numpy.arange(self.length)[keys[self.axis]]
+        period = self.cycle.shape[self.axis]
+        result = self.cycle.take((steps + self.phase) % period, axis=self.axis)
+        # the axis has been dealt with; an integer index took it away
+        rest = list(keys)
+        if numpy.ndim(steps) == 0:
+            del rest[self.axis]
+        else:
+            rest[self.axis] = slice(None)
+        return result[tuple(rest)]
+
+    def __array__(self, dtype=None, copy=None):
+        result = self[...]
+        return result if dtype is None else result.astype(dtype)
+
+
+def cyclic_lazy(cycle, length, axis=0, phase=0, chunk_size=CHUNK_SIZE):
+    """Return a dask array of *length* steps along *axis* repeating *cycle*
+    (see CyclicArray), in chunks of *chunk_size* steps."""
+    # masked only if the cycle has missing points
+    array = CyclicArray(dense(cycle), length, axis=axis, phase=phase)
+    chunks = list(array.shape)
+    chunks[array.axis] = chunk_size
+    meta = numpy.ma.masked_array(numpy.empty((0,) * array.ndim,
+                                             dtype=array.dtype)) \
+        if isinstance(array.cycle, numpy.ma.MaskedArray) else None
+    return dask.array.from_array(array, chunks=tuple(chunks), asarray=False,
+                                 meta=meta)
+
+
+def _month_number(time_coord, point):
+    # months since year 0 of a point of time_coord
+    date = time_coord.units.num2date(point)
+    return date.year * 12 + date.month - 1
+
+
+def monthly_time_coord(template, first_month, count):
+    """Return a copy of the time coordinate *template* for *count* months
+    from *first_month* (months since year 0), with mid-month points and,
+    if *template* has bounds, the start and end of each month."""
+    units = template.units
+    starts = [cftime.datetime(month // 12, month % 12 + 1, 1,
+                              calendar=units.calendar)
+              for month in range(first_month, first_month + count + 1)]
+    edges = numpy.asarray(units.date2num(starts), dtype='float64')
+    bounds = numpy.stack([edges[:-1], edges[1:]], axis=-1)
+    points = bounds.mean(axis=-1).astype(template.dtype)
+    return template.copy(points=points,
+                         bounds=bounds.astype(template.dtype)
+                         if template.has_bounds() else None)
+
+
+def _time_dim(cube):
+    time_coord = cube.coord(axis='t', dim_coords=True)
+    dim, = cube.coord_dims(time_coord)
+    return time_coord, dim
+
+
+def _with_time(cube, data, time_coord, dim):
+    # a copy of cube with new data and time coordinate; other coordinates
+    # along time are dropped
+    result = iris.cube.Cube(data)
+    result.metadata = cube.metadata
+    for coord in cube.dim_coords:
+        coord_dim, = cube.coord_dims(coord)
+        if coord_dim != dim:
+            result.add_dim_coord(coord.copy(), coord_dim)
+    result.add_dim_coord(time_coord, dim)
+    for coord in cube.aux_coords:
+        dims = cube.coord_dims(coord)
+        if dim not in dims:
+            result.add_aux_coord(coord.copy(), dims)
+    return result
+
+
+def cyclic_cube(cycle_cube, first_month, count, chunk_size=CHUNK_SIZE):
+    """Return a cube of *count* months from *first_month* (months since
+    year 0) repeating the PERIOD months of *cycle_cube*, with lazy data.
+
+    Each month of the result has the data of the same calendar month of
+    *cycle_cube*, which must be PERIOD consecutive months.
+    """
+    time_coord, dim = _time_dim(cycle_cube)
+    if cycle_cube.shape[dim] != PERIOD:
+        raise ValueError('Expected a {}-month cycle, got {} time steps.'
+                         .format(PERIOD, cycle_cube.shape[dim]))
+    start = _month_number(time_coord, time_coord.points[0])
+    # the cycle is stored once, however many times it is repeated
+    data = cyclic_lazy(cycle_cube.data, count, axis=dim,
+                       phase=first_month - start, chunk_size=chunk_size)
+    return _with_time(cycle_cube, data,
+                      monthly_time_coord(time_coord, first_month, count), dim)
+
+
+def pad_cycles(cube, before=0, after=0, chunk_size=CHUNK_SIZE):
+    """Return *cube* with *before* years of its first PERIOD months before
+    it and *after* years of its last PERIOD months after it, lazily.
+
+    This is the padding of make_combined_*_1950-2020.pro (before=10) and of
+    the CEDS series (the last year repeated). Only the two cycles are read
+    up front; the rest of *cube* stays lazy.
+    """
+    time_coord, dim = _time_dim(cube)
+    length = cube.shape[dim]
+    first = _month_number(time_coord, time_coord.points[0])
+    last = _month_number(time_coord, time_coord.points[-1])
+    if last - first + 1 != length:
+        raise ValueError('The time series is not monthly and contiguous.')
+    pieces = []
+    coords = []
+    keys = [slice(None)] * cube.ndim
+    if before:
+        keys[dim] = slice(0, PERIOD)
+        padding = cyclic_cube(cube[tuple(keys)], first - PERIOD * before,
+                              PERIOD * before, chunk_size=chunk_size)
+        pieces.append(padding.lazy_data())
+        coords.append(padding.coord(axis='t', dim_coords=True))
+    pieces.append(cube.lazy_data())
+    coords.append(time_coord)
+    if after:
+        keys[dim] = slice(length - PERIOD, length)
+        padding = cyclic_cube(cube[tuple(keys)], last + 1, PERIOD * after,
+                              chunk_size=chunk_size)
+        pieces.append(padding.lazy_data())
+        coords.append(padding.coord(axis='t', dim_coords=True))
+
+    points = numpy.concatenate([coord.points for coord in coords])
+    bounds = numpy.concatenate([coord.bounds for coord in coords]) \
+        if all(coord.has_bounds() for coord in coords) else None
+    return _with_time(cube, dask.array.concatenate(pieces, axis=dim),
+                      time_coord.copy(points=points, bounds=bounds), dim)
+
+
+def add_cycle(cube, cycle_cube, chunk_size=CHUNK_SIZE):
+    """Return *cube* plus the PERIOD-month *cycle_cube* repeated along it,
+    lazily, matching calendar months (as the soil NOx is added to every
+    year). The cubes must be on the same grid."""
+    time_coord, dim = _time_dim(cube)
+    first = _month_number(time_coord, time_coord.points[0])
+    cycle = cyclic_cube(cycle_cube, first, cube.shape[dim],
+                        chunk_size=chunk_size)
+    return cube.copy(data=cube.lazy_data() + cycle.lazy_data())
+
+
+def with_calendar(cube, calendar):
+    """Return *cube* with its monthly time coordinate on *calendar*: the
+    same months, as mid-month points in days since the start of the first
+    year (as make_combined_*_1950-2020.pro wrote them)."""
+    time_coord, dim = _time_dim(cube)
+    first = _month_number(time_coord, time_coord.points[0])
+    units = cf_units.Unit('days since {:04d}-01-01 00:00:00'.format(
+        first // 12), calendar=calendar)
+    template = time_coord.copy(points=numpy.zeros(1, dtype='float64'),
+                               bounds=numpy.zeros((1, 2), dtype='float64')
+                               if time_coord.has_bounds() else None)
+    template.units = units
+    return _with_time(cube, cube.lazy_data(),
+                      monthly_time_coord(template, first, cube.shape[dim]),
+                      dim)
+
+
+def _local_keys(cube):
+    # the attributes read from the data variable (Iris 3.8 or later)
+    return tuple(getattr(cube.attributes, 'locals', ()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Extend a monthly emissions file with repeats of its '
+                    'first or last year, and/or add a 12-month cycle to '
+                    'every year, a chunk of months at a time.')
+    parser.add_argument('input', help='monthly emissions file, '
+                        'e.g. combined_sources_NOx_1960-2020_greg.nc')
+    parser.add_argument('output', help='netCDF file to write')
+    parser.add_argument('--before', type=int, default=0,
+                        help='years of the first year to put before the '
+                             'series (10 for 1950-2020 from 1960-2020)')
+    parser.add_argument('--after', type=int, default=0,
+                        help='years of the last year to put after the series')
+    parser.add_argument('--add-cycle', default=None,
+                        help='file of a 12-month cycle on the same grid to '
+                             'add to every year (e.g. soil NOx)')
+    parser.add_argument('--calendar', default='360_day',
+                        help='calendar of the output times (default: '
+                             '%(default)s; "input" keeps the input times)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='months read and written at a time '
+                             '(default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    cube = iris.load_cube(args.input)
+    cube.data = read_ahead(cube.lazy_data(), args.chunk_size)
+    try:
+        if args.add_cycle:
+            cube = add_cycle(cube, iris.load_cube(args.add_cycle),
+                             chunk_size=args.chunk_size)
+        cube = pad_cycles(cube, before=args.before, after=args.after,
+                          chunk_size=args.chunk_size)
+    except ValueError as error:
+        sys.stderr.write('{}: {}\n'.format(args.input, error))
+        return 1
+    if args.calendar != 'input':
+        cube = with_calendar(cube, args.calendar)
+    command = ['ukca_emiss.cyclic'] + list(sys.argv[1:] if argv is None
+                                           else argv)
+    cube.attributes['history'] = '{}: {} \n{}'.format(
+        time.ctime(time.time()), ' '.join(command),
+        cube.attributes.get('history', ''))
+    write(cube, args.output, netcdf_format='NETCDF3_64BIT_OFFSET',
+          local_keys=_local_keys(cube), unlimited=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
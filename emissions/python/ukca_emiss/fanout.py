@@ -0,0 +1,168 @@
+##############################################################################################
+#
+#  fanout.py
+#
+#  Make the emissions files for several model resolutions at once, reading
+#  each source file only once.
+#
+#  Each regrid script is run once per target grid, in a directory named
+#  after the grid (e.g. N48e/ukca_emiss_NO.nc). The regridded data are all
+#  lazy and come from the same lazy source data, and the files are written
+#  together a time chunk at a time (pipeline.store_together), so each time
+#  chunk of the source is read once and then regridded onto every grid,
+#  each with its own cached weights. The 'grid'
+#  attribute of each file describes the grid it is on.
+#
+#  Usage (from emissions/python):
+#      python -m ukca_emiss.fanout timeseries_1950-2020/regrid_NOx_emissions_n96e_360d.py \
+#          --grids N48e N96e N216e --output-dir /path/to/output
+#
+##############################################################################################
+
+import argparse
+import os
+import sys
+import traceback
+
+import iris
+
+from . import output as _output
+from . import pipeline as _pipeline
+from . import timing as _timing
+from .batch import run_script, script_settings
+from .grids import ENDGAME_GRIDS, _GRIDS, add_grid, grid_description, load_grid
+from .pool import find_scripts
+from .regrid import CHUNK_SIZE, ENGINES, prepare_source, regrid
+
+
+def grid_directory(grid_name):
+    """Return the name of the output directory for target grid *grid_name*."""
+    return os.path.basename(grid_name)
+
+
+def fanout_regrid(cube, grids, engine=None, chunk_size=CHUNK_SIZE):
+    """Regrid *cube* onto each of *grids*, sharing the reads of the source.
+
+    *cube* has not been prepared (see regrid.prepare_source). Returns a list
+    of regridded cubes with lazy data, one per grid. Computed together,
+    each chunk of *chunk_size* time steps of *cube* is read only once.
+    """
+    results = []
+    prepared = {}
+    for grid in grids:
+        # the source only needs preparing again for a new coordinate system
+        key = repr(grid.coord_system())
+        if key not in prepared:
+            prepared[key] = prepare_source(cube, grid)
+        results.append(regrid(prepared[key], grid, engine=engine,
+                              chunk_size=chunk_size))
+    return results
+
+
+def _run_for_grid(path, grid_file, grid_name, grid, result, output_dir):
+    # run the script with grid in place of its own grid_file, writing into
+    # the directory for grid_name
+    directory = os.path.join(output_dir, grid_directory(grid_name))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    previous = _GRIDS.get(grid_file)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    add_grid(grid_file, grid)
+    if grid_name in ENDGAME_GRIDS:
+        _output.overrides['grid'] = grid_description(grid_name)
+    try:
+        run_script(path, result)
+    finally:
+        _output.overrides.clear()
+        if previous is None:
+            del _GRIDS[grid_file]
+        else:
+            add_grid(grid_file, previous)
+        os.chdir(cwd)
+
+
+def fanout_script(path, grid_names, output_dir='.', engine=None,
+                  chunk_size=CHUNK_SIZE):
+    """Run the regrid script *path* once for each of *grid_names*.
+
+    The grids are names of ENDGame grids (e.g. 'N96e') or grid files. Each
+    output file is written to a directory named after its grid under
+    *output_dir*, all in a single pass over the source file.
+    """
+    settings = script_settings(path)
+    if not settings['regrids'] or 'grid_file' not in settings or \
+            'emissions_file' not in settings:
+        raise ValueError('{} does not regrid its emissions, so it cannot be '
+                         'run for other grids.'.format(path))
+    output_dir = os.path.abspath(output_dir)
+    grids = [load_grid(name) for name in grid_names]
+    ems = iris.load_cube(settings['emissions_file'])
+    results = fanout_regrid(ems, grids, engine=engine, chunk_size=chunk_size)
+
+    _output.deferred = []
+    try:
+        for grid_name, grid, result in zip(grid_names, grids, results):
+            _run_for_grid(path, settings['grid_file'], grid_name, grid,
+                          result, output_dir)
+        writes = _output.deferred
+        _output.deferred = None
+        # all the files are written a chunk at a time together, so each
+        # source chunk is read once
+        with _timing.stage('save'):
+            if writes:
+                _pipeline.store_together(*zip(*writes))
+    except BaseException:
+        # no report for a run that failed
+        _timing.discard()
+        raise
+    finally:
+        _output.deferred = None
+    _timing.finish()
+
+
+def run_fanout(paths, grid_names, output_dir='.', engine=None,
+               chunk_size=CHUNK_SIZE):
+    """Run each of the regrid scripts *paths* for every grid in *grid_names*.
+
+    Returns a dict of the scripts that failed and their tracebacks.
+    """
+    failures = {}
+    for path in paths:
+        try:
+            fanout_script(path, grid_names, output_dir=output_dir,
+                          engine=engine, chunk_size=chunk_size)
+        except Exception:
+            failures[path] = traceback.format_exc()
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run regrid scripts for several target grids, reading '
+                    'each source file once.')
+    parser.add_argument('paths', nargs='+',
+                        help='product directories and/or regrid scripts')
+    parser.add_argument('--grids', nargs='+', required=True,
+                        help='target grids: ENDGame grid names ({}) or grid '
+                             'files'.format(', '.join(sorted(ENDGAME_GRIDS))))
+    parser.add_argument('--output-dir', default='.',
+                        help='directory in which to make a directory for '
+                             'each grid (default: the current directory)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='time steps read and regridded at a time '
+                             '(default: %(default)s)')
+    parser.add_argument('--engine', choices=ENGINES, default=None,
+                        help='regrid engine (default: chosen from the grids)')
+    args = parser.parse_args(argv)
+
+    failures = run_fanout(find_scripts(args.paths), args.grids,
+                          output_dir=args.output_dir, engine=args.engine,
+                          chunk_size=args.chunk_size)
+    for path in sorted(failures):
+        sys.stderr.write('FAILED: {}\n{}\n'.format(path, failures[path]))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+##############################################################################################
+#
+#  grids.py
+#
+#  Target grids for the regrid scripts. A grid is a cube whose horizontal
+#  coordinates (with bounds) describe the model grid; only the coordinates
+#  are used, never the data.
+#
+#  The standard ENDGame grids (N48e, N96e, N216e, N512e) are generated here,
+#  so they don't need a model output file at all: use the grid name in place
+#  of the file name, e.g. load_grid('N96e'). For UM pp and fieldsfiles only
+#  the header of the first field is read; anything else is loaded with Iris.
+#
+##############################################################################################
+
+import os
+
+import iris
+import iris.coord_systems
+import iris.coords
+import iris.cube
+import iris.fileformats
+import iris.fileformats.pp
+import numpy
+
+from . import timing as _timing
+
+try:
+    import iris.fileformats.um as _um
+except ImportError:
+    # Iris < 1.10
+    _um = None
+
+# the Earth as used by the UM
+UM_COORD_SYSTEM = iris.coord_systems.GeogCS(6371229.0)
+
+# the ENDGame grids: name -> (number of longitudes, number of latitudes)
+ENDGAME_GRIDS = {
+    'N48e': (96, 72),
+    'N96e': (192, 144),
+    'N216e': (432, 324),
+    'N512e': (1024, 768),
+}
+
+# grids already loaded by this process, keyed by file (or grid) name
+_GRIDS = {}
+
+
+def _grid_cube(x, y):
+    # a grid cube with dimension coordinates y and x and dummy data
+    return iris.cube.Cube(numpy.zeros((len(y.points), len(x.points)),
+                                      dtype='float32'),
+                          dim_coords_and_dims=[(y, 0), (x, 1)])
+
+
+def _regular_coord(name, start, step, count, coord_system, circular=False):
+    # count cells of width step from start, points at the cell centres
+    edges = start + step * numpy.arange(count + 1, dtype='float64')
+    bounds = numpy.column_stack((edges[:-1], edges[1:]))
+    return iris.coords.DimCoord(bounds.mean(axis=1), standard_name=name,
+                                units='degrees', bounds=bounds,
+                                coord_system=coord_system, circular=circular)
+
+
+def endgame_grid(name):
+    """Return the ENDGame grid *name* (one of ENDGAME_GRIDS, e.g. 'N96e').
+
+    The grid is regular in longitude and latitude, with the first cell
+    starting at 0 degrees east and the south pole, as for the theta points
+    of the UM's ENDGame dynamical core.
+    """
+    try:
+        nx, ny = ENDGAME_GRIDS[name]
+    except KeyError:
+        raise ValueError('Unknown ENDGame grid {!r}, expected one of {}.'
+                         .format(name, ', '.join(sorted(ENDGAME_GRIDS))))
+    x = _regular_coord('longitude', 0.0, 360.0 / nx, nx, UM_COORD_SYSTEM,
+                       circular=True)
+    y = _regular_coord('latitude', -90.0, 180.0 / ny, ny, UM_COORD_SYSTEM)
+    return _grid_cube(x, y)
+
+
+def grid_description(name):
+    """Return the 'grid' attribute of an emissions file on ENDGame grid *name*.
+
+    For example 'regular 1.875 x 1.25 degree longitude-latitude grid (N96e)'.
+    """
+    nx, ny = ENDGAME_GRIDS[name]
+    return 'regular {:g} x {:g} degree longitude-latitude grid ({})'.format(
+        360.0 / nx, 180.0 / ny, name)
+
+
+def _first_um_field(grid_file):
+    # the first field of a UM pp or fieldsfile, with its data unread, or
+    # None if grid_file is some other kind of file
+    with open(grid_file, 'rb') as fh:
+        try:
+            spec = iris.fileformats.FORMAT_AGENT.get_spec(
+                os.path.basename(grid_file), fh)
+        except ValueError:
+            return None
+    if spec.name.startswith('UM Post Processing file'):
+        fields = iris.fileformats.pp.load(
+            grid_file, little_ended='little-endian' in spec.name)
+    elif spec.name.startswith('UM Fieldsfile') and _um is not None:
+        fields = _um.um_to_pp(grid_file)
+    else:
+        return None
+    for field in fields:
+        return field
+    return None
+
+
+def _field_coord(field, axis, coord_system):
+    # the x or y coordinate of a pp field, from its header
+    if axis == 'x':
+        start, step, count, extra = field.bzx, field.bdx, field.lbnpt, 'x'
+    else:
+        start, step, count, extra = field.bzy, field.bdy, field.lbrow, 'y'
+    if step:
+        points = start + step * numpy.arange(1, count + 1, dtype='float64')
+    else:
+        # irregular grid, the points are in the extra data
+        points = numpy.array(getattr(field, extra), dtype='float64')
+    rotated = isinstance(coord_system, iris.coord_systems.RotatedGeogCS)
+    name = {'x': 'longitude', 'y': 'latitude'}[axis]
+    if rotated:
+        name = 'grid_' + name
+    circular = axis == 'x' and step and \
+        abs(abs(step) * count - 360.0) < 1e-4 * abs(step)
+    coord = iris.coords.DimCoord(points, standard_name=name, units='degrees',
+                                 coord_system=coord_system,
+                                 circular=bool(circular))
+    coord.guess_bounds()
+    return coord
+
+
+def um_header_grid(grid_file):
+    """Return the horizontal grid of the first field of a UM file.
+
+    Only the header of the field is read, not its data or any other field.
+    Returns None if *grid_file* isn't a UM pp or fieldsfile.
+    """
+    field = _first_um_field(grid_file)
+    if field is None:
+        return None
+    coord_system = field.coord_system()
+    return _grid_cube(_field_coord(field, 'x', coord_system),
+                      _field_coord(field, 'y', coord_system))
+
+
+@_timing.timed('grid')
+def load_grid(grid_file):
+    """Return the horizontal grid of the first field in *grid_file*.
+
+    *grid_file* may also be the name of one of the ENDGAME_GRIDS, e.g.
+    'N96e', which is generated rather than read. The x and y coordinates
+    have bounds, ready for area-weighted regridding. Each grid is only set
+    up once per process, so running several scripts in one process (see
+    batch.py) shares the grid.
+    """
+    if grid_file not in _GRIDS:
+        if grid_file in ENDGAME_GRIDS:
+            grd = endgame_grid(grid_file)
+        else:
+            grd = um_header_grid(grid_file)
+        if grd is None:
+            grd = iris.load(grid_file)[0]
+            grd.coord(axis='x').guess_bounds()
+            grd.coord(axis='y').guess_bounds()
+        _GRIDS[grid_file] = grd
+    return _GRIDS[grid_file].copy()
+
+
+def add_grid(grid_file, grid):
+    """Use *grid* for *grid_file* from now on, without reading the file."""
+    _GRIDS[grid_file] = grid
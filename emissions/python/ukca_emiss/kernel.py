@@ -0,0 +1,88 @@
+##############################################################################################
+#
+#  kernel.py
+#
+#  A compiled regrid kernel for the 'numba' engine (see regrid.py), used if
+#  Numba is installed.
+#
+#  It does the separable area-weighted regrid (the same wy @ field @ wx.T as
+#  the 'separable' engine), the scaling of each time step (e.g. the
+#  month_length/30 calendar factor and a molecular weight conversion, see
+#  regrid(..., scale=...)) and the conversion to the output type in a single
+#  pass over the source data, writing straight into the output array. Time
+#  steps are shared between threads with prange. The regrid factors are
+#  kept as compressed rows, as each target cell only overlaps a few source
+#  cells in each direction, and all the sums are done in float64.
+#
+##############################################################################################
+
+import numpy
+
+try:
+    import numba
+    from numba import prange
+except ImportError:
+    # the kernel is still defined (and runs, slowly) as plain Python
+    numba = None
+    prange = range
+
+
+def compressed_rows(weights):
+    """Return (indptr, indices, values) of the non-zero entries of each row
+    of the dense 2-d *weights*, as in a CSR matrix."""
+    weights = numpy.asarray(weights, dtype='float64')
+    rows, cols = numpy.nonzero(weights)
+    indptr = numpy.zeros(weights.shape[0] + 1, dtype='int64')
+    numpy.cumsum(numpy.bincount(rows, minlength=weights.shape[0]),
+                 out=indptr[1:])
+    return indptr, cols.astype('int64'), weights[rows, cols]
+
+
+def _regrid_steps(src, xptr, xidx, xw, yptr, yidx, yw, scale, out):
+    # out[t] = scale[t] * (wy @ src[t] @ wx.T), with wx and wy as
+    # compressed rows; one time step per parallel iteration
+    nsteps, ny_src = src.shape[0], src.shape[1]
+    ny_tgt, nx_tgt = out.shape[1], out.shape[2]
+    for step in prange(nsteps):
+        # the longitude pass, into a float64 array private to this step
+        tmp = numpy.empty((ny_src, nx_tgt))
+        for row in range(ny_src):
+            for col in range(nx_tgt):
+                total = 0.0
+                for k in range(xptr[col], xptr[col + 1]):
+                    total += src[step, row, xidx[k]] * xw[k]
+                tmp[row, col] = total
+        # the latitude pass, scaled and stored in the output type
+        line = numpy.empty(nx_tgt)
+        for row in range(ny_tgt):
+            line[:] = 0.0
+            for k in range(yptr[row], yptr[row + 1]):
+                weight = yw[k]
+                for col in range(nx_tgt):
+                    line[col] += weight * tmp[yidx[k], col]
+            for col in range(nx_tgt):
+                out[step, row, col] = line[col] * scale[step]
+
+
+if numba is not None:
+    regrid_steps = numba.njit(parallel=True, cache=True)(_regrid_steps)
+else:
+    regrid_steps = None
+
+
+def fused_operator(factors):
+    """Return a function(block, scale, out) for the separable *factors*
+    (wy, wx), which regrids the (n, ny, nx) *block*, multiplies step i by
+    *scale*[i] and stores the result in *out*."""
+    if regrid_steps is None:
+        raise ValueError("The 'numba' regrid engine needs Numba, which is "
+                         "not installed.")
+    wy, wx = factors
+    xptr, xidx, xw = compressed_rows(wx)
+    yptr, yidx, yw = compressed_rows(wy)
+
+    def operator(block, scale, out):
+        regrid_steps(numpy.ascontiguousarray(block), xptr, xidx, xw,
+                     yptr, yidx, yw,
+                     numpy.ascontiguousarray(scale, dtype='float64'), out)
+    return operator
@@ -0,0 +1,123 @@
+##############################################################################################
+#
+#  output.py
+#
+#  Writing the ukca_emiss_*.nc files.
+#
+#  save() does what the end of each regrid script used to do (missing_value
+#  as well as _FillValue, no unlimited dimension unless asked for, the CF
+#  Conventions attribute), for both old and new versions of Iris. If the
+#  cube has lazy data, e.g. from ukca_emiss.regrid(..., chunk_size=N), the
+#  data are computed and written one chunk at a time, so the whole field is
+#  never held in memory.
+#
+#  By default the file is written by writer.py, which can also chunk and
+#  compress the data with the NETCDF4 formats; writer='iris' uses Iris's
+#  netCDF Saver instead.
+#
+#  fanout.py runs a script once per target grid and writes all the files
+#  together, so it sets overrides (attributes such as 'grid' that depend on
+#  the target grid) and deferred (a list which, while set, collects the
+#  data of each file and where to write them rather than writing them, to
+#  be written in one pass, see pipeline.store_together).
+#
+##############################################################################################
+
+import dask
+import iris
+import iris.fileformats.netcdf
+
+from . import timing as _timing
+from . import writer as _writer
+
+# default _FillValue / missing_value of the emissions files
+FILL_VALUE = 1e+20
+
+# attributes set on every cube saved, over those set by the script
+overrides = {}
+
+# if a list, save() only sets up each file and appends the (data, target)
+# of its lazy data here, to be written by the caller with
+# pipeline.store_together (only with writer='netcdf4')
+deferred = None
+
+WRITERS = ('netcdf4', 'iris')
+
+
+def _set_missing_value(cube, fill_value):
+    # Iris 1.x won't accept missing_value as a cube attribute, so set it
+    # behind its back; newer versions allow it
+    try:
+        cube.attributes['missing_value'] = fill_value
+    except ValueError:
+        dict.__setitem__(cube.attributes, 'missing_value', fill_value)
+
+
+def save(cube, outpath, netcdf_format='NETCDF3_CLASSIC', local_keys=None,
+         fill_value=FILL_VALUE, unlimited=False, chunks=None, zlib=False,
+         complevel=4, shuffle=True, writer='netcdf4'):
+    """Write the emissions *cube* to the netCDF file *outpath*.
+
+    *local_keys* are the attributes written to the data variable rather
+    than as global attributes. The time dimension is only made unlimited
+    (so the file can be concatenated along time) if *unlimited* is True.
+
+    With one of the NETCDF4 formats, the data are stored in chunks of shape
+    *chunks* (by default one time step per chunk) and, if *zlib* is True,
+    compressed at level *complevel*, with the shuffle filter if *shuffle* is
+    True. *writer* is one of WRITERS.
+    """
+    if writer not in WRITERS:
+        raise ValueError('Unknown writer {!r}, expected one of {}.'
+                         .format(writer, ', '.join(WRITERS)))
+    if deferred is not None and writer != 'netcdf4':
+        raise ValueError("Writes can only be deferred with writer='netcdf4'.")
+    _timing.add_output(outpath, cube)
+    _save(cube, outpath, netcdf_format, local_keys, fill_value, unlimited,
+          chunks, zlib, complevel, shuffle, writer)
+    if deferred is None:
+        # the file is written, so the run report is complete
+        _timing.finish()
+
+
+@_timing.timed('save')
+def _save(cube, outpath, netcdf_format, local_keys, fill_value, unlimited,
+          chunks, zlib, complevel, shuffle, writer):
+    for name, value in overrides.items():
+        cube.attributes[name] = value
+    _set_missing_value(cube, fill_value)
+    if local_keys is None:
+        local_keys = []
+    if 'missing_value' not in local_keys:
+        local_keys = list(local_keys) + ['missing_value']
+
+    if writer == 'netcdf4':
+        result = _writer.write(cube, outpath, netcdf_format=netcdf_format,
+                               local_keys=local_keys, fill_value=fill_value,
+                               unlimited=unlimited, chunks=chunks, zlib=zlib,
+                               complevel=complevel, shuffle=shuffle,
+                               compute=deferred is None)
+        if result is not None:
+            deferred.append(result)
+        return
+
+    kwargs = {}
+    if hasattr(iris.FUTURE, 'netcdf_no_unlimited'):
+        # Iris 1.x
+        iris.FUTURE.netcdf_no_unlimited = not unlimited
+    else:
+        kwargs = {'fill_value': fill_value,
+                  'unlimited_dimensions': ['time'] if unlimited else []}
+    if netcdf_format.startswith('NETCDF4'):
+        kwargs.update(zlib=zlib, complevel=complevel, shuffle=shuffle)
+        if chunks is not None:
+            kwargs['chunksizes'] = chunks
+
+    # compute lazy data one chunk at a time, so memory use is set by the
+    # chunk size
+    with dask.config.set(scheduler='synchronous'):
+        with iris.fileformats.netcdf.Saver(filename=outpath,
+                                           netcdf_format=netcdf_format) as saver:
+            saver.update_global_attributes(
+                Conventions=iris.fileformats.netcdf.CF_CONVENTIONS_VERSION)
+            saver.write(cube, local_keys=local_keys, **kwargs)
@@ -0,0 +1,200 @@
+##############################################################################################
+#
+#  periodic.py
+#
+#  Make periodic emissions files (12 monthly fields, repeated every year by
+#  the UM, as in periodic_1960) from the regridded time series files,
+#  rather than regridding separate source files.
+#
+#  A 12-month window is copied out of an existing ukca_emiss_*.nc time
+#  series, reading only those months of the data, one month at a time. The
+#  time coordinates (time, forecast_reference_time and their bounds) are
+#  put relative to the start of the window, so that the time axis runs from
+#  15 to 345 days for a 360_day series, and the file is marked as periodic
+#  (emission_type and update_type 2). Everything else is copied unchanged.
+#
+#  Usage (from emissions/python):
+#      python -m ukca_emiss.periodic ukca_emiss_NO.nc --year 1960 --output-dir periodic
+#
+##############################################################################################
+
+import argparse
+import os
+import sys
+import time
+
+import cftime
+import netCDF4
+import numpy
+
+# number of months in a periodic file
+PERIOD = 12
+
+
+def _time_units(variable):
+    # the units of variable if it is a time, otherwise None
+    units = getattr(variable, 'units', '')
+    if ' since ' not in units:
+        return None
+    return units, getattr(variable, 'calendar', 'standard')
+
+
+def find_window(time_variable, year, month=1):
+    """Return the index of (*year*, *month*) in the netCDF *time_variable*.
+
+    Raises a ValueError unless the PERIOD months from there are all in the
+    file and consecutive.
+    """
+    units, calendar = _time_units(time_variable)
+    dates = cftime.num2date(time_variable[:], units, calendar)
+    months = numpy.array([date.year * 12 + date.month - 1 for date in dates])
+    start = year * 12 + month - 1
+    found = numpy.nonzero(months == start)[0]
+    if len(found) == 0:
+        raise ValueError('{:04d}-{:02d} is not in the time series.'
+                         .format(year, month))
+    index = found[0]
+    window = months[index:index + PERIOD]
+    if len(window) != PERIOD or \
+            not numpy.array_equal(window, start + numpy.arange(PERIOD)):
+        raise ValueError('The time series does not have {} consecutive '
+                         'months from {:04d}-{:02d}.'
+                         .format(PERIOD, year, month))
+    return index
+
+
+def _copy_attributes(source, target, skip=('_FillValue',)):
+    for name in source.ncattrs():
+        if name not in skip:
+            target.setncattr(name, source.getncattr(name))
+
+
+def extract_periodic(timeseries_file, outpath, year, month=1, title=None,
+                     netcdf_format=None):
+    """Write the periodic file *outpath* from *timeseries_file*.
+
+    The PERIOD months from (*year*, *month*) are copied, with the time axis
+    relative to the first of them. *title* replaces the title attribute if
+    given. The file has the same format as *timeseries_file* unless
+    *netcdf_format* is given.
+    """
+    source = netCDF4.Dataset(timeseries_file)
+    try:
+        source.set_auto_mask(False)
+        start = find_window(source.variables['time'], year, month)
+        window = slice(start, start + PERIOD)
+        new_units = 'days since {:04d}-{:02d}-01 00:00:00'.format(year, month)
+        bounds_of = dict((variable.bounds, name) for name, variable
+                         in source.variables.items()
+                         if 'bounds' in variable.ncattrs())
+
+        target = netCDF4.Dataset(outpath, 'w',
+                                 format=netcdf_format or source.file_format)
+        try:
+            for name, dimension in source.dimensions.items():
+                # not unlimited: a periodic file isn't meant to be cattable
+                target.createDimension(
+                    name, PERIOD if name == 'time' else len(dimension))
+
+            for name, variable in source.variables.items():
+                fill_value = variable.getncattr('_FillValue') \
+                    if '_FillValue' in variable.ncattrs() else None
+                args = {}
+                chunking = variable.chunking() \
+                    if target.data_model.startswith('NETCDF4') and \
+                    source.data_model.startswith('NETCDF4') else None
+                if chunking and chunking != 'contiguous':
+                    args['chunksizes'] = [
+                        min(size, PERIOD) if dim == 'time' else size
+                        for dim, size in zip(variable.dimensions, chunking)]
+                    filters = variable.filters() or {}
+                    if filters.get('zlib'):
+                        args.update(zlib=True, complevel=filters['complevel'],
+                                    shuffle=filters['shuffle'])
+                copy = target.createVariable(name, variable.dtype,
+                                             variable.dimensions,
+                                             fill_value=fill_value, **args)
+                copy.set_auto_mask(False)
+                _copy_attributes(variable, copy)
+
+                if 'time' not in variable.dimensions:
+                    copy[...] = variable[...]
+                    continue
+                tdim = variable.dimensions.index('time')
+                units = _time_units(variable)
+                if units is None and name in bounds_of:
+                    # bounds take the units of their coordinate
+                    units = _time_units(source.variables[bounds_of[name]])
+                if units is not None:
+                    # a time: re-express it relative to the window
+                    index = [slice(None)] * variable.ndim
+                    index[tdim] = window
+                    values = cftime.date2num(
+                        cftime.num2date(variable[tuple(index)], *units),
+                        new_units, units[1])
+                    copy[...] = values
+                    if 'units' in variable.ncattrs():
+                        copy.setncattr('units', new_units)
+                    continue
+                # the data, one month at a time
+                for step in range(PERIOD):
+                    index = [slice(None)] * variable.ndim
+                    index[tdim] = start + step
+                    out_index = list(index)
+                    out_index[tdim] = step
+                    copy[tuple(out_index)] = variable[tuple(index)]
+
+            _copy_attributes(source, target, skip=())
+            target.setncattr('emission_type', '2')  # periodic time series
+            target.setncattr('update_type', '2')    # same as above
+            target.setncattr('source', os.path.basename(timeseries_file))
+            if title is not None:
+                target.setncattr('title', title)
+            now = time.ctime(time.time())
+            target.setncattr('File_creation_date', now)
+            end = year * 12 + month - 1 + PERIOD - 1
+            target.setncattr('history', '{}: {:04d}-{:02d} to {:04d}-{:02d} of '
+                             '{} \n{}'.format(now, year, month, end // 12,
+                                              end % 12 + 1, timeseries_file,
+                                              getattr(source, 'history', '')))
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Make periodic emissions files from 12 months of '
+                    'regridded time series files.')
+    parser.add_argument('files', nargs='+', help='ukca_emiss_*.nc time series')
+    parser.add_argument('--year', type=int, required=True,
+                        help='year of the first month')
+    parser.add_argument('--month', type=int, default=1,
+                        help='first month (default: %(default)s)')
+    parser.add_argument('--output-dir', required=True,
+                        help='directory to write the periodic files to, '
+                             'with the same names as the time series files')
+    parser.add_argument('--title', default=None,
+                        help='new title attribute (default: keep the title)')
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    for path in args.files:
+        outpath = os.path.join(args.output_dir, os.path.basename(path))
+        if os.path.abspath(outpath) == os.path.abspath(path):
+            sys.stderr.write('Not overwriting {}\n'.format(path))
+            return 1
+        try:
+            extract_periodic(path, outpath, args.year, month=args.month,
+                             title=args.title)
+        except ValueError as error:
+            sys.stderr.write('{}: {}\n'.format(path, error))
+            return 1
+        print('{} -> {}'.format(path, outpath))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
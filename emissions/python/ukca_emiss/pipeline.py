@@ -0,0 +1,340 @@
+##############################################################################################
+#
+#  pipeline.py
+#
+#  Overlapping the reading, regridding and writing of a long time series.
+#
+#  Computed a chunk at a time with the synchronous scheduler, a lazy regrid
+#  reads a time chunk of the source file, regrids it and writes it out, then
+#  starts on the next chunk, so the disk and the CPU take turns to be idle.
+#  Here each stage has a thread of its own, with the chunks passed along in
+#  order:
+#    read_ahead() -- the source is read on a reader thread up to DEPTH
+#                    chunks ahead of the one being regridded
+#    store()      -- each regridded chunk is handed to a writer thread, with
+#                    at most DEPTH chunks waiting to be written
+#  so while chunk k is regridded, chunk k+1 is being read and chunk k-1
+#  written, and the run takes about as long as the slower of the I/O and
+#  the regrid rather than their sum. Memory use is still set by the chunk
+#  size, as only DEPTH chunks are held at each stage. store_together()
+#  does the same for several files made from one source (fanout.py,
+#  calendars.py), computing each chunk of all of them at once so the
+#  source chunk is read once.
+#
+#  The 3-D fields (e.g. the n96l85 aircraft emissions) have a whole time
+#  step of ~19 MB or more in float64; stream_levels() sizes the blocks read
+#  and written to a memory budget (UKCA_EMISS_MEMORY, in MB), splitting the
+#  levels of a time step if need be, and converts each block to float32 as
+#  it is read, so peak memory doesn't grow with the levels or years.
+#
+#  Iris's reads of netCDF files hold its netCDF lock, as the netCDF and
+#  HDF5 libraries aren't thread-safe; the writes (see writer.py) take the
+#  same lock, so only the regrid runs alongside the I/O.
+#
+##############################################################################################
+
+import concurrent.futures
+import itertools
+import os
+import queue
+import threading
+
+import dask.array
+import dask.base
+import numpy
+
+from . import timing as _timing
+
+# number of chunks read ahead, or waiting to be written
+DEPTH = 2
+
+# the memory budget (MB) of stream_levels, unless set in this environment
+# variable
+MEMORY_VAR = 'UKCA_EMISS_MEMORY'
+MEMORY = 256
+
+
+def _compute(data):
+    # (not dask.config.set, which isn't local to the thread)
+    return data.compute(scheduler='synchronous')
+
+
+class ReadAhead(object):
+    """A read-only array of the dask array *data*, which is read in blocks
+    of *chunk_size* steps of its first dimension (and *levels* steps of its
+    second, if given), converted to *dtype* if given as they are read.
+
+    While the blocks are asked for in order (the levels of a time chunk
+    before the next time chunk), the next *depth* blocks are read on a
+    reader thread, ready for the following requests; a block is only read
+    ahead once. Blocks asked for out of order, and other slices, are read
+    as they are asked for.
+
+    Each block is computed on its own, so *data* should be straight from
+    the file (e.g. iris.load_cube(...).lazy_data()): dask only reads the
+    slice asked for if it can pass it on to the file.
+    """
+
+    def __init__(self, data, chunk_size, depth=DEPTH, levels=None,
+                 dtype=None):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.levels = levels
+        self.depth = depth
+        self.shape = data.shape
+        self.dtype = numpy.dtype(dtype or data.dtype)
+        self.ndim = data.ndim
+        # the start of each block, in the order they are read
+        self._starts = [(start, level)
+                        for start in range(0, self.shape[0], chunk_size)
+                        for level in (range(0, self.shape[1], levels)
+                                      if levels else [0])]
+        self._order = dict((start, number)
+                           for number, start in enumerate(self._starts))
+        # blocks being read ahead, the starts of all the blocks read or
+        # being read, and the number of the block expected next
+        self._ahead = {}
+        self._read_starts = set()
+        self._next = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __dask_tokenize__(self):
+        return (type(self).__name__, dask.base.tokenize(self.data),
+                self.chunk_size, self.levels, str(self.dtype))
+
+    def _keys(self, start):
+        # the leading keys of the block from start
+        first, level = start
+        keys = (slice(first, first + self.chunk_size),)
+        if self.levels:
+            keys += (slice(level, level + self.levels),)
+        return keys
+
+    @_timing.timed('read')
+    def _read(self, start):
+        block = _compute(self.data[self._keys(start)])
+        return block.astype(self.dtype, copy=False)
+
+    def _block(self, start):
+        # the block from start; if the blocks are being asked for in order,
+        # start the reads of the next ones that haven't been read yet
+        with self._lock:
+            future = self._ahead.pop(start, None)
+            number = self._order[start]
+            in_order = future is not None or number == self._next
+            self._next = number + 1
+            self._read_starts.add(start)
+            if in_order:
+                for later in self._starts[number + 1:number + 1 + self.depth]:
+                    if later in self._read_starts:
+                        continue
+                    if self._executor is None:
+                        self._executor = \
+                            concurrent.futures.ThreadPoolExecutor(
+                                max_workers=1)
+                    self._read_starts.add(later)
+                    self._ahead[later] = self._executor.submit(self._read,
+                                                               later)
+            if not self._ahead and self._executor is not None:
+                # nothing left to read ahead
+                self._executor.shutdown(wait=False)
+                self._executor = None
+        return future.result() if future is not None else self._read(start)
+
+    def _block_start(self, keys):
+        # the start of the block that keys are, or None
+        starts = []
+        for dim, size in enumerate([self.chunk_size] +
+                                   ([self.levels] if self.levels else [])):
+            key = keys[dim] if dim < len(keys) else slice(None)
+            if not isinstance(key, slice) or key.step not in (None, 1):
+                return None
+            start, stop, step = key.indices(self.shape[dim])
+            if start % size != 0 or stop != min(start + size,
+                                                self.shape[dim]):
+                return None
+            starts.append(start)
+        return (starts[0], starts[1] if self.levels else 0)
+
+    def __getitem__(self, keys):
+        if not isinstance(keys, tuple):
+            keys = (keys,)
+        start = self._block_start(keys)
+        if start is not None:
+            lead = 2 if self.levels else 1
+            return self._block(start)[(slice(None),) * lead + keys[lead:]]
+        return _compute(self.data[keys]).astype(self.dtype, copy=False)
+
+    def __array__(self, dtype=None, copy=None):
+        result = _compute(self.data).astype(self.dtype, copy=False)
+        return result if dtype is None else result.astype(dtype)
+
+
+def read_ahead(data, chunk_size, depth=DEPTH, levels=None, dtype=None):
+    """Return the dask array *data* in chunks of *chunk_size* steps of its
+    first dimension (and *levels* of its second, if given), converted to
+    *dtype* if given, and read on a reader thread up to *depth* chunks
+    ahead (see ReadAhead)."""
+    if depth < 1:
+        data = data.rechunk({0: chunk_size, 1: levels} if levels
+                            else {0: chunk_size})
+        return data if dtype is None else data.astype(dtype)
+    chunks = (chunk_size,) + tuple(levels if dim == 1 and levels else -1
+                                   for dim in range(1, data.ndim))
+    array = ReadAhead(data, chunk_size, depth, levels=levels, dtype=dtype)
+    return dask.array.from_array(array, chunks=chunks, asarray=False,
+                                 meta=data._meta.astype(array.dtype))
+
+
+def memory_budget(memory=None):
+    """Return the memory budget in bytes: *memory* MB if given, else the
+    MB in the UKCA_EMISS_MEMORY environment variable, else MEMORY MB."""
+    if memory is None:
+        memory = float(os.environ.get(MEMORY_VAR) or MEMORY)
+    return int(memory * 1024 * 1024)
+
+
+def budget_chunks(shape, budget, itemsize=4, read_itemsize=8, depth=DEPTH):
+    """Return the (time steps, levels) of the blocks of an array of *shape*
+    (time, level, ...) for which read_ahead and store hold no more than
+    *budget* bytes of data.
+
+    Each block is read as *read_itemsize*-byte values, which takes up to
+    three times the block (the netCDF read and Iris's masking of it), and
+    kept as *itemsize*-byte ones; up to 2 * *depth* + 2 blocks are held at
+    once (read ahead, being passed on, waiting to be written and being
+    written). Whole time steps are used if one fits, otherwise the levels
+    are split into blocks of about the same size; a block is never less
+    than one level.
+    """
+    elements = budget // (3 * read_itemsize + itemsize * (2 * depth + 2))
+    per_level = int(numpy.prod(shape[2:], dtype='int64'))
+    per_step = per_level * shape[1]
+    if elements >= per_step:
+        return min(shape[0], elements // per_step), shape[1]
+    blocks = -(-shape[1] // max(1, elements // per_level))
+    return 1, -(-shape[1] // blocks)
+
+
+def stream_levels(cube, dtype=None, memory=None, depth=DEPTH):
+    """Make the lazy data of the (time, level, y, x) *cube* be read and
+    written a block of (time steps, levels) at a time, with the blocks as
+    large as the memory budget (*memory* MB, see memory_budget) allows,
+    and converted to *dtype* as each block is read. Returns *cube*.
+
+    The cube's data should still be straight from the file. The netCDF
+    file written from it (see writer.py) is chunked to match the blocks.
+    """
+    data = cube.lazy_data()
+    dtype = numpy.dtype(dtype or data.dtype)
+    chunk_size, levels = budget_chunks(data.shape, memory_budget(memory),
+                                       dtype.itemsize, data.dtype.itemsize,
+                                       depth)
+    cube.data = read_ahead(data, chunk_size, depth, levels=levels,
+                           dtype=dtype)
+    return cube
+
+
+def store(data, target, start=0, depth=DEPTH):
+    """Write the dask array *data* into *target*[start:start + len(data)]
+    (e.g. a netCDF variable), a block at a time: a chunk of its first
+    dimension, or of its first two if the second is chunked too.
+
+    The blocks are computed in order, each being written on a writer thread
+    while the next is computed; at most *depth* blocks wait to be written.
+    """
+    store_together([data], [target], start=start, depth=depth)
+
+
+def store_together(arrays, targets, start=0, depth=DEPTH):
+    """Write each of the dask arrays *arrays* into the matching one of
+    *targets*, as store() does.
+
+    The arrays must have the same chunks along the dimensions the blocks
+    are taken from. Each block of all the arrays is computed at once, so
+    anything they have in common (e.g. the read of a chunk of their source
+    file) is computed once, in order, and memory use is set by the size of
+    a block rather than the number of arrays.
+    """
+    lead = _lead(arrays[0])
+    for data in arrays[1:]:
+        if data.chunks[:lead] != arrays[0].chunks[:lead]:
+            raise ValueError('The arrays must have the same chunks, got {} '
+                             'and {}.'.format(arrays[0].chunks[:lead],
+                                              data.chunks[:lead]))
+
+    def compute(keys):
+        blocks = dask.base.compute(*[data[keys] for data in arrays],
+                                   scheduler='synchronous')
+        return [(target, _region(keys, start), block)
+                for target, block in zip(targets, blocks)]
+
+    if depth < 1:
+        for keys in _blocks(arrays[0]):
+            for target, region, block in compute(keys):
+                target[region] = block
+        return
+
+    waiting = queue.Queue(maxsize=depth)
+    errors = []
+
+    def write():
+        while True:
+            item = waiting.get()
+            if item is None:
+                return
+            if errors:
+                # keep emptying the queue, so the computing thread can't
+                # block on it
+                continue
+            try:
+                for target, region, block in item:
+                    target[region] = block
+            except BaseException as error:
+                errors.append(error)
+
+    writer = threading.Thread(target=write, name='ukca_emiss-writer')
+    writer.daemon = True
+    writer.start()
+    try:
+        for keys in _blocks(arrays[0]):
+            if errors:
+                break
+            waiting.put(compute(keys))
+    finally:
+        waiting.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+
+
+def _chunk_stops(chunks):
+    # (start, stop) of each of chunks
+    stop = 0
+    for size in chunks:
+        yield stop, stop + size
+        stop += size
+
+
+def _lead(data):
+    # the number of leading dimensions the blocks of data are taken from
+    return 2 if data.ndim > 1 and len(data.chunks[1]) > 1 else 1
+
+
+def _blocks(data):
+    # the keys of each block of data, a chunk of the first dimension and,
+    # if it is chunked, of the second, in order
+    lead = _lead(data)
+    stops = [list(_chunk_stops(chunks)) for chunks in data.chunks[:lead]]
+    for block in itertools.product(*stops):
+        yield tuple(slice(first, last) for first, last in block) + \
+            (slice(None),) * (data.ndim - lead)
+
+
+def _region(keys, start):
+    # keys moved start steps along the first dimension
+    return (slice(keys[0].start + start, keys[0].stop + start),) + keys[1:]
@@ -0,0 +1,301 @@
+##############################################################################################
+#
+#  pool.py
+#
+#  Run a whole product directory of regrid scripts (e.g. timeseries_1950-2020
+#  or CMIP6_hybrid) across a pool of worker processes.
+#
+#  Before the pool starts, the target grids are read and the regrid weights
+#  for every source/target pair are calculated once and put into shared
+#  memory. Each worker maps them into its weight cache, so no worker reads a
+#  grid file or recalculates weights. Every script runs in a fresh worker
+#  process, exactly as it would from the command line, and a failing script
+#  (or a worker that dies, e.g. killed for running out of memory) doesn't
+#  stop the others: all the results and failures are reported at the end.
+#
+#  Scripts that would write the same output file (e.g. the _greg and _360d
+#  scripts of CMIP6_hybrid both write ukca_emiss_<species>.nc) write to
+#  greg/ and 360d/ directories of the output directory, as in calendars.py;
+#  any other clash is an error before anything is run.
+#
+#  Usage (from emissions/python):
+#      python -m ukca_emiss.pool timeseries_1950-2020 --processes 8
+#
+##############################################################################################
+
+import argparse
+import collections
+import glob
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
+import time
+import traceback
+
+import iris
+import numpy
+
+from .batch import run_script, script_settings
+from .grids import add_grid, load_grid
+from .regrid import prepare_source
+from .weights import add_to_cache, factors_key, load_factors
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8, workers will calculate their own weights
+    shared_memory = None
+
+# shared memory blocks attached by this (worker) process, kept here so they
+# stay open for as long as the weights are in use
+_ATTACHED = []
+
+
+def find_scripts(paths):
+    """Return the regrid scripts in *paths*, which are scripts or directories."""
+    scripts = []
+    for path in paths:
+        if os.path.isdir(path):
+            scripts.extend(sorted(glob.glob(os.path.join(path, '*.py'))))
+        else:
+            scripts.append(path)
+    return scripts
+
+
+def _share_array(array, blocks):
+    # copy array into a new shared memory block and describe it
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    blocks.append(shm)
+    view = numpy.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    view[...] = array
+    return (shm.name, array.shape, array.dtype.str)
+
+
+def _attach_array(spec):
+    name, shape, dtype = spec
+    try:
+        # the parent owns the block, so don't let this process's resource
+        # tracker remove it when the worker exits
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13
+        shm = shared_memory.SharedMemory(name=name)
+    _ATTACHED.append(shm)
+    array = numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=shm.buf)
+    array.flags.writeable = False
+    return array
+
+
+def share_weights(scripts, blocks):
+    """Set up the grids and weights needed by *scripts* for the workers.
+
+    Returns (grids, shared) where grids maps each grid file to its grid
+    cube and shared maps each weights cache key to the shared memory
+    description of its separable factors. New shared memory blocks are
+    appended to *blocks*, which the caller must close and unlink.
+    """
+    grids = {}
+    shared = {}
+    for path in scripts:
+        try:
+            settings = script_settings(path)
+        except SyntaxError:
+            continue
+        if not settings['regrids'] or 'grid_file' not in settings or \
+                'emissions_file' not in settings:
+            continue
+        try:
+            grid_file = settings['grid_file']
+            if grid_file not in grids:
+                grids[grid_file] = load_grid(grid_file)
+                # realise the (small) grid data so the workers never need
+                # to open the grid file
+                grids[grid_file].data
+            grid = grids[grid_file]
+            src = prepare_source(iris.load_cube(settings['emissions_file']),
+                                 grid)
+            key = factors_key(src, grid)
+        except Exception:
+            # leave it to the script to report the problem
+            continue
+        if key in shared:
+            continue
+        factors = load_factors(src, grid)
+        if shared_memory is not None:
+            shared[key] = [_share_array(factor, blocks) for factor in factors]
+    return grids, shared
+
+
+def output_directories(scripts, output_dir='.'):
+    """Return {script: directory to run it in} for *scripts*.
+
+    Each script runs in *output_dir*, unless another script writes a file
+    of the same name: then scripts ending in _greg.py and _360d.py run in
+    its greg and 360d directories. Raises a ValueError if scripts would
+    still write the same file.
+    """
+    directories = dict((path, output_dir) for path in scripts)
+    by_outpath = collections.defaultdict(list)
+    for path in scripts:
+        try:
+            outpath = script_settings(path).get('outpath')
+        except SyntaxError:
+            continue
+        if outpath is not None:
+            by_outpath[outpath].append(path)
+    for paths in by_outpath.values():
+        if len(paths) < 2:
+            continue
+        for path in paths:
+            for calendar in ('greg', '360d'):
+                if path.endswith('_{}.py'.format(calendar)):
+                    directories[path] = os.path.join(output_dir, calendar)
+
+    writers = collections.defaultdict(list)
+    for outpath, paths in by_outpath.items():
+        for path in paths:
+            writers[os.path.normpath(os.path.join(directories[path],
+                                                  outpath))].append(path)
+    clashes = sorted((outpath, paths) for outpath, paths in writers.items()
+                     if len(paths) > 1)
+    if clashes:
+        raise ValueError('Scripts would write the same file: {}'.format(
+            '; '.join('{} ({})'.format(outpath, ', '.join(paths))
+                      for outpath, paths in clashes)))
+    return directories
+
+
+def _init_worker(grids, shared):
+    for grid_file, grid in grids.items():
+        add_grid(grid_file, grid)
+    for key, specs in shared.items():
+        add_to_cache(key, tuple(_attach_array(spec) for spec in specs))
+
+
+def _run_job(path, directory):
+    start = time.time()
+    try:
+        os.chdir(directory)
+        run_script(path)
+        error = None
+    except BaseException:
+        error = traceback.format_exc()
+    return path, error, time.time() - start
+
+
+def _job_process(connection, path, directory, grids, shared):
+    # the body of a worker process, which runs one script
+    _init_worker(grids, shared)
+    connection.send(_run_job(path, directory))
+    connection.close()
+
+
+def _died(exitcode):
+    # the error of a worker that died without a result
+    if exitcode is not None and exitcode < 0:
+        try:
+            return 'The worker died: killed by {}.\n'.format(
+                signal.Signals(-exitcode).name)
+        except ValueError:
+            pass
+    return 'The worker died: exit code {}.\n'.format(exitcode)
+
+
+def run_pool(scripts, processes=None, output_dir=None):
+    """Run *scripts* across a pool of *processes* worker processes.
+
+    The output files are written to *output_dir* (by default the current
+    directory), or to its greg and 360d directories (see
+    output_directories). Each script runs in a worker process of its own,
+    so a worker that dies (e.g. killed for running out of memory) fails
+    only its own script.
+
+    Returns a list of (script, error, seconds) for every script, in the
+    order they finished; error is None for scripts that succeeded and the
+    traceback (or how the worker died) otherwise.
+    """
+    # the workers may run in another directory
+    scripts = [os.path.abspath(path) for path in scripts]
+    directories = output_directories(scripts,
+                                     os.path.abspath(output_dir or '.'))
+    for directory in set(directories.values()):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    processes = processes or os.cpu_count() or 1
+    # spawn fresh workers rather than forking this process, which may have
+    # netCDF/HDF5 files and dask threads open
+    context = multiprocessing.get_context('spawn')
+    blocks = []
+    results = []
+    pending = collections.deque(scripts)
+    running = {}
+    try:
+        grids, shared = share_weights(scripts, blocks)
+        while pending or running:
+            while pending and len(running) < processes:
+                path = pending.popleft()
+                reader, writer = context.Pipe(duplex=False)
+                process = context.Process(
+                    target=_job_process,
+                    args=(writer, path, directories[path], grids, shared))
+                process.start()
+                # so the reader sees the end of the pipe if the worker dies
+                writer.close()
+                running[reader] = (process, path, time.time())
+            for reader in multiprocessing.connection.wait(list(running)):
+                process, path, start = running.pop(reader)
+                try:
+                    result = reader.recv()
+                except EOFError:
+                    result = None
+                reader.close()
+                process.join()
+                if result is None:
+                    result = (path, _died(process.exitcode),
+                              time.time() - start)
+                results.append(result)
+    finally:
+        for reader, (process, path, start) in running.items():
+            process.terminate()
+            process.join()
+            reader.close()
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run regrid scripts across a pool of processes, sharing '
+                    'the target grids and regrid weights.')
+    parser.add_argument('paths', nargs='+',
+                        help='product directories and/or regrid scripts')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes (default: one per CPU)')
+    parser.add_argument('--output-dir', default=None,
+                        help='directory to write the output files to '
+                             '(default: the current directory)')
+    args = parser.parse_args(argv)
+
+    try:
+        results = run_pool(find_scripts(args.paths),
+                           processes=args.processes,
+                           output_dir=args.output_dir)
+    except ValueError as error:
+        parser.error(str(error))
+
+    failures = [result for result in results if result[1] is not None]
+    for path, error, seconds in sorted(results):
+        print('{:6} {:8.1f}s  {}'.format('FAILED' if error else 'ok',
+                                         seconds, path))
+    for path, error, seconds in sorted(failures):
+        sys.stderr.write('\nFAILED: {}\n{}'.format(path, error))
+    print('{} scripts, {} failed'.format(len(results), len(failures)))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
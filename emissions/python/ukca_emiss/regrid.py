@@ -0,0 +1,458 @@
+##############################################################################################
+#
+#  regrid.py
+#
+#  Area-weighted regridding of emissions cubes using the cached weights from
+#  weights.py. This gives the same answer as
+#      cube.regrid(grid, iris.analysis.AreaWeighted())
+#  but the overlap calculation is done once per pair of grids rather than once
+#  per script.
+#
+#  There are four engines:
+#    'separable' -- for rectilinear longitude-latitude grids (all the grids
+#                   used here) the regrid is wy @ field @ wx.T, i.e. two small
+#                   dense matrix multiplies per time step
+#    'sparse'    -- a sparse matrix multiply with the full cached weights
+#    'iris'      -- iris.analysis.AreaWeighted, for anything else
+#    'numba'     -- the separable regrid as a compiled kernel (kernel.py),
+#                   which also scales each time step (see scale below) and
+#                   writes the output type in the same pass; needs Numba
+#  By default the separable engine is used whenever the grids allow it. The
+#  UKCA_EMISS_ENGINE environment variable sets another default engine.
+#
+#  regrid(..., scale=...) multiplies each time step of the result by a
+#  factor, e.g. the month_length/30 calendar factor (calendars.py) times a
+#  molecular weight conversion. As the regrid is linear this is the same as
+#  scaling the source, but it is done on the (much smaller) regridded block
+#  before it is stored, or inside the kernel by the 'numba' engine.
+#
+#  The source longitudes don't need to be put on 0 to 360 first (with
+#  cube.intersection, which copies all the data): the weights take
+#  longitudes modulo 360, so the wrap is folded into them. Only the 'iris'
+#  engine still needs the intersection, which regrid() does for it.
+#
+#  A cube with lazy data (as from iris.load_cube) is regridded lazily: regrid()
+#  doesn't touch the data at all but returns a cube with lazy (dask) data,
+#  regridded chunk_size (by default CHUNK_SIZE) time steps at a time as it is
+#  written out (see output.save). Peak memory is then set by the chunk size
+#  rather than the length of the time series. The source is read on a
+#  separate thread, a chunk or two ahead of the regrid (see pipeline.py).
+#
+##############################################################################################
+
+import contextlib
+import copy
+import os
+import threading
+
+import dask.array
+import iris
+import iris.analysis
+import numpy
+
+from . import timing as _timing
+from . import weights as _weights
+from .kernel import fused_operator
+from .pipeline import read_ahead
+
+ENGINES = ('separable', 'sparse', 'iris', 'numba')
+
+# number of time steps (or other leading points) regridded at once, which
+# bounds the size of the float64 working arrays
+BLOCK_SIZE = 64
+
+# number of time steps read and regridded at a time when regridding lazily
+CHUNK_SIZE = 12
+
+_LATLON_SYSTEMS = (iris.coord_systems.GeogCS, iris.coord_systems.RotatedGeogCS)
+
+# the result regridded ahead of time for the script running in each thread
+# (see regridded_ahead)
+_ahead = threading.local()
+
+
+def _horizontal_dims(cube):
+    xdim, = cube.coord_dims(cube.coord(axis='x', dim_coords=True))
+    ydim, = cube.coord_dims(cube.coord(axis='y', dim_coords=True))
+    return xdim, ydim
+
+
+def check_grids(src_cube, grid_cube):
+    """Raise a ValueError if *src_cube* can't be regridded onto *grid_cube*."""
+    for cube in (src_cube, grid_cube):
+        for axis in ('x', 'y'):
+            if not cube.coords(axis=axis, dim_coords=True):
+                raise ValueError('Cube {!r} has no one-dimensional {} '
+                                 'coordinate.'.format(cube.name(), axis))
+    if src_cube.coord_system() != grid_cube.coord_system():
+        raise ValueError('The source and grid cubes must have the same '
+                         'coordinate system, got {!r} and {!r}.'
+                         .format(src_cube.coord_system(),
+                                 grid_cube.coord_system()))
+
+
+def is_rectilinear_latlon(cube):
+    """Return True if *cube* is on a rectilinear longitude-latitude grid.
+
+    That is, one-dimensional x and y coordinates in angular units, in a
+    (possibly rotated) geographic coordinate system.
+    """
+    for axis in ('x', 'y'):
+        coords = cube.coords(axis=axis, dim_coords=True)
+        if not coords or not coords[0].units.is_convertible('degrees'):
+            return False
+    cs = cube.coord_system()
+    return cs is None or isinstance(cs, _LATLON_SYSTEMS)
+
+
+def choose_engine(src_cube, grid_cube):
+    """Return the fastest engine that can regrid *src_cube* onto *grid_cube*."""
+    if is_rectilinear_latlon(src_cube) and is_rectilinear_latlon(grid_cube):
+        return 'separable'
+    return 'iris'
+
+
+def _separable_operator(factors):
+    wy, wx = factors
+
+    def operator(block):
+        # (n, ny_src, nx_src) -> (n, ny_tgt, nx_tgt), done as two large
+        # matrix multiplies over the whole block rather than two per step
+        n, ny_src, nx_src = block.shape
+        tmp = numpy.dot(block.reshape((n * ny_src, nx_src)), wx.T)
+        tmp = tmp.reshape((n, ny_src, -1)).transpose(1, 0, 2)
+        tmp = numpy.dot(wy, tmp.reshape((ny_src, -1)))
+        return tmp.reshape((wy.shape[0], n, -1)).transpose(1, 0, 2)
+    return operator
+
+
+def _sparse_operator(weights, tgt_shape):
+    def operator(block):
+        flat = block.reshape((block.shape[0], -1))
+        result = numpy.asarray(weights.dot(flat.T).T)
+        return result.reshape((block.shape[0],) + tuple(tgt_shape))
+    return operator
+
+
+def _dense_block(block):
+    # a masked array with nothing masked as a plain array, without a copy
+    if numpy.ma.isMaskedArray(block) and not numpy.ma.is_masked(block):
+        return block.data
+    return block
+
+
+def dense(data):
+    """Return *data* (a numpy or dask array) as plain arrays wherever it
+    has no masked points.
+
+    netCDF4, and so iris.load_cube, gives masked arrays even though the
+    emissions fields have no missing points. Only blocks with genuinely
+    missing data stay masked.
+    """
+    if isinstance(data, dask.array.Array):
+        meta = numpy.empty((0,) * data.ndim, dtype=data.dtype)
+        return data.map_blocks(_dense_block, dtype=data.dtype, meta=meta)
+    return _dense_block(data)
+
+
+def _block_factors(scale, lead):
+    # a float64 factor for each (y, x) field of a block with leading shape
+    # lead, from scale broadcastable to lead + (1, 1)
+    return numpy.broadcast_to(numpy.asarray(scale, dtype='float64'),
+                              tuple(lead) + (1, 1)).reshape(-1)
+
+
+@_timing.timed('regrid')
+def apply_weights(data, operator, tgt_shape, dtype=None, scale=None):
+    """Apply a regrid *operator* to the trailing (y, x) dimensions of *data*.
+
+    *operator* maps a float64 (n, ny_src, nx_src) array to the regridded
+    (n, ny_tgt, nx_tgt) array. Masked source points are left out of the
+    area-weighted mean and a target point is only masked if every source
+    point under it is masked, as with iris.analysis.AreaWeighted(mdtol=1).
+
+    The result is of type *dtype* if given: each block is regridded in
+    float64 and stored straight into it, with no separate cast afterwards.
+    If *scale* is given (broadcastable to *data* with its y and x dimensions
+    of length 1, e.g. one factor per time step) each regridded field is
+    multiplied by its factor before it is stored.
+
+    An operator with a fused kernel (the 'numba' engine) does the regrid,
+    the scaling and the cast in one pass unless the data are masked.
+    """
+    lead = data.shape[:-2]
+    stack = data.reshape((-1,) + data.shape[-2:])
+    masked = numpy.ma.isMaskedArray(stack) and numpy.ma.getmask(stack).any()
+    factors = _block_factors(1.0 if scale is None else scale, lead)
+
+    # keep the source precision, as iris does
+    if dtype is None:
+        dtype = _result_dtype(data.dtype)
+    result = numpy.empty((stack.shape[0],) + tuple(tgt_shape), dtype=dtype)
+
+    fused = getattr(operator, 'fused', None)
+    if fused is not None and not masked:
+        fused(numpy.asarray(stack), factors, result)
+        return result.reshape(lead + tuple(tgt_shape))
+
+    if masked:
+        result = numpy.ma.masked_array(result, mask=False)
+    for start in range(0, stack.shape[0], BLOCK_SIZE):
+        block = stack[start:start + BLOCK_SIZE]
+        if masked:
+            valid = (~numpy.ma.getmaskarray(block)).astype('float64')
+            total = operator(numpy.ma.filled(block, 0.0).astype('float64'))
+            coverage = operator(valid)
+            field = numpy.divide(total, coverage, out=numpy.zeros_like(total),
+                                 where=coverage > 0)
+            mask = coverage <= 0
+        else:
+            field = operator(numpy.asarray(block, dtype='float64'))
+        if scale is not None:
+            field *= factors[start:start + BLOCK_SIZE, numpy.newaxis,
+                             numpy.newaxis]
+        result[start:start + BLOCK_SIZE] = \
+            numpy.ma.masked_array(field, mask=mask) if masked else field
+
+    return result.reshape(lead + tuple(tgt_shape))
+
+
+def regridded_cube(src_cube, grid_cube, data):
+    """Return a new cube holding *data* on the horizontal grid of *grid_cube*.
+
+    The metadata and all non-horizontal coordinates are taken from
+    *src_cube*, the horizontal coordinates from *grid_cube*. *data* must
+    have the same dimension order as *src_cube*.
+    """
+    xdim, ydim = _horizontal_dims(src_cube)
+    result = iris.cube.Cube(data)
+    result.metadata = copy.deepcopy(src_cube.metadata)
+
+    for coord in src_cube.dim_coords:
+        dim, = src_cube.coord_dims(coord)
+        if dim not in (xdim, ydim):
+            result.add_dim_coord(coord.copy(), dim)
+    for coord in src_cube.aux_coords:
+        dims = src_cube.coord_dims(coord)
+        if xdim not in dims and ydim not in dims:
+            result.add_aux_coord(coord.copy(), dims)
+
+    result.add_dim_coord(grid_cube.coord(axis='x', dim_coords=True).copy(), xdim)
+    result.add_dim_coord(grid_cube.coord(axis='y', dim_coords=True).copy(), ydim)
+    return result
+
+
+def prepare_source(cube, grid):
+    """Return *cube* ready to be regridded onto *grid*.
+
+    This is the same preparation as done in the regrid scripts: the
+    coordinate system is taken from the grid and the horizontal bounds are
+    guessed. The longitudes are left as they are, as the regrid weights
+    wrap them (see weights.lon_overlaps).
+    """
+    # a new cube, sharing the (possibly lazy) data of cube
+    nems = cube.copy(data=cube.core_data())
+    nems.coord(axis='x').coord_system = grid.coord_system()
+    nems.coord(axis='y').coord_system = grid.coord_system()
+    nems.coord(axis='x').guess_bounds()
+    nems.coord(axis='y').guess_bounds()
+    return nems
+
+
+def select_engine(cube, grid, engine=None):
+    """Return *engine*, or if it is None the engine set by the
+    UKCA_EMISS_ENGINE environment variable or else the one to use for these
+    grids."""
+    if engine is None:
+        engine = os.environ.get('UKCA_EMISS_ENGINE') or \
+            choose_engine(cube, grid)
+    if engine not in ENGINES:
+        raise ValueError('Unknown regrid engine {!r}, expected one of {}.'
+                         .format(engine, ', '.join(ENGINES)))
+    return engine
+
+
+def target_shape(grid):
+    """Return the (ny, nx) shape of the horizontal grid of *grid*."""
+    gxdim, gydim = _horizontal_dims(grid)
+    return (grid.shape[gydim], grid.shape[gxdim])
+
+
+@_timing.timed('weights')
+def build_operator(cube, grid, engine):
+    """Return the regrid operator used by apply_weights for *engine*."""
+    check_grids(cube, grid)
+    if engine == 'separable':
+        return _separable_operator(_weights.load_factors(cube, grid))
+    if engine == 'numba':
+        # the plain operator is still used for masked blocks
+        factors = _weights.load_factors(cube, grid)
+        operator = _separable_operator(factors)
+        operator.fused = fused_operator(factors)
+        return operator
+    return _sparse_operator(_weights.load_weights(cube, grid),
+                            target_shape(grid))
+
+
+def yx_last(cube):
+    """Return the dimension order that puts (y, x) last in *cube*."""
+    xdim, ydim = _horizontal_dims(cube)
+    order = [dim for dim in range(cube.ndim) if dim not in (ydim, xdim)]
+    return order + [ydim, xdim]
+
+
+@contextlib.contextmanager
+def regridded_ahead(result):
+    """Make the first call of regrid() in the with block return *result*,
+    regridded ahead of time (e.g. by batch.regrid_stack), rather than
+    regrid its cube. That call raises a ValueError if *result* isn't the
+    regrid of its cube onto its grid."""
+    previous = getattr(_ahead, 'result', None)
+    _ahead.result = result
+    try:
+        yield
+    finally:
+        _ahead.result = previous
+
+
+def _check_ahead(result, cube, grid):
+    # raise a ValueError unless result fits the regrid of cube onto grid
+    expected = list(cube.shape)
+    xdim, ydim = _horizontal_dims(cube)
+    expected[ydim], expected[xdim] = target_shape(grid)
+    if list(result.shape) != expected:
+        raise ValueError('The result regridded ahead of time has shape {}, '
+                         'but the regrid of {!r} has shape {}.'.format(
+                             result.shape, cube.name(), tuple(expected)))
+    if result.coords(axis='t') != cube.coords(axis='t'):
+        raise ValueError('The result regridded ahead of time has other time '
+                         'points than {!r}.'.format(cube.name()))
+
+
+def _result_dtype(dtype):
+    return dtype if numpy.issubdtype(dtype, numpy.floating) \
+        else numpy.dtype('float64')
+
+
+def _scaled_block(block, scale, operator, tgt_shape, dtype):
+    return apply_weights(block, operator, tgt_shape, dtype, scale)
+
+
+def _lazy_regrid(data, operator, tgt_shape, chunk_size, dtype=None,
+                 scale=None):
+    # data is a dask array with (y, x) last; regrid it chunk_size steps of the
+    # first dimension at a time
+    chunks = dict((dim, chunk_size if dim == 0 else -1)
+                  for dim in range(data.ndim))
+    data = data.rechunk(chunks)
+    dtype = numpy.dtype(dtype or _result_dtype(data.dtype))
+    # the result is a plain array unless a block has missing points, when
+    # that block alone is masked
+    meta = numpy.empty((0,) * data.ndim, dtype=dtype)
+    out_chunks = data.chunks[:-2] + ((tgt_shape[0],), (tgt_shape[1],))
+    # (dtype is passed on to apply_weights, as well as given to dask)
+    if scale is None:
+        return data.map_blocks(apply_weights, operator, tgt_shape, dtype,
+                               dtype=dtype, chunks=out_chunks, meta=meta)
+    # the factors are chunked like the data, so each block gets its own
+    scale = numpy.broadcast_to(numpy.asarray(scale, dtype='float64'),
+                               data.shape[:-2] + (1, 1))
+    scale = dask.array.from_array(scale, chunks=data.chunks[:-2] + (1, 1))
+    return dask.array.map_blocks(_scaled_block, data, scale, operator,
+                                 tgt_shape, dtype, dtype=dtype,
+                                 chunks=out_chunks, meta=meta)
+
+
+def _time_factors(cube, scale, order=None):
+    # scale (a number, or a factor for each time step) shaped to broadcast
+    # against the data of cube, or against them in the dimension order
+    # order
+    scale = numpy.asarray(scale, dtype='float64')
+    if scale.ndim == 0:
+        return scale
+    dim, = cube.coord_dims(cube.coord(axis='t', dim_coords=True))
+    if scale.shape != (cube.shape[dim],):
+        raise ValueError('Expected a scale factor for each of the {} time '
+                         'steps, got shape {}.'.format(cube.shape[dim],
+                                                       scale.shape))
+    shape = [1] * cube.ndim
+    shape[dim if order is None else list(order).index(dim)] = -1
+    return scale.reshape(shape)
+
+
+def _scale_result(result, factors, dtype):
+    # the already regridded result times factors, of type dtype
+    data = result.core_data()
+    dtype = dtype or data.dtype
+    if factors is not None:
+        data = data * factors
+    result.data = data.astype(dtype)
+    return result
+
+
+def regrid(cube, grid, engine=None, chunk_size=None, dtype=None, scale=None):
+    """Area-weighted regrid of *cube* onto the horizontal grid of *grid*.
+
+    Both cubes need bounded, one-dimensional x and y coordinates in the same
+    coordinate system. *engine* is one of ENGINES, by default the fastest
+    one that suits the grids (see choose_engine).
+
+    If *cube* has lazy data or *chunk_size* is given, the result has lazy
+    data which is read and regridded *chunk_size* (by default CHUNK_SIZE)
+    time steps at a time when it is needed.
+
+    The regridded data are of type *dtype* (e.g. 'float32', as written to
+    the files) if given, otherwise of the source type; the regrid itself is
+    always done in float64.
+
+    *scale* is a number, or one number for each time step, that the
+    regridded data are multiplied by (in float64, before any cast to
+    *dtype*), e.g. calendars.calendar_factors(time_coord).
+
+    In a regridded_ahead(result) block, the first call returns result
+    (scaled and cast as asked) instead.
+    """
+    factors = None if scale is None else _time_factors(cube, scale)
+    result = getattr(_ahead, 'result', None)
+    if result is not None:
+        _ahead.result = None
+        _check_ahead(result, cube, grid)
+        if dtype is not None or factors is not None:
+            result = _scale_result(result, factors, dtype)
+        return result
+
+    engine = select_engine(cube, grid, engine)
+    if engine == 'iris':
+        if cube.coords('longitude', dim_coords=True):
+            # AreaWeighted doesn't wrap longitudes itself
+            cube = cube.intersection(longitude=(0, 360))
+        with _timing.stage('regrid'):
+            result = cube.regrid(grid, iris.analysis.AreaWeighted())
+        if dtype is not None or factors is not None:
+            result = _scale_result(result, factors, dtype)
+        return result
+    operator = build_operator(cube, grid, engine)
+    tgt_shape = target_shape(grid)
+
+    # put (y, x) last, regrid, then put the dimensions back in place
+    order = yx_last(cube)
+    if scale is not None:
+        factors = _time_factors(cube, scale, order)
+    if not chunk_size and cube.has_lazy_data():
+        chunk_size = CHUNK_SIZE
+    if chunk_size:
+        data = cube.lazy_data()
+        if order[0] == 0:
+            # read each chunk while the one before is regridded; this goes
+            # before dense(), which would otherwise read whole file chunks
+            # for each time chunk
+            data = read_ahead(data, chunk_size)
+        data = dense(data).transpose(order)
+        result = _lazy_regrid(data, operator, tgt_shape, chunk_size, dtype,
+                              factors)
+    else:
+        data = dense(cube.data).transpose(order)
+        result = apply_weights(data, operator, tgt_shape, dtype, factors)
+    result = result.transpose(tuple(numpy.argsort(order)))
+
+    return regridded_cube(cube, grid, result)
@@ -0,0 +1,112 @@
+##############################################################################################
+#
+#  report.py
+#
+#  Merging the run reports written with UKCA_EMISS_REPORT set (see
+#  timing.py) into one table: one row per run, with its wall and CPU time,
+#  peak memory, I/O and the wall time of each stage, and a total row with
+#  each stage's share of the time of all the runs.
+#
+#  Usage (from emissions/python):
+#      python -m ukca_emiss.report /path/to/reports [--csv table.csv]
+#
+##############################################################################################
+
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+
+from .timing import ENV_VAR, STAGES
+
+
+def load_reports(paths):
+    """Return the reports in *paths*, which are report files or
+    directories of them."""
+    reports = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(glob.glob(os.path.join(path, '*.json')))
+        else:
+            files = [path]
+        for name in files:
+            with open(name) as infile:
+                reports.append(json.load(infile))
+    return reports
+
+
+def _product(report):
+    return ' '.join(os.path.relpath(output['path'])
+                    for output in report['outputs'])
+
+
+def table(reports):
+    """Return the rows (lists) of the table of *reports*, a header row and
+    then one row per report and a total row."""
+    header = ['product', 'species', 'wall', 'cpu', 'peak_rss', 'read_MB',
+              'written_MB', 'in_MB', 'out_MB']
+    header += ['{}_wall'.format(name) for name in STAGES]
+    rows = [header]
+    totals = [0.0] * (len(header) - 2)
+    for report in sorted(reports, key=_product):
+        inputs = sum(item['bytes'] or 0 for item in report['inputs'])
+        outputs = sum(item['bytes'] or 0 for item in report['outputs'])
+        values = [report['wall'], report['cpu'], report['peak_rss'],
+                  report['read'] / 1e6, report['written'] / 1e6,
+                  inputs / 1e6, outputs / 1e6]
+        values += [report['stages'].get(name, {}).get('wall', 0.0)
+                   for name in STAGES]
+        rows.append([_product(report), ' '.join(report['species'])] +
+                    values)
+        totals = [total + value for total, value in zip(totals, values)]
+    # the peak over all the runs rather than the sum
+    totals[2] = max([row[4] for row in rows[1:]] or [0.0])
+    rows.append(['total ({} runs)'.format(len(reports)), ''] + totals)
+    return rows
+
+
+def format_table(rows):
+    """Return *rows* (from table) as text, with each stage's share of the
+    total wall time."""
+    widths = [max(len(str(row[0])) for row in rows), 10]
+    lines = []
+    for number, row in enumerate(rows):
+        cells = [str(row[0]).ljust(widths[0]), str(row[1])[:10].ljust(10)]
+        for value in row[2:]:
+            cells.append('{:>10}'.format(value if number == 0
+                                         else '{:.1f}'.format(value)))
+        lines.append(' '.join(cells))
+    total = rows[-1]
+    if total[2]:
+        shares = ', '.join('{} {:.0f}%'.format(name, 100 * value / total[2])
+                           for name, value in zip(STAGES, total[9:]))
+        lines.append('share of the wall time: ' + shares)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Merge the run reports written with {} set into one '
+                    'table.'.format(ENV_VAR))
+    parser.add_argument('paths', nargs='+',
+                        help='report files and/or directories of them')
+    parser.add_argument('--csv', default=None,
+                        help='also write the table to this CSV file')
+    args = parser.parse_args(argv)
+
+    reports = load_reports(args.paths)
+    if not reports:
+        sys.stderr.write('No reports found.\n')
+        return 1
+    rows = table(reports)
+    print(format_table(rows))
+    if args.csv:
+        with open(args.csv, 'w') as outfile:
+            csv.writer(outfile).writerows(rows)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,348 @@
+##############################################################################################
+#
+#  store.py
+#
+#  The emission totals of the csv/v1 zip archives (and any made with
+#  totals.py) as one indexed, columnar table, with a query API.
+#
+#  Each row is the total (kg) of a species, sector, calendar, year and
+#  month (0 for the annual tables). The index, which zip member holds which
+#  (species, sector, calendar, period), is made from the zip directories
+#  alone; a zip's tables are only read and parsed the first time one of them
+#  is asked for, into numpy columns (year, month, kg) that are kept in
+#  memory and, keyed by the size and time of the zip file, in the cache
+#  directory of the regrid weights (see weights.py). Later processes load
+#  the parsed columns instead of parsing the text again. Queries select
+#  the tables from the index and the rows with numpy masks; aggregations
+#  sum the selected rows by any of the columns with numpy.bincount.
+#
+#  The csv/v1 totals are the same for both calendars (the 360_day fluxes
+#  are scaled by month_length/30 and summed over 30-day months) and have
+#  the Gregorian years and months, so they are given calendar 'gregorian';
+#  totals of a 360_day file added with TotalsStore.add are '360_day'.
+#
+#  For example, NOx against the biomass burning of every species in 1997
+#  and 2015:
+#      store = TotalsStore()
+#      store.aggregate(by=('species', 'year'), sector='bioburn',
+#                      years=(1997, 2015), period='annual')
+#  or from emissions/python:
+#      python -m ukca_emiss.store --sector bioburn --years 1997 2015 --period annual --by species year
+#
+##############################################################################################
+
+import argparse
+import glob
+import hashlib
+import os
+import re
+import sys
+import tempfile
+import zipfile
+
+import numpy
+
+from .audit import CSV_DIR
+from .totals import annual_totals, read_csv_totals
+from .weights import cache_dir
+
+# bump this if the parsed columns change, so old cache files are ignored
+STORE_VERSION = 2
+
+# the columns of a query, in order
+COLUMNS = ('species', 'sector', 'calendar', 'year', 'month', 'kg')
+
+PERIODS = ('monthly', 'annual')
+
+# the calendar of the csv/v1 totals (see above)
+CSV_CALENDAR = 'gregorian'
+
+_MEMBER = re.compile(r'^(?P<species>.+?)_(?P<period>monthly|annual)'
+                     r'(_(?P<sector>.+))?\.csv$')
+
+
+def _member_key(archive, member):
+    # (species, sector, period) of a member of a csv/v1 zip file, or None;
+    # the species is the member's own, which may be a product of the zip
+    # file's species (e.g. C2H6_lumped or CH3OH_as_C)
+    species = re.sub(r'(_\d{8})?\.zip$', '', os.path.basename(archive))
+    match = _MEMBER.match(member)
+    if not match or not (match.group('species') == species or
+                         match.group('species').startswith(species + '_')):
+        return None
+    # aircraft_NO_annual.csv has no sector, as written by totals.py
+    sector = match.group('sector') or 'aircraft'
+    return match.group('species'), sector, match.group('period')
+
+
+def _parse(archive, member):
+    # the (year, month, kg) columns of a table
+    totals = read_csv_totals(archive, member)
+    keys = sorted(totals)
+    years = numpy.array([key[0] if isinstance(key, tuple) else key
+                         for key in keys], dtype='int16')
+    months = numpy.array([key[1] if isinstance(key, tuple) else 0
+                          for key in keys], dtype='int8')
+    kg = numpy.array([totals[key] for key in keys], dtype='float64')
+    return years, months, kg
+
+
+class TotalsStore(object):
+    """The emission totals of the zip archives in *directory* (by default
+    csv/v1), indexed by species, sector, calendar and period ('monthly' or
+    'annual'). The tables are read when first needed; with *cache* True
+    their parsed columns are also kept on disk. The (archive, member) of
+    any zip members that aren't tables of totals are in skipped."""
+
+    def __init__(self, directory=CSV_DIR, cache=True):
+        self.cache = cache
+        self.skipped = []
+        # (species, sector, calendar, period) -> (archive, member)
+        self._index = {}
+        # (species, sector, calendar, period) -> (year, month, kg)
+        self._columns = {}
+        for archive in sorted(glob.glob(os.path.join(directory, '*.zip'))):
+            with zipfile.ZipFile(archive) as zipped:
+                names = zipped.namelist()
+            for member in names:
+                key = _member_key(archive, member)
+                if key is None:
+                    self.skipped.append((archive, member))
+                    continue
+                species, sector, period = key
+                self._index[(species, sector, CSV_CALENDAR, period)] = \
+                    (archive, member)
+
+    def keys(self, species=None, sector=None, calendar=None, period=None):
+        """Return the sorted (species, sector, calendar, period) of the tables
+        that match; each argument is a value or a list of them, None for
+        any."""
+        wanted = [_values(value) for value in (species, sector, calendar,
+                                               period)]
+        return sorted(key for key in set(self._index) | set(self._columns)
+                      if all(values is None or part in values
+                             for part, values in zip(key, wanted)))
+
+    @property
+    def species(self):
+        return sorted(set(key[0] for key in self.keys()))
+
+    def sectors(self, species=None):
+        """Return the sectors (of *species*, or of any species)."""
+        return sorted(set(key[1] for key in self.keys(species=species)))
+
+    def add(self, species, sector, totals):
+        """Add the monthly and annual *totals* (from totals.global_totals) of
+        *species* and *sector*, replacing any with the same calendar."""
+        calendar = totals['calendar']
+        if calendar in ('standard', 'proleptic_gregorian'):
+            calendar = 'gregorian'
+        self._columns[(species, sector, calendar, 'monthly')] = (
+            numpy.array([date[0] for date in totals['dates']], dtype='int16'),
+            numpy.array([date[1] for date in totals['dates']], dtype='int8'),
+            numpy.asarray(totals['kg'], dtype='float64'))
+        years = annual_totals(totals)
+        self._columns[(species, sector, calendar, 'annual')] = (
+            numpy.array(sorted(years), dtype='int16'),
+            numpy.zeros(len(years), dtype='int8'),
+            numpy.array([years[year] for year in sorted(years)]))
+
+    def table(self, key):
+        """Return the (year, month, kg) columns of the table *key*, a
+        (species, sector, calendar, period)."""
+        if key not in self._columns:
+            self._load(self._index[key][0])
+        return self._columns[key]
+
+    def _load(self, archive):
+        # parse all the tables of archive, or load them from the cache
+        keys = [key for key, (path, member) in self._index.items()
+                if path == archive and key not in self._columns]
+        filename = self._cache_file(archive) if self.cache else None
+        if filename and os.path.exists(filename):
+            with numpy.load(filename) as cached:
+                for key in keys:
+                    name = '/'.join(key)
+                    self._columns[key] = tuple(
+                        cached['{}/{}'.format(name, column)]
+                        for column in ('year', 'month', 'kg'))
+            return
+        arrays = {}
+        for key in keys:
+            self._columns[key] = _parse(*self._index[key])
+            for column, values in zip(('year', 'month', 'kg'),
+                                      self._columns[key]):
+                arrays['{}/{}'.format('/'.join(key), column)] = values
+        if filename:
+            _save_columns(arrays, filename)
+
+    def _cache_file(self, archive):
+        status = os.stat(archive)
+        text = '{} {} {} {}'.format(os.path.abspath(archive), status.st_size,
+                                    status.st_mtime, STORE_VERSION)
+        key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        return os.path.join(cache_dir(), 'totals_{}.npz'.format(key))
+
+    def _select(self, species=None, sector=None, calendar=None,
+                period='monthly', years=None, months=None):
+        # (key, year, month, kg) of each table that matches, with the rows
+        # that match
+        for key in self.keys(species, sector, calendar, period):
+            year, month, kg = self.table(key)
+            if years is not None or months is not None:
+                mask = numpy.ones(len(kg), dtype=bool)
+                if years is not None:
+                    mask &= numpy.isin(year, _values(years))
+                if months is not None:
+                    mask &= numpy.isin(month, _values(months))
+                year, month, kg = year[mask], month[mask], kg[mask]
+            yield key, year, month, kg
+
+    def query(self, species=None, sector=None, calendar=None, period='monthly',
+              years=None, months=None):
+        """Return the rows that match as a dict of COLUMNS (numpy arrays).
+
+        *species*, *sector*, *calendar*, *years* and *months* are each a
+        value or a list of them (None for any); *period* is 'monthly' or
+        'annual' (whose rows have month 0).
+        """
+        parts = dict((column, []) for column in COLUMNS)
+        for key, year, month, kg in self._select(species, sector, calendar,
+                                                 period, years, months):
+            for column, value in zip(COLUMNS[:3], key[:3]):
+                parts[column].append(numpy.repeat(numpy.array(value),
+                                                  len(kg)))
+            for column, values in zip(COLUMNS[3:], (year, month, kg)):
+                parts[column].append(values)
+        result = {}
+        for column in COLUMNS:
+            if parts[column]:
+                result[column] = numpy.concatenate(parts[column])
+            else:
+                result[column] = numpy.array(
+                    [], dtype='float64' if column == 'kg' else 'U1'
+                    if column in COLUMNS[:3] else 'int16')
+        return result
+
+    def aggregate(self, by=('species',), **filters):
+        """Return {group: kg} of the rows selected by *filters* (as for
+        query), summed by the columns *by*; each group is a tuple of their
+        values."""
+        selected = list(self._select(**filters))
+        if not selected:
+            return {}
+        # each column as codes into its sorted values: species, sector and
+        # calendar are the same for a whole table
+        uniques = []
+        codes = []
+        for column in by:
+            if column in COLUMNS[:3]:
+                part = COLUMNS.index(column)
+                values = sorted(set(key[part] for key, year, month, kg
+                                    in selected))
+                lookup = dict((value, code)
+                              for code, value in enumerate(values))
+                codes.append(numpy.concatenate([
+                    numpy.full(len(kg), lookup[key[part]], dtype='intp')
+                    for key, year, month, kg in selected]))
+                uniques.append(values)
+            else:
+                position = COLUMNS.index(column) - 2
+                column_values = numpy.concatenate(
+                    [table[position] for table in selected]).astype('intp')
+                values, inverse = numpy.unique(column_values,
+                                               return_inverse=True)
+                codes.append(inverse.ravel())
+                uniques.append(values.tolist())
+        kg = numpy.concatenate([table[3] for table in selected])
+        shape = tuple(len(values) for values in uniques)
+        flat = numpy.ravel_multi_index(codes, shape) if codes else \
+            numpy.zeros(len(kg), dtype='intp')
+        size = int(numpy.prod(shape))
+        sums = numpy.bincount(flat, weights=kg, minlength=size)
+        present = numpy.bincount(flat, minlength=size) > 0
+        result = {}
+        for index in numpy.nonzero(present)[0]:
+            positions = numpy.unravel_index(index, shape)
+            group = tuple(values[position]
+                          for values, position in zip(uniques, positions))
+            result[group] = float(sums[index])
+        return result
+
+    def value(self, species, sector, year, month=0, calendar=CSV_CALENDAR):
+        """Return the total (kg) of one month (or year, for month 0)."""
+        period = 'annual' if not month else 'monthly'
+        years, months, kg = self.table((species, sector, calendar, period))
+        found = numpy.nonzero((years == year) & (months == month))[0]
+        if not len(found):
+            raise KeyError((species, sector, calendar, year, month))
+        return float(kg[found[0]])
+
+
+def _values(value):
+    # a query value as a list, or None for any
+    if value is None:
+        return None
+    if isinstance(value, (str, int, numpy.integer)):
+        return [value]
+    return list(value)
+
+
+def _save_columns(arrays, filename):
+    directory = os.path.dirname(filename)
+    tmpname = None
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # written to a temporary file and renamed into place, as for the
+        # weights, so other processes never see a partial file
+        fd, tmpname = tempfile.mkstemp(suffix='.npz', dir=directory)
+        os.close(fd)
+        with open(tmpname, 'wb') as outfile:
+            numpy.savez(outfile, **arrays)
+        os.rename(tmpname, filename)
+    except (IOError, OSError):
+        # a read-only or full cache directory only costs the parsing
+        if tmpname is not None and os.path.exists(tmpname):
+            os.remove(tmpname)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Query the emission totals of the csv/v1 zip archives.')
+    parser.add_argument('--directory', default=CSV_DIR,
+                        help='directory of the zip archives '
+                             '(default: %(default)s)')
+    parser.add_argument('--species', nargs='+', default=None)
+    parser.add_argument('--sector', nargs='+', default=None)
+    parser.add_argument('--calendar', nargs='+', default=None)
+    parser.add_argument('--period', choices=PERIODS, default='annual')
+    parser.add_argument('--years', nargs='+', type=int, default=None)
+    parser.add_argument('--months', nargs='+', type=int, default=None)
+    parser.add_argument('--by', nargs='+', choices=COLUMNS[:5],
+                        default=['species', 'sector', 'year', 'month'],
+                        help='columns to sum by (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't keep the parsed tables on disk")
+    args = parser.parse_args(argv)
+
+    store = TotalsStore(args.directory, cache=not args.no_cache)
+    for archive, member in store.skipped:
+        sys.stderr.write('{}: skipped {}, not a table of totals\n'.format(
+            archive, member))
+    result = store.aggregate(by=args.by, species=args.species,
+                             sector=args.sector, calendar=args.calendar,
+                             period=args.period, years=args.years,
+                             months=args.months)
+    if not result:
+        sys.stderr.write('No totals found.\n')
+        return 1
+    print(' '.join(args.by + ['kg']))
+    for group in sorted(result):
+        print(' '.join(str(value) for value in group) +
+              ' {:.8g}'.format(result[group]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
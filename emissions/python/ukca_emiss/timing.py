@@ -0,0 +1,250 @@
+##############################################################################################
+#
+#  timing.py
+#
+#  Run reports: where the time of a regrid script goes.
+#
+#  If the UKCA_EMISS_REPORT environment variable is set to a directory,
+#  each script (run on its own or by batch, pool, calendars or fanout)
+#  writes a JSON report there when its file has been written (one report
+#  for the files written together by a batch group, fanout or calendar
+#  pair), with the script, species, input and output files and their
+#  sizes. The first report of a process covers it from the start, so its
+#  wall, cpu and I/O include starting Python and importing Iris; a later
+#  one (e.g. of the next batch group) starts where the one before ended.
+#  For each stage of the regrid path it gives:
+#    wall, cpu        -- seconds (cpu is that of the thread doing the work)
+#    read, written    -- bytes read and written by the process meanwhile
+#                        (from /proc/self/io, so other threads' I/O counts)
+#    peak_rss         -- peak resident memory of the process so far (MB)
+#    calls            -- the number of times the stage ran
+#  The stages are
+#    load      -- everything before the first of the other stages: for a
+#                 script run on its own, starting Python, the imports and
+#                 the script's iris.load_cube of its source (which reads
+#                 the metadata; its data are read in the read stage)
+#    grid      -- loading or generating the target grid (grids.load_grid)
+#    weights   -- reading or calculating the regrid weights
+#    read      -- reading the source chunks ahead of the regrid (pipeline.py)
+#    regrid    -- applying the weights
+#    assemble  -- making the (t, 1, y, x) cube (add_level_axis)
+#    write     -- writing the netCDF file
+#    save      -- the whole of ukca_emiss.save; with lazy data this includes
+#                 the reading, regridding and writing of every chunk
+#  With the lazy scripts, read, regrid and write run in different threads
+#  at the same time (see pipeline.py), so their wall times overlap.
+#
+#  The reports of many runs are merged into one table by report.py.
+#
+##############################################################################################
+
+import contextlib
+import functools
+import json
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+
+# the environment variable naming the directory to write reports to
+ENV_VAR = 'UKCA_EMISS_REPORT'
+
+STAGES = ('load', 'grid', 'weights', 'read', 'regrid', 'assemble', 'write',
+          'save')
+
+# the report being collected by this process, if any
+_current = None
+_lock = threading.Lock()
+
+# where the next report starts, as (time, process cpu, (read, written)),
+# or None for the start of the process
+_since = None
+
+# when this module was imported, if the start of the process isn't known
+_IMPORTED = time.time()
+
+
+def report_dir():
+    """Return the directory reports are written to, or None if reports are
+    turned off."""
+    return os.environ.get(ENV_VAR) or None
+
+
+def _io_counters():
+    # (bytes read, bytes written) by this process, through any file
+    counters = {}
+    try:
+        with open('/proc/self/io') as infile:
+            for line in infile:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    except (IOError, OSError, ValueError):
+        return 0, 0
+    return counters.get('rchar', 0), counters.get('wchar', 0)
+
+
+def _peak_rss():
+    # in MB; ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _process_started():
+    # when this process started, by time.time()
+    try:
+        with open('/proc/self/stat') as infile:
+            # the fields after the command name, which may hold spaces;
+            # the start time (in clock ticks after boot) is the 22nd field
+            fields = infile.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as infile:
+            uptime = float(infile.read().split()[0])
+        age = uptime - int(fields[19]) / float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, ValueError, IndexError):
+        return _IMPORTED
+    return time.time() - age
+
+
+def _snapshot():
+    return time.time(), time.process_time(), _io_counters()
+
+
+def _new_report():
+    started, cpu, io = _since or (_process_started(), 0.0, (0, 0))
+    report = {'started': started, 'cpu_start': cpu, 'io_start': io,
+              'host': socket.gethostname(), 'pid': os.getpid(),
+              # as it may be relative, and scripts may change directory
+              'directory': os.path.abspath(report_dir()), 'stages': {},
+              'outputs': [], 'species': [], 'scripts': [], 'inputs': []}
+    # the time up to the first stage, which starts the report
+    now, now_cpu, (read, written) = _snapshot()
+    report['stages']['load'] = {
+        'wall': now - started, 'cpu': now_cpu - cpu, 'read': read - io[0],
+        'written': written - io[1], 'calls': 1, 'peak_rss': _peak_rss()}
+    return report
+
+
+def _current_report():
+    # the current report, started if need be; call with _lock held
+    global _current
+    if _current is None:
+        _current = _new_report()
+    return _current
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Time the code in the with block as the stage *name* of the current
+    report, if reports are turned on."""
+    if report_dir() is None:
+        yield
+        return
+    wall = time.time()
+    cpu = time.thread_time()
+    read, written = _io_counters()
+    try:
+        yield
+    finally:
+        end_read, end_written = _io_counters()
+        values = {'wall': time.time() - wall,
+                  'cpu': time.thread_time() - cpu,
+                  'read': end_read - read, 'written': end_written - written}
+        with _lock:
+            totals = _current_report()['stages'].setdefault(
+                name, dict((key, 0) for key in values))
+            for key, value in values.items():
+                totals[key] += value
+            totals['calls'] = totals.get('calls', 0) + 1
+            totals['peak_rss'] = _peak_rss()
+
+
+def _file_info(path):
+    path = os.path.abspath(path)
+    size = os.path.getsize(path) if os.path.isfile(path) else None
+    return {'path': path, 'bytes': size}
+
+
+def _script_info():
+    # the script being run and its input files: runpy (as used by batch)
+    # makes the running script __main__, whose globals are its settings
+    main = sys.modules.get('__main__')
+    script = getattr(main, '__file__', None)
+    inputs = []
+    for name in ('emissions_file', 'grid_file'):
+        value = getattr(main, name, None)
+        if isinstance(value, str) and os.path.isfile(value):
+            inputs.append(os.path.abspath(value))
+    return script and os.path.abspath(script), inputs
+
+
+def timed(name):
+    """Return a decorator timing each call of a function as the stage
+    *name* (see stage)."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_output(path, cube):
+    """Add the file *path*, written from *cube* by the running script, to
+    the current report."""
+    if report_dir() is None:
+        return
+    script, inputs = _script_info()
+    with _lock:
+        report = _current_report()
+        report['outputs'].append({'path': os.path.abspath(path),
+                                  'shape': list(cube.shape),
+                                  'dtype': str(cube.dtype)})
+        species = cube.attributes.get('tracer_name') or cube.var_name
+        if species and species not in report['species']:
+            report['species'].append(species)
+        if script and script not in report['scripts']:
+            report['scripts'].append(script)
+        for name in inputs:
+            if name not in report['inputs']:
+                report['inputs'].append(name)
+
+
+def discard():
+    """Drop the current report, e.g. of a script that failed."""
+    global _current, _since
+    with _lock:
+        _current = None
+        _since = _snapshot()
+
+
+def finish():
+    """Write the current report, if reports are turned on and a file has
+    been written, and start a new one. Returns the report's path."""
+    global _current, _since
+    with _lock:
+        report, _current = _current, None
+        if report is not None:
+            _since = _snapshot()
+    if report is None or not report['outputs']:
+        return None
+    directory = report.pop('directory')
+    read, written = _io_counters()
+    start_read, start_written = report.pop('io_start')
+    report['wall'] = time.time() - report['started']
+    report['cpu'] = time.process_time() - report.pop('cpu_start')
+    report['read'] = read - start_read
+    report['written'] = written - start_written
+    report['peak_rss'] = _peak_rss()
+    report['inputs'] = [_file_info(name) for name in report['inputs']]
+    for output in report['outputs']:
+        output.update(_file_info(output['path']))
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    name = os.path.splitext(os.path.basename(report['outputs'][0]['path']))[0]
+    path = os.path.join(directory, '{}.{}.{}.{}.json'.format(
+        name, report['host'], report['pid'], int(report['started'] * 1000)))
+    with open(path, 'w') as outfile:
+        json.dump(report, outfile, indent=1, sort_keys=True)
+    return path
@@ -0,0 +1,405 @@
+##############################################################################################
+#
+#  totals.py
+#
+#  Global emission totals (kg) of gridded flux files, and the csv/v1 zip
+#  archives of them, in place of the total(field*surf*month_length*
+#  secs_per_day) loops and printf tables of the IDL combine_all_sources_*.pro
+#  and *_combine_sectors.pro scripts.
+#
+#  A file is read a time chunk at a time with netCDF4 (all of its sector
+#  variables in the same pass) and each chunk is reduced to the global
+#  emission rate (kg s-1) of each time step, summed over any levels. The
+#  cell areas of a longitude-latitude grid (0.5x0.5 degree, N96e or any
+#  other) are the product of a longitude and a latitude factor, so this is
+#  two small matrix products; the factors are cached by grid. A month's
+#  total is its rate times its length in the file's calendar, as in the IDL:
+#  30 days in the 360_day files, whose fluxes were already scaled by
+#  month_length/30, so both calendars give the same totals.
+#
+#  An archive is described by a JSON manifest of
+#      {"CO_20170607.zip": {"combined": "combined_sources_CO_1960-2020_greg.nc",
+#                           "anthrop": {"file": "...", "variable": "emiss_flux"},
+#                           ...},
+#       "aircraft_NO.zip": {"aircraft": "MACCity_aircraft_NO_1960-2020_n96l85.nc"}}
+#  and gets CO_monthly_<sector>.csv and CO_annual_<sector>.csv for each
+#  sector, laid out as the IDL wrote them. The 'aircraft' sector is the one
+#  annual table of aircraft_NO.zip, in Tg of NO and of N.
+#
+#  Usage (from emissions/python):
+#      python -m ukca_emiss.totals manifest.json --output-dir /path/to/csv --processes 8
+#
+##############################################################################################
+
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+import time
+import traceback
+import zipfile
+
+import cftime
+import netCDF4
+import numpy
+
+from .append import _guess_bounds
+from .grids import UM_COORD_SYSTEM
+from .regrid import CHUNK_SIZE
+
+# the Earth radius of the cell areas; the IDL scripts use either this or
+# 6371 km, which changes the totals by 7e-5
+EARTH_RADIUS = UM_COORD_SYSTEM.semi_major_axis
+
+SECONDS_PER_DAY = 86400.0
+
+# the IDL's free format for doubles, e.g. '   8.6071550e+10'
+TOTAL_FORMAT = '{:#16.8g}'
+
+# the columns of the aircraft table: name and kg of it per kg of NO
+AIRCRAFT_COLUMNS = (('Tg_NO_yr-1', 1.0), ('Tg_N_yr-1', 14.0 / 30.0))
+
+# area factors already worked out by this process, keyed by grid
+_AREA_CACHE = {}
+
+
+def _bounds(dataset, dim):
+    # the cell bounds (degrees) of the coordinate variable of dimension dim
+    coord = dataset.variables[dim]
+    name = getattr(coord, 'bounds', None)
+    if name in dataset.variables:
+        return numpy.asarray(dataset.variables[name][:], dtype='float64')
+    return _guess_bounds(coord[:])
+
+
+def area_factors(x_bounds, y_bounds, radius=EARTH_RADIUS):
+    """Return the factors (wy, wx) of the cell areas (m2) of the grid with
+    longitude and latitude bounds *x_bounds* and *y_bounds* (degrees):
+    the area of cell (j, i) is wy[j] * wx[i]."""
+    x_bounds = numpy.asarray(x_bounds, dtype='float64')
+    y_bounds = numpy.asarray(y_bounds, dtype='float64')
+    digest = hashlib.sha1()
+    for array in (x_bounds, y_bounds, numpy.float64(radius)):
+        digest.update(numpy.ascontiguousarray(array).tobytes())
+    key = digest.hexdigest()
+    if key not in _AREA_CACHE:
+        wx = numpy.radians(numpy.abs(x_bounds[:, 1] - x_bounds[:, 0]))
+        sin_y = numpy.sin(numpy.radians(numpy.clip(y_bounds, -90.0, 90.0)))
+        wy = radius ** 2 * numpy.abs(sin_y[:, 1] - sin_y[:, 0])
+        _AREA_CACHE[key] = (wy, wx)
+    return _AREA_CACHE[key]
+
+
+def _data_variable(dataset, name=None):
+    # the emissions variable: the one with the most dimensions (at least
+    # time, latitude and longitude) that isn't a coordinate or bounds
+    if name is not None:
+        return dataset.variables[name]
+    others = set(dataset.dimensions)
+    for variable in dataset.variables.values():
+        others.update(getattr(variable, 'bounds', '').split())
+    candidates = [variable for variable in dataset.variables.values()
+                  if variable.ndim >= 3 and variable.name not in others]
+    if not candidates:
+        raise ValueError('No emissions variable in {}.'
+                         .format(dataset.filepath()))
+    most = max(variable.ndim for variable in candidates)
+    candidates = [variable for variable in candidates
+                  if variable.ndim == most]
+    if len(candidates) > 1:
+        raise ValueError('More than one emissions variable in {} ({}), give '
+                         'the name of one.'.format(
+                             dataset.filepath(),
+                             ', '.join(variable.name
+                                       for variable in candidates)))
+    return candidates[0]
+
+
+def _valid(variable, block):
+    # block with the missing data set to 0 (not masked, as that fails if
+    # missing_value is a double and the data float)
+    block = numpy.asarray(block)
+    missing = ~numpy.isfinite(block)
+    for name in ('_FillValue', 'missing_value'):
+        for value in numpy.atleast_1d(getattr(variable, name, [])):
+            missing |= block == numpy.array(value).astype(block.dtype)
+    if missing.any():
+        block = numpy.where(missing, 0, block)
+    return block
+
+
+def file_totals(path, variables=(None,), chunk_size=CHUNK_SIZE,
+                radius=EARTH_RADIUS):
+    """Return the global emissions of each time step of the *variables*
+    (names, None for the one emissions variable) of the netCDF file *path*,
+    fluxes in kg m-2 s-1 on a longitude-latitude grid.
+
+    The result is a list with a dict for each variable of 'dates' (the (year,
+    month) of each step), 'days' (the length of each month in the file's
+    calendar), 'rate' (the global emission rate in kg s-1, summed over any
+    levels) and 'kg' (the total of each month), along with the 'variable'
+    name and 'calendar'. The file is read once, *chunk_size* time steps
+    at a time.
+    """
+    with netCDF4.Dataset(path) as dataset:
+        data = [_data_variable(dataset, name) for name in variables]
+        dims = data[0].dimensions
+        for variable in data:
+            if variable.dimensions[0] != dims[0] or \
+                    variable.dimensions[-2:] != dims[-2:]:
+                raise ValueError('The variables of {} are on different grids.'
+                                 .format(path))
+            variable.set_auto_mask(False)
+        time_coord = dataset.variables[dims[0]]
+        calendar = getattr(time_coord, 'calendar', 'standard')
+        dates = cftime.num2date(time_coord[:], time_coord.units, calendar)
+        wy, wx = area_factors(_bounds(dataset, dims[-1]),
+                              _bounds(dataset, dims[-2]), radius)
+        rates = numpy.zeros((len(data), len(dates)))
+        for start in range(0, len(dates), chunk_size):
+            for rate, variable in zip(rates, data):
+                block = _valid(variable, variable[start:start + chunk_size])
+                block = block.reshape((block.shape[0], -1) + block.shape[-2:])
+                rate[start:start + chunk_size] = \
+                    numpy.matmul(numpy.matmul(block, wx), wy).sum(axis=1)
+        names = [variable.name for variable in data]
+    days = numpy.array([date.daysinmonth for date in dates], dtype='float64')
+    dates = [(date.year, date.month) for date in dates]
+    return [{'variable': name, 'calendar': calendar, 'dates': dates,
+             'days': days, 'rate': rate, 'kg': rate * days * SECONDS_PER_DAY}
+            for name, rate in zip(names, rates)]
+
+
+def global_totals(path, variable=None, chunk_size=CHUNK_SIZE,
+                  radius=EARTH_RADIUS):
+    """Return the global emissions of each time step of *variable* (by
+    default the one emissions variable) of the netCDF file *path*, as a
+    dict of file_totals."""
+    return file_totals(path, [variable], chunk_size=chunk_size,
+                       radius=radius)[0]
+
+
+def annual_totals(totals):
+    """Return {year: kg} for the complete years of *totals* (from
+    global_totals)."""
+    years = {}
+    for (year, month), value in zip(totals['dates'], totals['kg']):
+        years.setdefault(year, {})[month] = value
+    return dict((year, sum(months.values()))
+                for year, months in years.items() if len(months) == 12)
+
+
+def read_csv_totals(path, member):
+    """Return the totals in the csv/v1 table *member* of the zip file
+    *path*: {(year, month): kg} for a monthly table ("1960-1 , 8.6e+10"
+    lines), or {year: kg} for an annual one ("1960   8.5e+11", or the
+    first column of a table in Tg with a header line)."""
+    totals = {}
+    factor = 1.0
+    with zipfile.ZipFile(path) as archive:
+        text = io.TextIOWrapper(archive.open(member), encoding='ascii')
+        for line in text:
+            fields = line.replace(',', ' ').split()
+            if not fields:
+                continue
+            if not fields[0][:1].isdigit():
+                # a header
+                factor = 1e9 if fields[1].startswith('Tg') else 1.0
+                continue
+            if '-' in fields[0]:
+                year, month = fields[0].split('-')
+                key = (int(year), int(month))
+            else:
+                key = int(fields[0])
+            totals[key] = float(fields[1]) * factor
+    return totals
+
+
+def monthly_table(totals):
+    """Return the *_monthly_*.csv table of *totals* (from global_totals)."""
+    return ''.join('{}-{} , {}\n'.format(year, month,
+                                         TOTAL_FORMAT.format(value))
+                   for (year, month), value in zip(totals['dates'],
+                                                   totals['kg']))
+
+
+def annual_table(totals):
+    """Return the *_annual_*.csv table of the complete years of *totals*."""
+    years = annual_totals(totals)
+    return ''.join('{}{}\n'.format(year, TOTAL_FORMAT.format(years[year]))
+                   for year in sorted(years))
+
+
+def aircraft_table(totals):
+    """Return the annual table of aircraft_NO.zip: Tg of NO and of N."""
+    years = annual_totals(totals)
+    lines = ['Year ' + ' '.join(name for name, factor in AIRCRAFT_COLUMNS)]
+    for year in sorted(years):
+        lines.append('{} {}'.format(year, ' '.join(
+            '{:#.8g}'.format(years[year] * factor / 1e9)
+            for name, factor in AIRCRAFT_COLUMNS)))
+    return '\n'.join(lines) + '\n'
+
+
+def archive_tables(name, sectors):
+    """Return {member: text} of the zip archive *name* (e.g.
+    CO_20170607.zip) from {sector: totals}."""
+    prefix = re.sub(r'(_\d{8})?\.zip$', '', os.path.basename(name))
+    members = {}
+    for sector, totals in sectors.items():
+        if sector == 'aircraft':
+            members['{}_annual.csv'.format(prefix)] = aircraft_table(totals)
+            continue
+        members['{}_monthly_{}.csv'.format(prefix, sector)] = \
+            monthly_table(totals)
+        members['{}_annual_{}.csv'.format(prefix, sector)] = \
+            annual_table(totals)
+    return members
+
+
+def write_archive(path, members):
+    """Write the zip file *path* of {member: text}."""
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # written to a temporary file and renamed into place, so a failed run
+    # doesn't leave half an archive
+    fd, tmpname = tempfile.mkstemp(suffix='.zip', dir=directory)
+    os.close(fd)
+    # (mkstemp makes the file readable by its owner only)
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmpname, 0o666 & ~umask)
+    try:
+        with zipfile.ZipFile(tmpname, 'w', zipfile.ZIP_DEFLATED) as archive:
+            stamp = time.localtime()[:6]
+            for member in sorted(members):
+                info = zipfile.ZipInfo(member, date_time=stamp)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = 0o644 << 16
+                archive.writestr(info, members[member])
+        os.rename(tmpname, path)
+    except BaseException:
+        os.remove(tmpname)
+        raise
+
+
+def read_manifest(path):
+    """Return the archives of the JSON manifest *path*, as {archive:
+    {sector: (file, variable)}}, with the files relative to the manifest."""
+    with open(path) as infile:
+        manifest = json.load(infile)
+    directory = os.path.dirname(os.path.abspath(path))
+    archives = {}
+    for name, sectors in manifest.items():
+        archives[name] = {}
+        for sector, entry in sectors.items():
+            if not isinstance(entry, dict):
+                entry = {'file': entry}
+            archives[name][sector] = (
+                os.path.join(directory, os.path.expanduser(entry['file'])),
+                entry.get('variable'))
+    return archives
+
+
+def _file_job(args):
+    # totals of the variables of one file, in a worker process
+    path, variables, chunk_size, radius = args
+    start = time.time()
+    try:
+        totals = file_totals(path, variables, chunk_size=chunk_size,
+                             radius=radius)
+        return path, dict(zip(variables, totals)), None, time.time() - start
+    except BaseException:
+        return path, None, traceback.format_exc(), time.time() - start
+
+
+def make_archives(archives, output_dir, processes=None, chunk_size=CHUNK_SIZE,
+                  radius=EARTH_RADIUS):
+    """Write the zip archives of *archives* (from read_manifest) to
+    *output_dir*, reading each file once, with the files shared across
+    *processes* worker processes (one per CPU by default; 1 reads them in
+    this process). Returns (file, error, seconds) for every file, error
+    being None if it succeeded; archives with a failed file aren't written.
+    """
+    # each file is read once, for all the sectors that use it
+    variables = {}
+    for sectors in archives.values():
+        for path, variable in sectors.values():
+            variables.setdefault(path, set()).add(variable)
+    jobs = [(path, sorted(names, key=str), chunk_size, radius)
+            for path, names in sorted(variables.items())]
+    if processes == 1:
+        results = [_file_job(job) for job in jobs]
+    else:
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(processes=processes)
+        try:
+            results = list(pool.imap_unordered(_file_job, jobs))
+        finally:
+            pool.close()
+            pool.join()
+
+    files = dict((path, totals) for path, totals, error, seconds in results
+                 if error is None)
+    for name, sectors in sorted(archives.items()):
+        if any(path not in files for path, variable in sectors.values()):
+            continue
+        tables = dict((sector, files[path][variable])
+                      for sector, (path, variable) in sectors.items())
+        write_archive(os.path.join(output_dir, name),
+                      archive_tables(name, tables))
+    return [(path, error, seconds)
+            for path, totals, error, seconds in results]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Write the csv/v1 zip archives of monthly and annual '
+                    'emission totals from gridded flux files.')
+    parser.add_argument('manifests', nargs='+',
+                        help='JSON files of {archive: {sector: file}}')
+    parser.add_argument('--output-dir', default='.',
+                        help='directory to write the archives to '
+                             '(default: the current directory)')
+    parser.add_argument('--only', nargs='+', default=None,
+                        help='only write these archives')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes (default: one per '
+                             'CPU)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='time steps read at a time '
+                             '(default: %(default)s)')
+    parser.add_argument('--radius', type=float, default=EARTH_RADIUS,
+                        help='Earth radius of the cell areas in m '
+                             '(default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    archives = {}
+    for path in args.manifests:
+        archives.update(read_manifest(path))
+    if args.only:
+        archives = dict((name, archives[name]) for name in args.only
+                        if name in archives)
+    results = make_archives(archives, args.output_dir,
+                            processes=args.processes,
+                            chunk_size=args.chunk_size, radius=args.radius)
+
+    failures = [result for result in results if result[1] is not None]
+    for path, error, seconds in sorted(results):
+        print('{:6} {:8.1f}s  {}'.format('FAILED' if error else 'ok',
+                                         seconds, path))
+    for path, error, seconds in sorted(failures):
+        sys.stderr.write('\nFAILED: {}\n{}'.format(path, error))
+    print('{} archives from {} files, {} failed'.format(
+        len(archives), len(results), len(failures)))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
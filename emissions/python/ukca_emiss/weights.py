@@ -0,0 +1,217 @@
+##############################################################################################
+#
+#  weights.py
+#
+#  Area-weighted regridding weights between two rectilinear longitude-latitude
+#  grids, held as a sparse matrix and cached on disk.
+#
+#  The overlap area of a source cell (lon0:lon1, lat0:lat1) with a target cell
+#  on the sphere is proportional to
+#      (overlap in longitude) * (overlap in sin(latitude))
+#  which is the same weighting used by iris.analysis.AreaWeighted. Each row of
+#  the weight matrix is normalised by the total overlap of that target cell so
+#  that applying the matrix to a flattened (y, x) field gives the area-weighted
+#  mean of the source cells under each target cell.
+#
+#  The weights for a given source/target pair only depend on the coordinate
+#  bounds, so they are keyed by a hash of the bounds (and the coordinate
+#  system) and written to a cache directory. The directory can be set with the
+#  UKCA_EMISS_CACHE_DIR environment variable and defaults to
+#  ~/.cache/ukca_emiss.
+#
+#  Because the overlap area is a product of a longitude term and a latitude
+#  term, the full matrix is the Kronecker product of a (nx_tgt, nx_src)
+#  longitude matrix and a (ny_tgt, ny_src) latitude matrix. load_factors
+#  returns these two small dense matrices, which is all the separable regrid
+#  in regrid.py needs.
+#
+##############################################################################################
+
+import hashlib
+import os
+import tempfile
+
+import numpy
+import scipy.sparse
+
+# bump this if the way the weights are calculated changes, so that old cache
+# files are no longer picked up
+WEIGHTS_VERSION = 1
+
+# weights already calculated or read by this process, keyed by cache key
+_MEMORY_CACHE = {}
+
+
+def cache_dir():
+    """Return the directory used to store regrid weights on disk."""
+    default = os.path.join(os.path.expanduser('~'), '.cache', 'ukca_emiss')
+    return os.environ.get('UKCA_EMISS_CACHE_DIR', default)
+
+
+def horizontal_bounds(cube):
+    """Return the (x, y) bounds of *cube* in degrees as float64 arrays.
+
+    The horizontal coordinates must be one-dimensional and have bounds.
+    """
+    bounds = []
+    for axis in ('x', 'y'):
+        coord = cube.coord(axis=axis, dim_coords=True)
+        if not coord.has_bounds():
+            raise ValueError('The {} coordinate {!r} has no bounds, call '
+                             'guess_bounds() before regridding.'
+                             .format(axis, coord.name()))
+        values = coord.units.convert(coord.bounds.astype('float64'), 'degrees')
+        bounds.append(numpy.asarray(values, dtype='float64'))
+    return tuple(bounds)
+
+
+def weights_key(src_cube, grid_cube):
+    """Return the cache key for regridding *src_cube* onto *grid_cube*.
+
+    The key is a hash of the horizontal coordinate bounds and coordinate
+    system of both grids, so any change in resolution, origin or bounds
+    gives a new set of weights.
+    """
+    sha = hashlib.sha1()
+    sha.update(('area_weighted-v{}'.format(WEIGHTS_VERSION)).encode('ascii'))
+    for cube in (src_cube, grid_cube):
+        sha.update(repr(cube.coord_system()).encode('utf-8'))
+        for bounds in horizontal_bounds(cube):
+            sha.update(repr(bounds.shape).encode('ascii'))
+            sha.update(numpy.ascontiguousarray(bounds).tobytes())
+    return sha.hexdigest()
+
+
+def _sorted(bounds):
+    return numpy.sort(bounds, axis=1)
+
+
+def lon_overlaps(tgt_bounds, src_bounds, modulus=360.0):
+    """Return the (ntgt, nsrc) matrix of longitude overlaps in degrees.
+
+    Longitude is treated as circular, so a target cell spanning the origin
+    (e.g. -0.9375 to 0.9375) overlaps source cells at both ends of a
+    0 to 360 source grid.
+    """
+    tgt = _sorted(tgt_bounds)
+    src = _sorted(src_bounds)
+    t0 = tgt[:, 0:1]
+    t1 = tgt[:, 1:2]
+    # range of whole-circle shifts that can bring a source cell onto a target
+    kmin = int(numpy.floor((tgt.min() - src.max()) / modulus))
+    kmax = int(numpy.ceil((tgt.max() - src.min()) / modulus))
+    overlap = numpy.zeros((tgt.shape[0], src.shape[0]), dtype='float64')
+    for k in range(kmin, kmax + 1):
+        s0 = src[:, 0][numpy.newaxis, :] + k * modulus
+        s1 = src[:, 1][numpy.newaxis, :] + k * modulus
+        overlap += numpy.clip(numpy.minimum(t1, s1) - numpy.maximum(t0, s0),
+                              0.0, None)
+    return overlap
+
+
+def lat_overlaps(tgt_bounds, src_bounds):
+    """Return the (ntgt, nsrc) matrix of overlaps in sin(latitude)."""
+    tgt = numpy.sin(numpy.deg2rad(numpy.clip(_sorted(tgt_bounds), -90.0, 90.0)))
+    src = numpy.sin(numpy.deg2rad(numpy.clip(_sorted(src_bounds), -90.0, 90.0)))
+    upper = numpy.minimum(tgt[:, 1:2], src[:, 1][numpy.newaxis, :])
+    lower = numpy.maximum(tgt[:, 0:1], src[:, 0][numpy.newaxis, :])
+    return numpy.clip(upper - lower, 0.0, None)
+
+
+def _normalise_rows(overlap):
+    totals = overlap.sum(axis=1, keepdims=True)
+    return numpy.divide(overlap, totals, out=numpy.zeros_like(overlap),
+                        where=totals > 0)
+
+
+def calculate_factors(src_cube, grid_cube):
+    """Calculate the separable factors of the area-weighted regrid matrix.
+
+    Returns dense, row-normalised matrices (wy, wx) of shape
+    (ny_tgt, ny_src) and (nx_tgt, nx_src), so that a (y, x) field is
+    regridded by wy @ field @ wx.T.
+    """
+    src_x, src_y = horizontal_bounds(src_cube)
+    tgt_x, tgt_y = horizontal_bounds(grid_cube)
+    wy = _normalise_rows(lat_overlaps(tgt_y, src_y))
+    wx = _normalise_rows(lon_overlaps(tgt_x, src_x))
+    return wy, wx
+
+
+def calculate_weights(src_cube, grid_cube):
+    """Calculate the sparse area-weighted regrid matrix.
+
+    Returns a CSR matrix of shape (ny_tgt*nx_tgt, ny_src*nx_src) acting on
+    fields flattened in (y, x) order.
+    """
+    wy, wx = calculate_factors(src_cube, grid_cube)
+    return scipy.sparse.kron(scipy.sparse.csr_matrix(wy),
+                             scipy.sparse.csr_matrix(wx), format='csr')
+
+
+def _cache_file(key, directory):
+    return os.path.join(directory, 'area_weights_{}.npz'.format(key))
+
+
+def load_weights(src_cube, grid_cube, directory=None):
+    """Return the sparse regrid matrix from *src_cube* to *grid_cube*.
+
+    The matrix is taken from the in-memory cache, then the on-disk cache,
+    and is only calculated if neither has it. Newly calculated weights are
+    written to the on-disk cache so later runs (for other species or
+    calendars on the same grids) can reuse them.
+    """
+    key = weights_key(src_cube, grid_cube)
+    if key in _MEMORY_CACHE:
+        return _MEMORY_CACHE[key]
+
+    if directory is None:
+        directory = cache_dir()
+    filename = _cache_file(key, directory)
+    if os.path.exists(filename):
+        weights = scipy.sparse.load_npz(filename).tocsr()
+    else:
+        weights = calculate_weights(src_cube, grid_cube)
+        _save_weights(weights, filename)
+    _MEMORY_CACHE[key] = weights
+    return weights
+
+
+def factors_key(src_cube, grid_cube):
+    """Return the in-memory cache key of the separable regrid factors."""
+    return 'factors-' + weights_key(src_cube, grid_cube)
+
+
+def add_to_cache(key, weights):
+    """Put already calculated *weights* into the in-memory cache."""
+    _MEMORY_CACHE[key] = weights
+
+
+def load_factors(src_cube, grid_cube):
+    """Return the separable regrid factors (wy, wx), see calculate_factors.
+
+    The factors are small and quick to calculate, so they are only cached
+    in memory.
+    """
+    key = factors_key(src_cube, grid_cube)
+    if key not in _MEMORY_CACHE:
+        _MEMORY_CACHE[key] = calculate_factors(src_cube, grid_cube)
+    return _MEMORY_CACHE[key]
+
+
+def _save_weights(weights, filename):
+    directory = os.path.dirname(filename)
+    tmpname = None
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # write to a temporary file and rename it into place, so that other
+        # scripts running at the same time never see a partial file
+        fd, tmpname = tempfile.mkstemp(suffix='.npz', dir=directory)
+        os.close(fd)
+        scipy.sparse.save_npz(tmpname, weights)
+        os.rename(tmpname, filename)
+    except (IOError, OSError):
+        # a read-only or full cache directory shouldn't stop the regrid
+        if tmpname is not None and os.path.exists(tmpname):
+            os.remove(tmpname)
@@ -0,0 +1,290 @@
+##############################################################################################
+#
+#  writer.py
+#
+#  A netCDF writer for the ukca_emiss_*.nc files, using netCDF4 directly
+#  rather than Iris's Saver.
+#
+#  The file has the same layout and attributes as the Saver gives for an
+#  emissions cube (CF coordinate and bounds variables, grid mapping, the
+#  attributes in local_keys on the data variable and the rest as global
+#  attributes), but the data variable can be chunked (by default one time
+#  step per chunk) and compressed with zlib and the shuffle filter, which
+#  needs one of the NETCDF4 formats. Lazy data are written one dask chunk
+#  (or block of levels) at a time, either straight away (on a writer thread
+#  while the next chunk is computed, see pipeline.py) or later, along with
+#  other files (see output.deferred).
+#
+##############################################################################################
+
+import os
+import threading
+
+import iris.coord_systems
+import iris.fileformats.netcdf
+import iris.util
+import netCDF4
+import numpy
+
+from . import pipeline as _pipeline
+from . import timing as _timing
+
+try:
+    # the lock Iris holds while it reads netCDF files
+    from iris.fileformats.netcdf._thread_safe_nc import \
+        _GLOBAL_NETCDF4_LOCK as _NETCDF_LOCK
+except ImportError:
+    _NETCDF_LOCK = threading.Lock()
+
+# formats that can't hold 64-bit or unsigned integers
+_CLASSIC_FORMATS = ('NETCDF3_CLASSIC', 'NETCDF3_64BIT', 'NETCDF3_64BIT_OFFSET',
+                    'NETCDF4_CLASSIC')
+
+# one lock per file, for writes from several threads
+_LOCKS = {}
+_LOCKS_LOCK = threading.Lock()
+
+
+def _file_lock(path):
+    with _LOCKS_LOCK:
+        return _LOCKS.setdefault(path, threading.Lock())
+
+
+class _VariableWriter(object):
+    # stands in for a netCDF variable as the target of pipeline.store or
+    # pipeline.store_together, opening the (closed) file for each chunk written
+
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self.lock = _file_lock(path)
+
+    @_timing.timed('write')
+    def __setitem__(self, keys, values):
+        # the netCDF library isn't thread-safe, so no reads meanwhile
+        with self.lock, _NETCDF_LOCK:
+            dataset = netCDF4.Dataset(self.path, 'a')
+            try:
+                dataset.variables[self.name][keys] = values
+            finally:
+                dataset.close()
+
+
+def _var_name(coord_or_cube):
+    return coord_or_cube.var_name or coord_or_cube.name()
+
+
+def _units(coord):
+    # as the Saver: degrees of latitude and longitude get CF units
+    units = str(coord.units)
+    if isinstance(coord.coord_system, (iris.coord_systems.GeogCS, type(None))) \
+            and coord.units == 'degrees':
+        if coord.standard_name == 'latitude':
+            units = 'degrees_north'
+        elif coord.standard_name == 'longitude':
+            units = 'degrees_east'
+    return units
+
+
+def _valid_dtype(values, netcdf_format):
+    # the classic formats have no 64-bit or unsigned integers
+    values = numpy.asarray(values)
+    if netcdf_format in _CLASSIC_FORMATS and values.dtype.kind in 'iu' and \
+            values.dtype.itemsize >= 4 and values.dtype != numpy.int32:
+        values = values.astype('int32')
+    return values
+
+
+def _grid_mapping(dataset, coord_system):
+    # write the grid mapping variable for coord_system, returning its name
+    if isinstance(coord_system, iris.coord_systems.RotatedGeogCS):
+        name = 'rotated_latitude_longitude'
+        attributes = [
+            ('grid_north_pole_latitude', coord_system.grid_north_pole_latitude),
+            ('grid_north_pole_longitude',
+             coord_system.grid_north_pole_longitude),
+            ('north_pole_grid_longitude',
+             coord_system.north_pole_grid_longitude)]
+        ellipsoid = coord_system.ellipsoid
+    elif isinstance(coord_system, iris.coord_systems.GeogCS):
+        name = 'latitude_longitude'
+        attributes = [('longitude_of_prime_meridian',
+                       coord_system.longitude_of_prime_meridian)]
+        ellipsoid = coord_system
+    else:
+        return None
+    if ellipsoid is not None:
+        if ellipsoid.semi_major_axis == ellipsoid.semi_minor_axis:
+            attributes.append(('earth_radius', ellipsoid.semi_major_axis))
+        else:
+            attributes.append(('semi_major_axis', ellipsoid.semi_major_axis))
+            attributes.append(('semi_minor_axis', ellipsoid.semi_minor_axis))
+    if name not in dataset.variables:
+        variable = dataset.createVariable(name, 'i4')
+        variable.setncattr('grid_mapping_name', name)
+        for key, value in attributes:
+            variable.setncattr(key, float(value))
+    return name
+
+
+def _cell_methods(cube):
+    methods = []
+    for method in cube.cell_methods:
+        text = ''.join('{}: '.format(name) for name in method.coord_names)
+        text += method.method
+        extra = ['interval: {}'.format(interval)
+                 for interval in method.intervals]
+        extra += ['comment: {}'.format(comment)
+                  for comment in method.comments]
+        if extra:
+            text += ' ({})'.format(' '.join(extra))
+        methods.append(text)
+    return ' '.join(methods)
+
+
+def _write_coord(dataset, coord, dims, netcdf_format, axis=None):
+    name = _var_name(coord)
+    points = _valid_dtype(coord.points, netcdf_format)
+    variable = dataset.createVariable(name, points.dtype, dims)
+    if axis:
+        variable.setncattr('axis', axis)
+    if coord.has_bounds():
+        bounds = _valid_dtype(coord.bounds, netcdf_format)
+        bounds_dim = 'bnds' if bounds.shape[-1] == 2 \
+            else 'bnds_{}'.format(bounds.shape[-1])
+        if bounds_dim not in dataset.dimensions:
+            dataset.createDimension(bounds_dim, bounds.shape[-1])
+        variable.setncattr('bounds', name + '_bnds')
+        bounds_variable = dataset.createVariable(name + '_bnds', bounds.dtype,
+                                                 dims + (bounds_dim,))
+        bounds_variable[:] = bounds
+    variable.setncattr('units', _units(coord))
+    if coord.standard_name:
+        variable.setncattr('standard_name', coord.standard_name)
+    if coord.long_name:
+        variable.setncattr('long_name', coord.long_name)
+    if coord.units.is_time_reference():
+        variable.setncattr('calendar', coord.units.calendar)
+    for key in sorted(coord.attributes):
+        variable.setncattr(key, coord.attributes[key])
+    variable[:] = points
+    return name
+
+
+def default_chunks(cube):
+    """Return the netCDF chunk shape for *cube*: one time step per chunk,
+    and the levels of a dask chunk of lazy data (see
+    pipeline.stream_levels)."""
+    chunks = list(cube.shape)
+    time_coords = cube.coords(axis='t', dim_coords=True)
+    if time_coords:
+        dim, = cube.coord_dims(time_coords[0])
+        chunks[dim] = 1
+    level_coords = cube.coords(axis='z', dim_coords=True)
+    if level_coords and cube.has_lazy_data():
+        dim, = cube.coord_dims(level_coords[0])
+        chunks[dim] = cube.lazy_data().chunks[dim][0]
+    return tuple(chunks)
+
+
+def write(cube, outpath, netcdf_format='NETCDF3_CLASSIC', local_keys=(),
+          fill_value=None, unlimited=False, chunks=None, zlib=False,
+          complevel=4, shuffle=True, compute=True):
+    """Write *cube* to the new netCDF file *outpath*.
+
+    The attributes named in *local_keys* go on the data variable, the rest
+    are global attributes. The time dimension is unlimited if *unlimited*
+    is True. For the NETCDF4 formats the data variable is stored in chunks
+    of shape *chunks* (by default default_chunks(cube)) and is compressed
+    with zlib at level *complevel* if *zlib* is True, using the shuffle
+    filter if *shuffle* is True.
+
+    If *compute* is False, the data of a cube with lazy data are not
+    written, and the (data, target) to write them with (see
+    pipeline.store_together) are returned.
+    """
+    # the data may be written later, from another directory
+    outpath = os.path.abspath(outpath)
+    netcdf4 = netcdf_format.startswith('NETCDF4')
+    if not netcdf4 and (chunks is not None or zlib):
+        raise ValueError('Chunking and compression need a NETCDF4 format, '
+                         'not {}.'.format(netcdf_format))
+
+    dim_names = []
+    for dim in range(cube.ndim):
+        coords = cube.coords(dimensions=dim, dim_coords=True)
+        dim_names.append(_var_name(coords[0]) if coords
+                         else 'dim{}'.format(dim))
+
+    # the header, and the data if they aren't lazy
+    with _timing.stage('write'):
+        dataset = netCDF4.Dataset(outpath, 'w', format=netcdf_format)
+        try:
+            for name, size in zip(dim_names, cube.shape):
+                dataset.createDimension(
+                    name, None if unlimited and name == 'time' else size)
+
+            for coord in cube.dim_coords:
+                dim, = cube.coord_dims(coord)
+                _write_coord(dataset, coord, (dim_names[dim],), netcdf_format,
+                             axis=iris.util.guess_coord_axis(coord))
+            aux_names = []
+            for coord in cube.aux_coords:
+                dims = tuple(dim_names[dim] for dim in cube.coord_dims(coord))
+                aux_names.append(_write_coord(dataset, coord, dims,
+                                              netcdf_format))
+
+            variable_args = {}
+            if netcdf4:
+                variable_args['chunksizes'] = tuple(chunks or
+                                                    default_chunks(cube))
+                if zlib:
+                    variable_args.update(zlib=True, complevel=complevel,
+                                         shuffle=shuffle)
+            if fill_value is not None:
+                fill_value = numpy.array(fill_value, dtype=cube.dtype)
+            attributes = {}
+            if cube.standard_name:
+                attributes['standard_name'] = cube.standard_name
+            if cube.long_name:
+                attributes['long_name'] = cube.long_name
+            attributes['units'] = str(cube.units)
+            for key in sorted(local_keys):
+                if key in cube.attributes:
+                    attributes[key] = cube.attributes[key]
+            if cube.cell_methods:
+                attributes['cell_methods'] = _cell_methods(cube)
+            grid_mapping = _grid_mapping(dataset, cube.coord_system())
+            if grid_mapping:
+                attributes['grid_mapping'] = grid_mapping
+            if aux_names:
+                attributes['coordinates'] = ' '.join(sorted(aux_names))
+            global_attributes = {
+                'Conventions': iris.fileformats.netcdf.CF_CONVENTIONS_VERSION}
+            for key in sorted(cube.attributes):
+                if key not in local_keys and key != 'Conventions':
+                    global_attributes[key] = cube.attributes[key]
+
+            # in the classic formats each change to the header once the data
+            # variable exists moves (after first filling) all of its data, so
+            # it is made last, with all its attributes set at once
+            dataset.setncatts(global_attributes)
+            name = _var_name(cube)
+            variable = dataset.createVariable(name, cube.dtype,
+                                              tuple(dim_names),
+                                              fill_value=fill_value,
+                                              **variable_args)
+            variable.setncatts(attributes)
+
+            if not cube.has_lazy_data():
+                variable[:] = cube.data
+        finally:
+            dataset.close()
+
+    if cube.has_lazy_data():
+        # write the data one dask chunk at a time
+        target = _VariableWriter(outpath, name)
+        if not compute:
+            return cube.lazy_data(), target
+        _pipeline.store(cube.lazy_data(), target)
+    return None